@@ -3,6 +3,7 @@ from sentence_transformers import SentenceTransformer
 from flask import Flask, request, jsonify
 from backend.Lib.Logger import Logger
 from backend.Lib.Config import SENTENCE_TRANSFORMER_MODEL, MAIN_SERVER
+from backend.Lib.Metrics import REGISTRY, register_metrics
 from typing import List, Any
 
 app = Flask(__name__)
@@ -17,6 +18,10 @@ CORS(
       }
   },
 )
+register_metrics(app)
+
+EMBED_BATCH_SIZE = REGISTRY.histogram("embedding_batch_size", "Texts per encode call", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+EMBED_DURATION = REGISTRY.histogram("embedding_duration_seconds", "SentenceTransformer encode time")
 
 class Encoder:
   __sentence_transformer = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
@@ -24,7 +29,9 @@ class Encoder:
   @classmethod
   def encode(cls, data: List[Any]):
     try:
-      embeddings = cls.__sentence_transformer.encode(data)
+      EMBED_BATCH_SIZE.observe(len(data))
+      with EMBED_DURATION.time():
+        embeddings = cls.__sentence_transformer.encode(data)
       return embeddings.tolist()
     except Exception as e:
       Logger.log.error(str(e))
@@ -36,8 +43,10 @@ def encode():
   """
   body format
   {
-    data: str
+    data: str[],
+    batch?: bool
   }
+  the vector of the first item of `data`, of each item with `batch`
   """
   try:
     data = request.get_json()
@@ -45,9 +54,15 @@ def encode():
     if len(buffer) == 0:
       raise Exception()
 
-    Logger.log.info(f"data {buffer}")
+    batch = bool(data.get("batch", False))
+    if batch:
+      Logger.log.info(f"data batch of {len(buffer)}")
+    else:
+      Logger.log.info(f"data {buffer}")
     embeddings = Encoder.encode(buffer)
-    if len(embeddings) > 0:
+    if batch and len(embeddings) != len(buffer):
+      raise Exception()
+    if not batch and len(embeddings) > 0:
       embeddings = embeddings[0]
     return jsonify({
       "embeddings": embeddings
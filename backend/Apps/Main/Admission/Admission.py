@@ -0,0 +1,7 @@
+from flask import current_app
+from .AdmissionExtension import KEY
+from .AdmissionService import AdmissionService
+
+def get_admission() -> AdmissionService:
+  service: AdmissionService = current_app.extensions[KEY]
+  return service
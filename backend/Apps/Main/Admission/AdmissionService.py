@@ -0,0 +1,246 @@
+import math
+from threading import Lock
+from time import perf_counter, sleep, time
+from uuid import uuid4
+from redis import Redis
+
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import (
+  CHAT_GENERATION_LEASE_SEC, CHAT_MAX_IN_FLIGHT, CHAT_QUEUE_MAX, CHAT_QUEUE_TIMEOUT_MS,
+  CHAT_RATE_BURST, CHAT_RATE_PER_MIN, REDIS_HOST, REDIS_PORT
+)
+from backend.Lib.Error import TooManyChats
+from backend.Lib.Logger import Logger
+from backend.Lib.Metrics import CHAT_ADMISSION, CHAT_QUEUE_WAIT
+
+BUCKET_PREFIX = "adm:bucket:"
+# the keys of one script are in one hash slot (redis cluster), a script
+# only touches the keys it is passed
+IN_FLIGHT_KEY = "adm:{slots}:inflight"
+RING_KEY = "adm:{slots}:ring"
+SEEN_KEY = "adm:{slots}:seen"
+QUEUES_KEY = "adm:{slots}:queues"
+
+# waiters ask for a slot this often, one that did not ask for _STALE_MS gave up
+_POLL_SEC = 0.05
+_STALE_MS = 1000
+
+# KEYS bucket, ARGV now_ms, tokens per ms, burst. Returns ms until a token is available, 0 took one
+_TAKE_TOKEN = """
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = math.min(burst, (tonumber(b[1]) or burst) + (now - (tonumber(b[2]) or now)) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate) + 1000)
+return wait
+"""
+
+# the tickets of a user in the order they queued, the field `user` of the hash KEYS[n]
+_QUEUE = """
+local function queue(n, user)
+  local q = {}
+  for t in string.gmatch(redis.call('HGET', KEYS[n], user) or '', '%S+') do
+    q[#q + 1] = t
+  end
+  return q
+end
+local function save(n, user, q)
+  if #q == 0 then
+    redis.call('HDEL', KEYS[n], user)
+  else
+    redis.call('HSET', KEYS[n], user, table.concat(q, ' '))
+  end
+end
+"""
+
+# KEYS in flight, ring, seen, queues, ARGV now_ms, max in flight, lease ms, ticket, user, stale ms, max queued.
+# Queues `ticket` behind the other tickets of `user` and `user` in the ring of users with waiters,
+# a slot goes to the first ticket of the first user, who then moves to the end of the ring.
+# Returns 1 admitted, 0 wait, -1 queue full
+_ACQUIRE = _QUEUE + """
+local now, max, lease = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local ticket, user, stale, max_queued = ARGV[4], ARGV[5], tonumber(ARGV[6]), tonumber(ARGV[7])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - stale)
+if not redis.call('ZSCORE', KEYS[3], ticket) then
+  if redis.call('ZCARD', KEYS[3]) >= max_queued then
+    return -1
+  end
+  local q = queue(4, user)
+  if #q == 0 then
+    redis.call('RPUSH', KEYS[2], user)
+  end
+  q[#q + 1] = ticket
+  save(4, user, q)
+end
+redis.call('ZADD', KEYS[3], now, ticket)
+
+while redis.call('ZCARD', KEYS[1]) < max do
+  local head = redis.call('LINDEX', KEYS[2], 0)
+  if not head then
+    return 0
+  end
+  local q = queue(4, head)
+  local first = q[1]
+  local waiting = first and redis.call('ZSCORE', KEYS[3], first)
+  if first and waiting and first ~= ticket then
+    return 0
+  end
+  -- the first ticket is ours or gave up
+  if first then
+    table.remove(q, 1)
+    save(4, head, q)
+  end
+  redis.call('LPOP', KEYS[2])
+  if #q > 0 then
+    redis.call('RPUSH', KEYS[2], head)
+  end
+  if first == ticket then
+    redis.call('ZREM', KEYS[3], ticket)
+    redis.call('ZADD', KEYS[1], now + lease, ticket)
+    return 1
+  end
+end
+return 0
+"""
+
+# KEYS ring, seen, queues, ARGV ticket, user
+_LEAVE = _QUEUE + """
+local q = {}
+for _, t in ipairs(queue(3, ARGV[2])) do
+  if t ~= ARGV[1] then
+    q[#q + 1] = t
+  end
+end
+save(3, ARGV[2], q)
+redis.call('ZREM', KEYS[2], ARGV[1])
+if #q == 0 then
+  redis.call('LREM', KEYS[1], 0, ARGV[2])
+end
+return 0
+"""
+
+class Slot:
+  """
+  A generation admitted by `AdmissionService.admit`, `release` when it ends
+  """
+  def __init__(self, service: "AdmissionService | None" = None, ticket: str = ""):
+    self._service = service
+    self._ticket = ticket
+    self._lock = Lock()
+
+  def release(self):
+    with self._lock:
+      service, self._service = self._service, None
+    if service != None:
+      service._release(self._ticket)
+
+  def hand_off(self) -> "Slot":
+    """
+    The slot for another owner, e.g. a thread that outlives the request,
+    `release` of this one then does nothing
+    """
+    with self._lock:
+      service, self._service = self._service, None
+    return Slot(service, self._ticket)
+
+class AdmissionService:
+  """
+  Admission of the chat generations, shared by the replicas in redis
+
+  Each user has a token bucket of `CHAT_RATE_PER_MIN` replies a minute and
+  `CHAT_RATE_BURST` at once, an empty bucket is a 429 at once. At most
+  `CHAT_MAX_IN_FLIGHT` generations run, each holds a lease until it is
+  released or `CHAT_GENERATION_LEASE_SEC` passed. Requests beyond wait in
+  a queue per user, free slots go to the users round robin so one user
+  with many requests waits behind the others. A request that waited
+  `CHAT_QUEUE_TIMEOUT_MS` or finds `CHAT_QUEUE_MAX` requests waiting gets a
+  429 with `Retry-After`.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=1,
+      socket_connect_timeout=1
+    )
+    self._take_token = self.con_redis.register_script(_TAKE_TOKEN)
+    self._acquire = self.con_redis.register_script(_ACQUIRE)
+    self._leave = self.con_redis.register_script(_LEAVE)
+    self.breaker = Breaker("AdmissionService", "admitting without limits")
+
+  def admit(self, user_id: str) -> Slot:
+    """
+    Waits for a generation slot of `user_id`
+
+    Throws:
+      `TooManyChats`
+    """
+    if not self.breaker.ok():
+      CHAT_ADMISSION.inc("unchecked")
+      return Slot()
+    try:
+      self._check_rate(user_id)
+      if CHAT_MAX_IN_FLIGHT <= 0:
+        CHAT_ADMISSION.inc("admitted")
+        return Slot()
+      return self._wait_slot(user_id)
+    except TooManyChats:
+      raise
+    except Exception as e:
+      self.breaker.failed("admit", e)
+      CHAT_ADMISSION.inc("unchecked")
+      return Slot()
+
+  def _check_rate(self, user_id: str):
+    if CHAT_RATE_PER_MIN <= 0:
+      return
+    wait_ms = int(self._take_token(
+      keys=[ BUCKET_PREFIX + user_id ],
+      args=[ int(time() * 1000), CHAT_RATE_PER_MIN / 60_000, max(1, CHAT_RATE_BURST) ]
+    )) # type: ignore
+    if wait_ms > 0:
+      CHAT_ADMISSION.inc("rate_limited")
+      raise TooManyChats(math.ceil(wait_ms / 1000))
+
+  def _wait_slot(self, user_id: str) -> Slot:
+    ticket = uuid4().hex
+    start = perf_counter()
+    deadline = start + CHAT_QUEUE_TIMEOUT_MS / 1000
+    while True:
+      res = int(self._acquire(
+        keys=[ IN_FLIGHT_KEY, RING_KEY, SEEN_KEY, QUEUES_KEY ],
+        args=[ int(time() * 1000), CHAT_MAX_IN_FLIGHT, CHAT_GENERATION_LEASE_SEC * 1000, ticket, user_id, _STALE_MS, CHAT_QUEUE_MAX ]
+      )) # type: ignore
+      if res == 1:
+        CHAT_QUEUE_WAIT.observe(perf_counter() - start)
+        CHAT_ADMISSION.inc("admitted")
+        return Slot(self, ticket)
+      if res == -1:
+        CHAT_ADMISSION.inc("queue_full")
+        raise TooManyChats(max(1, math.ceil(CHAT_QUEUE_TIMEOUT_MS / 1000)))
+      if perf_counter() >= deadline:
+        self._leave(keys=[ RING_KEY, SEEN_KEY, QUEUES_KEY ], args=[ ticket, user_id ])
+        CHAT_QUEUE_WAIT.observe(perf_counter() - start)
+        CHAT_ADMISSION.inc("queue_timeout")
+        raise TooManyChats(max(1, math.ceil(CHAT_QUEUE_TIMEOUT_MS / 1000)))
+      sleep(_POLL_SEC)
+
+  def _release(self, ticket: str):
+    try:
+      self.con_redis.zrem(IN_FLIGHT_KEY, ticket)
+    except Exception as e:
+      # the lease expires
+      Logger.log.warning(f"AdmissionService::release {repr(e)}")
+
+  def close(self):
+    self.con_redis.close()
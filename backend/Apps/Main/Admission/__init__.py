@@ -0,0 +1,3 @@
+from .AdmissionService import *
+from .AdmissionExtension import *
+from .Admission import *
@@ -0,0 +1,7 @@
+from flask import current_app
+from .AuditLogExtension import KEY
+from .AuditLogService import AuditLogService
+
+def get_audit_log() -> AuditLogService:
+  service: AuditLogService = current_app.extensions[KEY]
+  return service
@@ -0,0 +1,245 @@
+import atexit
+import os
+import socket
+from collections import deque
+from threading import Condition, Event, Thread
+from time import monotonic
+from typing import List
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+from redis import Redis
+
+from backend.Apps.Main.Database import Audit
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import (
+  AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS, AUDIT_OVERFLOW, AUDIT_QUEUE_SIZE, AUDIT_STREAM, AUDIT_WRITE_BEHIND, REDIS_HOST, REDIS_PORT
+)
+from backend.Lib.Logger import Logger
+from backend.Lib.Metrics import AUDIT_PENDING, AUDIT_WRITES
+
+STREAM_KEY = "audit:stream"
+GROUP = "audit-writer"
+# pending stream entries of a replica that died are taken over after this
+_CLAIM_IDLE_MS = 60_000
+_RETRY_SEC = 1.0
+
+class AuditLogService:
+  """
+  Write behind sink for `Audit` documents
+
+  `write` only validates and queues, a background thread inserts the
+  queued documents with `insert_many` every `AUDIT_BATCH_SIZE` documents
+  or `AUDIT_FLUSH_MS`. Documents get their `_id` when queued so a replayed
+  batch does not insert twice.
+
+  The queue holds `AUDIT_QUEUE_SIZE` documents, when it is full
+  `AUDIT_OVERFLOW` decides: `drop` the new document, `drop-oldest` or
+  `sync` (insert it on the request). With `AUDIT_STREAM` the queue is the
+  `audit:stream` redis stream, read by the replicas through a consumer
+  group, so documents queued by a process that dies are inserted by the
+  next one. The in memory queue is used while redis is down.
+
+  Queued documents are flushed when the process exits.
+  """
+  con_redis: Redis | None = None
+
+  def __init__(self):
+    self.write_behind = AUDIT_WRITE_BEHIND
+    self.queue: deque = deque()
+    self._cond = Condition()
+    self._stop = Event()
+    self._consumer = f"{socket.gethostname()}-{os.getpid()}"
+    self.breaker = Breaker("AuditLogService", "queueing in memory")
+    if not self.write_behind:
+      return
+
+    if AUDIT_STREAM:
+      self.con_redis = Redis(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        socket_timeout=max(2, AUDIT_FLUSH_MS / 1000 * 2),
+        socket_connect_timeout=1
+      )
+    self._thread = Thread(target=self._run, name="audit-writer", daemon=True)
+    self._thread.start()
+    atexit.register(self.close)
+
+  # ============ Producers ============
+  def write(self, *audits: Audit):
+    docs = []
+    for audit in audits:
+      audit.validate()
+      doc = audit.to_mongo().to_dict()
+      doc.setdefault("_id", ObjectId())
+      docs.append(doc)
+    if len(docs) == 0:
+      return
+
+    if not self.write_behind:
+      self._insert(docs)
+      return
+    if self.con_redis != None and self.breaker.ok() and self._stream_add(docs):
+      return
+    self._enqueue(docs)
+
+  def _stream_add(self, docs: List[dict]) -> bool:
+    try:
+      pipe = self.con_redis.pipeline(transaction=False) # type: ignore
+      for doc in docs:
+        pipe.xadd(STREAM_KEY, { "d": json_util.dumps(doc) }, maxlen=AUDIT_QUEUE_SIZE, approximate=True)
+      pipe.execute()
+      return True
+    except Exception as e:
+      self.breaker.failed("stream_add", e)
+      return False
+
+  def _enqueue(self, docs: List[dict]):
+    overflow = []
+    with self._cond:
+      for doc in docs:
+        if len(self.queue) >= AUDIT_QUEUE_SIZE:
+          if AUDIT_OVERFLOW == "sync":
+            overflow.append(doc)
+            continue
+          AUDIT_WRITES.inc("dropped")
+          if AUDIT_OVERFLOW != "drop-oldest":
+            continue
+          self.queue.popleft()
+          AUDIT_PENDING.dec()
+        self.queue.append(doc)
+        AUDIT_PENDING.inc()
+      if len(self.queue) >= AUDIT_BATCH_SIZE:
+        self._cond.notify()
+    if len(overflow) > 0:
+      self._insert(overflow)
+
+  # ============ Writer ============
+  def _insert(self, docs: List[dict]) -> bool:
+    """
+    Returns:
+      False when the documents should be retried
+    """
+    try:
+      Audit._get_collection().insert_many(docs, ordered=False) # type: ignore
+    except BulkWriteError as e:
+      # already inserted by a replayed batch
+      errors = [ i for i in e.details.get("writeErrors", []) if i.get("code") != 11000 ]
+      if len(errors) > 0:
+        Logger.log.error(f"AuditLogService::insert {len(errors)} audits failed: {errors[0].get('errmsg')}")
+        AUDIT_WRITES.inc("failed", value=len(errors))
+      AUDIT_WRITES.inc("written", value=len(docs) - len(errors))
+      return True
+    except Exception as e:
+      Logger.log.error(f"AuditLogService::insert {repr(e)}")
+      return False
+    AUDIT_WRITES.inc("written", value=len(docs))
+    return True
+
+  def _take(self) -> List[dict]:
+    with self._cond:
+      if len(self.queue) < AUDIT_BATCH_SIZE and not self._stop.is_set():
+        self._cond.wait(timeout=AUDIT_FLUSH_MS / 1000)
+      batch = []
+      while len(self.queue) > 0 and len(batch) < AUDIT_BATCH_SIZE:
+        batch.append(self.queue.popleft())
+      AUDIT_PENDING.dec(value=len(batch))
+      return batch
+
+  def _requeue(self, batch: List[dict]):
+    with self._cond:
+      room = max(0, AUDIT_QUEUE_SIZE - len(self.queue))
+      self.queue.extendleft(reversed(batch[:room]))
+      AUDIT_PENDING.inc(value=min(room, len(batch)))
+      if len(batch) > room:
+        AUDIT_WRITES.inc("dropped", value=len(batch) - room)
+
+  def _flush_queue(self) -> bool:
+    batch = self._take()
+    if len(batch) == 0:
+      return True
+    if self._insert(batch):
+      return True
+    self._requeue(batch)
+    return False
+
+  def _flush_stream(self, pending: bool) -> bool:
+    """
+    Inserts a batch of the stream, `pending` re-reads the entries of this
+    consumer that were not acknowledged
+    """
+    con = self.con_redis
+    try:
+      if pending:
+        _, claimed, _ = con.xautoclaim(STREAM_KEY, GROUP, self._consumer, _CLAIM_IDLE_MS, count=AUDIT_BATCH_SIZE) # type: ignore
+        entries = list(claimed)
+        own = con.xreadgroup(GROUP, self._consumer, { STREAM_KEY: "0" }, count=AUDIT_BATCH_SIZE) # type: ignore
+      else:
+        entries = []
+        own = con.xreadgroup(GROUP, self._consumer, { STREAM_KEY: ">" }, count=AUDIT_BATCH_SIZE, block=int(AUDIT_FLUSH_MS)) # type: ignore
+      for _, items in own or []:
+        entries.extend(items)
+    except Exception as e:
+      self.breaker.failed("flush_stream", e)
+      return False
+
+    entries = [ (i, fields) for i, fields in entries if fields ]
+    if len(entries) == 0:
+      return True
+    docs = {}
+    for _, fields in entries:
+      doc = json_util.loads(fields[b"d"])
+      docs[doc["_id"]] = doc
+    if not self._insert(list(docs.values())):
+      return False
+    ids = [ i for i, _ in entries ]
+    con.xack(STREAM_KEY, GROUP, *ids) # type: ignore
+    con.xdel(STREAM_KEY, *ids) # type: ignore
+    return True
+
+  def _create_group(self) -> bool:
+    try:
+      self.con_redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True) # type: ignore
+    except Exception as e:
+      if "BUSYGROUP" not in str(e):
+        self.breaker.failed("create_group", e)
+        return False
+    return True
+
+  def _run(self):
+    group = False
+    next_claim = 0.0
+    while not self._stop.is_set():
+      try:
+        ok = self._flush_queue()
+        if self.con_redis != None and self.breaker.ok():
+          group = group or self._create_group()
+          # after a failed insert and now and then for the entries of dead replicas
+          pending = monotonic() >= next_claim
+          if group and self._flush_stream(pending):
+            if pending:
+              next_claim = monotonic() + _CLAIM_IDLE_MS / 1000
+          else:
+            ok = False
+            next_claim = 0.0
+        if not ok:
+          self._stop.wait(_RETRY_SEC)
+      except Exception as e:
+        Logger.log.error(f"AuditLogService::run {repr(e)}")
+        self._stop.wait(_RETRY_SEC)
+
+  def close(self):
+    """
+    Stops the writer and inserts what is left of the in memory queue
+    """
+    if self._stop.is_set():
+      return
+    self._stop.set()
+    with self._cond:
+      self._cond.notify_all()
+    self._thread.join(timeout=5)
+    with self._cond:
+      docs = list(self.queue)
+      self.queue.clear()
+    AUDIT_PENDING.dec(value=len(docs))
+    for i in range(0, len(docs), AUDIT_BATCH_SIZE):
+      self._insert(docs[i:i + AUDIT_BATCH_SIZE])
@@ -0,0 +1,3 @@
+from .AuditLogService import *
+from .AuditLogExtension import *
+from .AuditLog import *
@@ -0,0 +1,34 @@
+from typing import List, Tuple
+from flask import current_app
+from .ChatContextExtension import KEY
+from .ChatContextService import ChatContextService
+from .Dataclass import ContextMessage
+
+def get_chat_context() -> ChatContextService:
+  """
+  Resolve in the request, the retrieval worker threads have no app context
+  """
+  service: ChatContextService = current_app.extensions[KEY]
+  return service
+
+def split_context(
+  messages: List[ContextMessage],
+  user_id: str | None,
+  last_limit: int,
+  history_limit: int
+) -> Tuple[List[dict], List[dict]]:
+  """
+  Args:
+    messages: oldest first
+
+  Returns:
+    `([ { text } ], [ { role, content } ])` the last `last_limit` messages of
+    `user_id` newest first (RAG context) and the last `history_limit`
+    messages oldest first (chat history)
+  """
+  last_messages = [ { "text": m.text } for m in reversed(messages) if m.sender != None and m.sender == user_id ][:last_limit]
+  history = [
+    { "role": "assistant" if m.sender is None else "user", "content": m.text }
+    for m in (messages[-history_limit:] if history_limit > 0 else [])
+  ]
+  return last_messages, history
@@ -0,0 +1,15 @@
+from .ChatContextService import ChatContextService
+from flask import Flask
+
+KEY = "cedrik-chat-context"
+
+class ChatContextExtension:
+  def __init__(self, app: Flask | None = None):
+    if not app or not isinstance(app, Flask):
+        raise TypeError("Invalid Flask app instance.")
+
+    if app:
+      self.init_app(app)
+
+  def init_app(self, app: Flask):
+    app.extensions[KEY] = ChatContextService()
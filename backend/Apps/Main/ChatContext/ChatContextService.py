@@ -0,0 +1,116 @@
+import json
+from dataclasses import asdict
+from typing import List
+from bson import ObjectId
+from redis import Redis
+
+from backend.Apps.Main.Database import Message
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import REDIS_HOST, REDIS_PORT, CHAT_CONTEXT_MESSAGES, CHAT_CONTEXT_EXPIRE_SEC
+from backend.Lib.Metrics import CACHE_REQUESTS
+from .Dataclass import ContextMessage
+
+class ChatContextService:
+  """
+  Last `CHAT_CONTEXT_MESSAGES` messages of a conversation
+
+  Cached per conversation in a redis list (oldest first) that is filled from
+  one `Message` query on a miss and appended to after each chat commit.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=1,
+      socket_connect_timeout=1
+    )
+    self.breaker = Breaker("ChatContextService", "reading the context from the database")
+
+  def _key(self, conversation_id: ObjectId | str):
+    return f"c:turns:{conversation_id}"
+
+  def load(self, conversation_id: ObjectId) -> List[ContextMessage]:
+    """
+    Returns:
+      oldest first
+    """
+    key = self._key(conversation_id)
+    if self.breaker.ok():
+      try:
+        cached = self.con_redis.lrange(key, 0, -1)
+        if len(cached) > 0: # type: ignore
+          CACHE_REQUESTS.inc("chat_context", "hit")
+          return [ ContextMessage(**json.loads(i)) for i in cached ] # type: ignore
+      except Exception as e:
+        self.breaker.failed("load", e)
+
+    CACHE_REQUESTS.inc("chat_context", "miss")
+    messages = self.query(conversation_id)
+    self._fill(key, messages)
+    return messages
+
+  def query(self, conversation_id: ObjectId) -> List[ContextMessage]:
+    docs = list(
+      Message.objects(conversation=conversation_id) # type: ignore
+        .only("sender", "text")
+        .order_by("-created_at", "-position", "-id")
+        .limit(CHAT_CONTEXT_MESSAGES)
+        .as_pymongo()
+    )
+    return [
+      ContextMessage(
+        id=str(i["_id"]),
+        sender=str(i["sender"]) if i.get("sender") != None else None,
+        text=i.get("text", "")
+      ) for i in reversed(docs)
+    ]
+
+  def _fill(self, key: str, messages: List[ContextMessage]):
+    if len(messages) == 0 or not self.breaker.ok():
+      return
+    try:
+      pipe = self.con_redis.pipeline(transaction=True)
+      pipe.delete(key)
+      pipe.rpush(key, *[ json.dumps(asdict(m)) for m in messages ])
+      pipe.expire(key, CHAT_CONTEXT_EXPIRE_SEC)
+      pipe.execute()
+    except Exception as e:
+      self.breaker.failed("fill", e)
+
+  def append(self, conversation_id: ObjectId | str, messages: List[ContextMessage], is_new: bool):
+    """
+    Call after the messages are committed.
+
+    An existing conversation is only appended to when it is cached,
+    otherwise the next `load` reads it from the database.
+    """
+    if len(messages) == 0 or not self.breaker.ok():
+      return
+    key = self._key(conversation_id)
+    values = [ json.dumps(asdict(m)) for m in messages ]
+    try:
+      pipe = self.con_redis.pipeline(transaction=True)
+      if is_new:
+        pipe.rpush(key, *values)
+      else:
+        pipe.rpushx(key, *values) # type: ignore
+      pipe.ltrim(key, -CHAT_CONTEXT_MESSAGES, -1)
+      pipe.expire(key, CHAT_CONTEXT_EXPIRE_SEC)
+      pipe.execute()
+    except Exception as e:
+      self.breaker.failed("append", e)
+
+  def invalidate(self, conversation_id: ObjectId | str):
+    """
+    Call when messages of the conversation are edited or deleted
+    """
+    try:
+      self.con_redis.delete(self._key(conversation_id))
+    except Exception as e:
+      self.breaker.failed("invalidate", e)
+
+  def close(self):
+    self.con_redis.close()
@@ -0,0 +1,7 @@
+from dataclasses import dataclass
+
+@dataclass
+class ContextMessage:
+  id: str
+  sender: str | None # None for AI Model
+  text: str
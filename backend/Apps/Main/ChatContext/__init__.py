@@ -0,0 +1,4 @@
+from .Dataclass import *
+from .ChatContextService import *
+from .ChatContextExtension import *
+from .ChatContext import *
@@ -1,4 +1,4 @@
-from mongoengine import FloatField, ListField, StringField, EnumField
+from mongoengine import FloatField, IntField, ListField, StringField, EnumField
 from mongoengine.base.fields import ObjectIdField
 
 from backend.Apps.Main.Utils.Enum import MemoryType
@@ -8,7 +8,13 @@ class Memory(BaseDocument):
     title = StringField()
     mem_type = EnumField(MemoryType, default=MemoryType.TEXT)
     text = StringField()
+    # estimated prompt tokens of `text`, see `Lib.ContextPacker`
+    token_count = IntField()
     file_id = ObjectIdField(required=False)
+    # first and last page of the file a chunk is from, empty for a file without pages
+    pages = ListField(IntField())
+    # sha256 of the `text` of a file memory chunk, a chunk kept when its file is replaced keeps its embeddings
+    content_hash = StringField()
     permission = ListField(StringField())
     tags = ListField(StringField())
     embeddings = ListField(FloatField())
\ No newline at end of file
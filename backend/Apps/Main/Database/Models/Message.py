@@ -1,4 +1,4 @@
-from mongoengine import FloatField, ListField, ReferenceField, StringField
+from mongoengine import FloatField, IntField, ListField, ReferenceField, StringField, queryset_manager
 from mongoengine.base.fields import ObjectIdField
 from backend.Apps.Main.Database.Models import User, Conversation
 from .BaseDocument import BaseDocument
@@ -8,4 +8,15 @@ class Message(BaseDocument):
     conversation = ReferenceField(Conversation)
     text = StringField()
     file_id = ObjectIdField(required=False)
-    embeddings = ListField(FloatField()) # No Embeddings for AI Model
\ No newline at end of file
+    # 0 the prompt, 1 the reply of a turn. Both are created within the same
+    # millisecond and their ids may be derived (`commit_chat`), sort on
+    # `created_at, position, id` so a turn reads back as prompt then reply
+    position = IntField(default=None)
+    # Legacy, embeddings are in `MessageEmbedding`. Only messages written before
+    # `python -m backend.Apps.Main.Database.MoveMessageEmbeddings` still have them
+    embeddings = ListField(FloatField(), default=None)
+
+    @queryset_manager
+    def objects(doc_cls, queryset):
+        # never read the legacy embeddings back
+        return queryset.exclude("embeddings")
@@ -0,0 +1,30 @@
+import struct
+from typing import List
+from mongoengine import BinaryField, Document, ObjectIdField
+
+from backend.Apps.Main.Utils.Enum import Collections
+
+class MessageEmbedding(Document):
+    """
+    Query embedding of a user message, `id` is the `Message` id
+
+    Kept out of `message` so conversation reads and deletes do not carry
+    the vectors, stored as little endian float32 bytes (4 bytes per float
+    instead of 9 for a BSON double array element).
+    """
+    id = ObjectIdField(primary_key=True)
+    conversation = ObjectIdField(required=True)
+    embeddings = BinaryField()
+
+    meta = {
+        "collection": Collections.MESSAGE_EMBEDDING.value,
+        "indexes": [ "conversation" ]
+    }
+
+    @staticmethod
+    def pack(embeddings: List[float]) -> bytes:
+        return struct.pack(f"<{len(embeddings)}f", *embeddings)
+
+    @staticmethod
+    def unpack(data: bytes) -> List[float]:
+        return list(struct.unpack(f"<{len(data) // 4}f", data))
@@ -1,6 +1,7 @@
 from .User import User
 from .Conversation import Conversation
 from .Message import Message
+from .MessageEmbedding import MessageEmbedding
 from .Memory import *
 from .Audit import Audit
 from .Otp import Otp
@@ -9,6 +10,7 @@ def init_indexes():
   User.ensure_indexes()
   Conversation.ensure_indexes()
   Message.ensure_indexes()
+  MessageEmbedding.ensure_indexes()
   Memory.ensure_indexes()
   Audit.ensure_indexes()
   Otp.ensure_indexes()
@@ -0,0 +1,54 @@
+"""
+Moves the embeddings still stored on `message` documents to `message_embedding`
+
+Messages written before the embeddings had their own collection carry a
+float array each, mongod reads it from disk and cache on every history
+read even when it is projected out. Safe to run while Main is up and to
+run again, messages are only unset after their embeddings are stored.
+
+Usage
+  python -m backend.Apps.Main.Database.MoveMessageEmbeddings
+"""
+from pymongo import ReplaceOne
+
+from backend.Apps.Main.Database import Message, MessageEmbedding, db_connection_init
+
+_BATCH = 500
+
+def move() -> int:
+    """
+    Returns:
+        messages moved
+    """
+    col_message = Message._get_collection() # type: ignore
+    col_embedding = MessageEmbedding._get_collection() # type: ignore
+
+    moved = 0
+    while True:
+        docs = list(col_message.find(
+            { "embeddings": { "$exists": True } },
+            { "conversation": 1, "embeddings": 1 }
+        ).limit(_BATCH))
+        if len(docs) == 0:
+            break
+
+        writes = [
+            ReplaceOne({ "_id": i["_id"] }, MessageEmbedding(
+                id=i["_id"],
+                conversation=i["conversation"],
+                embeddings=MessageEmbedding.pack(i["embeddings"])
+            ).to_mongo(), upsert=True)
+            for i in docs if len(i["embeddings"] or []) > 0 and i.get("conversation") != None
+        ]
+        if len(writes) > 0:
+            col_embedding.bulk_write(writes, ordered=False)
+        col_message.update_many({ "_id": { "$in": [ i["_id"] for i in docs ] } }, { "$unset": { "embeddings": "" } })
+        moved += len(writes)
+    return moved
+
+def main():
+    db_connection_init()
+    print(f"moved the embeddings of {move()} messages")
+
+if __name__ == "__main__":
+    main()
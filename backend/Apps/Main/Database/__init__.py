@@ -5,19 +5,21 @@ from pymongo.client_session import ClientSession
 from typing import Tuple
 from backend.Apps.Main.Database.Models import *
 from backend.Lib.Logger import Logger
-from backend.Lib.Config import DATABASE_URI
+from backend.Lib.Config import DATABASE_URI, DATABASE_TLS
 
 def db_connection_init():
     if not DATABASE_URI:
         raise ValueError("CyberSync_DatabaseUri is not set in the environment variables")
         
     Logger.log.info(f"Starting connection to database")
+    tls = {}
+    if DATABASE_TLS:
+        tls = { "tls": True, "tlsAllowInvalidCertificates": True }
     mongoengine.connect(
         db="CyberSync",
         host=DATABASE_URI,
-        tls=True,
-        tlsAllowInvalidCertificates=True,
-        connect=False
+        connect=False,
+        **tls
     )
     init_indexes()
     # sslAllowInvalidCertificates=True
@@ -0,0 +1,7 @@
+from flask import current_app
+from .IngestionExtension import KEY
+from .IngestionService import IngestionService
+
+def get_ingestion() -> IngestionService:
+  service: IngestionService = current_app.extensions[KEY]
+  return service
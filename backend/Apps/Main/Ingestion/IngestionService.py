@@ -0,0 +1,173 @@
+import json
+from datetime import datetime, timezone
+from typing import List, Tuple
+from uuid import uuid4
+from redis import Redis
+
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import INGEST_CLAIM_IDLE_SEC, INGEST_JOB_EXPIRE_SEC, REDIS_HOST, REDIS_PORT
+from backend.Lib.Logger import Logger
+
+STREAM_KEY = "ingest:jobs"
+GROUP = "ingest-worker"
+JOB_PREFIX = "ingest:job:"
+# a worker waits this long for a new job per read
+READ_BLOCK_MS = 5000
+
+def _now() -> str:
+  return datetime.now(timezone.utc).isoformat()
+
+class IngestionService:
+  """
+  Queue of the file memory ingestion jobs
+
+  A job is the hash `ingest:job:<id>` of the spooled file (its GridFS id),
+  the memory fields, the user and ip of the upload, the memory it `replaces`
+  and that memory's file (`replaces_file`, empty when none) and its state: `status` (queued, running, done,
+  failed), `stage` (queued, extract, embed, insert, done), `chunks`
+  embedded so far, `attempts`, the last `error` and the `memories`
+  inserted. It expires `INGEST_JOB_EXPIRE_SEC` after its last update.
+
+  Jobs are entries of the `ingest:jobs` redis stream read by the workers
+  (`backend.Worker`) through a consumer group. A worker reports progress
+  with `heartbeat`, a job without progress for `INGEST_CLAIM_IDLE_SEC`
+  (its worker died) is taken over by another worker.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=READ_BLOCK_MS / 1000 + 2,
+      socket_connect_timeout=1
+    )
+    self.breaker = Breaker("IngestionService", "ingesting files on the request")
+    self._group = False
+
+  def _key(self, job_id: str):
+    return f"{JOB_PREFIX}{job_id}"
+
+  def available(self) -> bool:
+    return self.breaker.ok()
+
+  # ============ API ============
+  def submit(
+    self, file_id: str, filename: str, title: str, tags: List[str], user: str, ip: str,
+    replaces: str = "", replaces_file: str = ""
+  ) -> str | None:
+    """
+    `user` and `ip` of the request, for the audits. `replaces` a memory
+    and `replaces_file` its file when the file replaces them.
+
+    Returns:
+      the job id, None when redis is down
+    """
+    job_id = uuid4().hex
+    key = self._key(job_id)
+    now = _now()
+    try:
+      pipe = self.con_redis.pipeline(transaction=True)
+      pipe.hset(key, mapping={
+        "id": job_id,
+        "status": "queued",
+        "stage": "queued",
+        "chunks": 0,
+        "attempts": 0,
+        "error": "",
+        "memories": 0,
+        "file_id": file_id,
+        "filename": filename,
+        "title": title,
+        "tags": json.dumps(tags),
+        "user": user,
+        "ip": ip,
+        "replaces": replaces,
+        "replaces_file": replaces_file,
+        "created_at": now,
+        "updated_at": now,
+      })
+      pipe.expire(key, INGEST_JOB_EXPIRE_SEC)
+      pipe.xadd(STREAM_KEY, { "job": job_id })
+      pipe.execute()
+    except Exception as e:
+      self.breaker.failed("submit", e)
+      return None
+    return job_id
+
+  def get(self, job_id: str) -> dict | None:
+    """
+    Throws:
+      when redis is down
+    """
+    job = self.con_redis.hgetall(self._key(job_id))
+    if not job:
+      return None
+    job["tags"] = json.loads(job.get("tags") or "[]") # type: ignore
+    for field in ("chunks", "attempts", "memories"):
+      job[field] = int(job.get(field) or 0) # type: ignore
+    return job # type: ignore
+
+  def update(self, job_id: str, **fields):
+    key = self._key(job_id)
+    try:
+      pipe = self.con_redis.pipeline(transaction=False)
+      pipe.hset(key, mapping={ **fields, "updated_at": _now() })
+      pipe.expire(key, INGEST_JOB_EXPIRE_SEC)
+      pipe.execute()
+    except Exception as e:
+      # the job still runs, only its status is behind
+      Logger.log.warning(f"IngestionService::update {repr(e)}")
+
+  # ============ Worker ============
+  def _create_group(self):
+    if self._group:
+      return
+    try:
+      self.con_redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except Exception as e:
+      if "BUSYGROUP" not in str(e):
+        raise
+    self._group = True
+
+  def take(self, consumer: str) -> Tuple[str, str] | None:
+    """
+    Waits up to `READ_BLOCK_MS` for a job, first the jobs of dead workers
+
+    Returns:
+      `(entry id, job id)`, None when there is none
+    """
+    self._create_group()
+    _, claimed, _ = self.con_redis.xautoclaim(STREAM_KEY, GROUP, consumer, INGEST_CLAIM_IDLE_SEC * 1000, count=1) # type: ignore
+    entries = [ i for i in claimed if i[1] ]
+    if len(entries) == 0:
+      res = self.con_redis.xreadgroup(GROUP, consumer, { STREAM_KEY: ">" }, count=1, block=READ_BLOCK_MS)
+      entries = [ i for _, items in res or [] for i in items ] # type: ignore
+    if len(entries) == 0:
+      return None
+    entry_id, fields = entries[0]
+    return entry_id, fields["job"]
+
+  def heartbeat(self, consumer: str, entry_id: str):
+    """
+    Keeps the job from being taken over
+    """
+    try:
+      self.con_redis.xclaim(STREAM_KEY, GROUP, consumer, 0, [ entry_id ], justid=True)
+    except Exception as e:
+      Logger.log.warning(f"IngestionService::heartbeat {repr(e)}")
+
+  def finish(self, entry_id: str, retry_job: str | None = None):
+    """
+    Removes the entry of a job, `retry_job` queues it again
+    """
+    pipe = self.con_redis.pipeline(transaction=True)
+    if retry_job != None:
+      pipe.xadd(STREAM_KEY, { "job": retry_job })
+    pipe.xack(STREAM_KEY, GROUP, entry_id)
+    pipe.xdel(STREAM_KEY, entry_id)
+    pipe.execute()
+
+  def close(self):
+    self.con_redis.close()
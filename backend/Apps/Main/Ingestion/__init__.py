@@ -0,0 +1,3 @@
+from .IngestionService import *
+from .IngestionExtension import *
+from .Ingestion import *
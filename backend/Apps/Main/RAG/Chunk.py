@@ -1,25 +1,28 @@
-import io
-from typing import List
+from typing import Iterable, Iterator, Tuple
 
-from backend.Lib.Config import CHUNK_SIZE_BYTES, CHUNK_OFFSET_BYTES
+from backend.Lib.Config import CHUNK_OVERLAP_TOKENS, CHUNK_TOKENS
+from backend.Lib.TextChunker import chunk_pages, chunk_text
 
 def chunkify(
-  buffer: io.BytesIO,
-  # TODO rename to MINIMUM_CHUNK_SIZE_BYTES
-  size: int = int(CHUNK_SIZE_BYTES),
-  offset: int = int(CHUNK_OFFSET_BYTES)
-):
-  buffer_len = buffer.getbuffer().nbytes
-  chunk_size = min(buffer_len // 10, size)
+  text: Iterable[str] | str,
+  size: int = CHUNK_TOKENS,
+  overlap: int = CHUNK_OVERLAP_TOKENS
+) -> Iterator[str]:
+  """
+  Chunks of extracted text to embed, about `size` estimated tokens each,
+  the next chunk repeats up to `overlap` tokens of sentences
 
-  chunks: List[bytes] = []
-  while True:
-    data = buffer.read(chunk_size)
-    if not data:
-      break
-    # buffer.seek(-offset, io.SEEK_CUR)
-
-    chunks.append(data)
-
-  return chunks
+  Lazy, chunks are made as they are consumed
+  """
+  return chunk_text(text, size, overlap)
 
+def chunkify_pages(
+  pages: Iterable[Tuple[int, str]],
+  size: int = CHUNK_TOKENS,
+  overlap: int = CHUNK_OVERLAP_TOKENS
+) -> Iterator[Tuple[str, int, int]]:
+  """
+  `chunkify` of the `(page, text)` of a file, with the first and last page
+  of each chunk
+  """
+  return chunk_pages(pages, size, overlap)
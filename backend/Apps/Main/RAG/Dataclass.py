@@ -1,9 +1,12 @@
 from dataclasses import dataclass
-from io import BytesIO
+from typing import BinaryIO
 
 
 @dataclass
 class FileInfo:
   filename: str
-  stream: BytesIO
-  content_type: str = ""
\ No newline at end of file
+  stream: BinaryIO
+  content_type: str = ""
+  # `Lib.FileSniff.sniff` of the file, set by `RAG.Extract`
+  kind: str = ""
+  encoding: str = ""
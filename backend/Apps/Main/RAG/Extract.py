@@ -1,26 +1,42 @@
+from typing import Iterator, Tuple
 from backend.Apps.Main.RAG.Dataclass import FileInfo
 from backend.Lib.Error import FileNotSupported
 from backend.Lib.Config import DEBUG
+from backend.Lib.FileSniff import sniff
 from time import perf_counter
 
 from backend.Lib.Logger import Logger
 from .Reader import *
 
-def extract(file_info: FileInfo):
+def _reader(file_info: FileInfo) -> BaseRAG:
+  """
+  Sniffs the file once (`FileInfo.kind`, `FileInfo.encoding`) for the readers
+  """
   start = 0
   if DEBUG:
     start = perf_counter()
 
+  file_info.kind, file_info.encoding = sniff(file_info.stream, file_info.filename, file_info.content_type)
   for reader in READERS:
     if reader.is_document(file_info):
       if DEBUG:
         end = perf_counter()
         Logger.log.warning(f"READER {end-start}s")
 
-      return reader.read(file_info)
+      return reader
 
   if DEBUG:
     end = perf_counter()
     Logger.log.warning(f"READER {end-start}s")
 
-  raise FileNotSupported()
\ No newline at end of file
+  raise FileNotSupported()
+
+def extract(file_info: FileInfo):
+  return _reader(file_info).read(file_info)
+
+def extract_pages(file_info: FileInfo) -> Iterator[Tuple[int, str]]:
+  """
+  `(page, text)` of the file, page 0 when it has no pages. The reader is
+  picked now, the pages are read as they are consumed.
+  """
+  return _reader(file_info).read_pages(file_info)
@@ -1,3 +1,5 @@
+from typing import Iterator, Tuple
+
 from backend.Apps.Main.RAG.Dataclass import FileInfo
 
 class BaseRAG:
@@ -7,4 +9,11 @@ class BaseRAG:
   
   @classmethod
   def read(cls, file_info: FileInfo) -> str:
-    raise NotImplementedError()
\ No newline at end of file
+    raise NotImplementedError()
+
+  @classmethod
+  def read_pages(cls, file_info: FileInfo) -> Iterator[Tuple[int, str]]:
+    """
+    `(page, text)` of the document in order, page 0 for a document without pages
+    """
+    yield 0, cls.read(file_info)
@@ -2,13 +2,13 @@ from docx import Document
 
 from backend.Apps.Main.RAG.Dataclass import FileInfo
 from backend.Lib.Error import FileNotSupported
+from backend.Lib.FileSniff import DOCX
 from .Base import BaseRAG
 
 class Docx(BaseRAG):
   @classmethod
   def is_document(cls, file_info: FileInfo) -> bool:
-    is_correct_content_type = file_info.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    return file_info.filename.lower().endswith(".docx") or is_correct_content_type
+    return file_info.kind == DOCX
   
   @classmethod
   def read(cls, file_info: FileInfo) -> str:
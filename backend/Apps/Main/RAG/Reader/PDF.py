@@ -1,51 +1,50 @@
 from backend.Apps.Main.RAG.Dataclass import FileInfo
+from backend.Lib.Config import PDF_PAGE_TIMEOUT_SEC
 from backend.Lib.Error import FileNotSupported
+from backend.Lib.FileSniff import PDF as KIND_PDF
+from backend.Lib.PdfPages import read_pages
 from .Base import BaseRAG
 import PyPDF2 as pdf2
-from typing import List
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, Tuple
 from backend.Lib.Logger import Logger
 
 class PDF(BaseRAG):
   @classmethod
   def is_document(cls, file_info: FileInfo):
-    return file_info.filename.lower().endswith(".pdf") or file_info.content_type == "application/pdf"
+    return file_info.kind == KIND_PDF
 
   @classmethod
   def read(cls, file_info: FileInfo):
-    buffer = file_info.stream
-    try:
-      read_pdf = pdf2.PdfReader(buffer)
+    return "\n".join([ text for _, text in cls.read_pages(file_info) ])
 
-      contents: List[str] = []
-      for page_num, page in enumerate(read_pdf.pages):
-        try:
-          # Extract text from page
-          text = page.extract_text()
-          
-          if text:
-            # ✅ FIXED: Clean and normalize the text to handle encoding issues
-            # Remove null bytes and other problematic characters
-            cleaned_text = text.replace('\x00', '').strip()
-            
-            # Ensure the text is valid UTF-8
-            # Encode and decode to catch any encoding issues early
-            cleaned_text = cleaned_text.encode('utf-8', errors='ignore').decode('utf-8')
-            
-            if cleaned_text:  # Only add non-empty pages
-              contents.append(cleaned_text)
-        except Exception as e:
-          Logger.log.warning(f"Failed to extract text from page {page_num + 1}: {str(e)}")
+  @classmethod
+  def read_pages(cls, file_info: FileInfo) -> Iterator[Tuple[int, str]]:
+    """
+    Pages are read in parallel by the `PDF_WORKERS` processes a worker
+    starts (`Lib.PdfPages`), serially elsewhere. A page that fails or takes
+    over `PDF_PAGE_TIMEOUT_SEC` is skipped
+    """
+    try:
+      found = False
+      for page_num, text, error in read_pages(file_info.stream, PDF_PAGE_TIMEOUT_SEC):
+        if error:
+          Logger.log.warning(f"Failed to extract text from page {page_num}: {error}")
           # Continue processing other pages even if one fails
           continue
+        if text:  # Only add non-empty pages
+          found = True
+          yield page_num, text
 
-      if not contents:
+      if not found:
         raise FileNotSupported("No text could be extracted from the PDF. The file may be image-based or corrupted.")
 
-      return "\n".join(contents)
-      
+    except (FileNotSupported, BrokenProcessPool):
+      # a pool process died, the file may be read next time
+      raise
     except pdf2.errors.PdfReadError as e:
       Logger.log.error(f"PDF Read Error: {str(e)}")
       raise FileNotSupported(f"Could not read PDF file: {str(e)}")
     except Exception as e:
       Logger.log.error(f"Unexpected error reading PDF: {str(e)}")
-      raise FileNotSupported(f"Error processing PDF: {str(e)}")
\ No newline at end of file
+      raise FileNotSupported(f"Error processing PDF: {str(e)}")
@@ -2,13 +2,13 @@ from pptx import Presentation
 
 from backend.Apps.Main.RAG.Dataclass import FileInfo
 from backend.Lib.Error import FileNotSupported
+from backend.Lib.FileSniff import PPTX
 from .Base import BaseRAG
 
 class PPT(BaseRAG):
   @classmethod
   def is_document(cls, file_info: FileInfo) -> bool:
-    is_correct_content_type = file_info.content_type == "application/vnd.openxmlformats-officedocument.presentationml.presentation"
-    return file_info.filename.lower().endswith(".pptx") or is_correct_content_type
+    return file_info.kind == PPTX
   
   @classmethod
   def read(cls, file_info: FileInfo) -> str:
@@ -0,0 +1,63 @@
+import mmap
+import shutil
+from contextlib import contextmanager
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterator
+from flask import Request
+
+from backend.Lib.Config import UPLOAD_SPOOL_BYTES
+
+_COPY_BUFFER = 1024 * 1024
+
+def new_spool() -> BinaryIO:
+  """
+  File kept in memory up to `UPLOAD_SPOOL_BYTES`, then in a temporary file
+  """
+  return SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode="w+b") # type: ignore
+
+def spool(src: BinaryIO) -> BinaryIO:
+  """
+  Copies `src` (e.g. a GridFS file) to a `new_spool` in blocks, at the start
+  """
+  dst = new_spool()
+  shutil.copyfileobj(src, dst, _COPY_BUFFER)
+  dst.seek(0)
+  return dst
+
+class SpooledRequest(Request):
+  """
+  Uploaded files are `new_spool` files, werkzeug's default keeps them in
+  memory up to 500KB of the whole request
+  """
+  def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+    return new_spool()
+
+@contextmanager
+def view(stream: BinaryIO) -> Iterator[memoryview]:
+  """
+  The whole content of `stream` without copying it: the buffer of a file in
+  memory or the file mapped read only. A stream that is neither is read.
+
+  The view is released on exit, do not keep it or slices of it.
+  """
+  stream.seek(0)
+  raw = getattr(stream, "_file", stream) # the file under a SpooledTemporaryFile
+  mapped = None
+  if isinstance(raw, BytesIO):
+    buffer = raw.getbuffer()
+  else:
+    try:
+      raw.flush()
+      mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+      buffer = memoryview(mapped)
+    except (AttributeError, OSError, ValueError):
+      # not a file, or empty (it cannot be mapped)
+      buffer = memoryview(stream.read())
+  try:
+    yield buffer
+  finally:
+    buffer.release()
+    if mapped != None:
+      mapped.close()
+    stream.seek(0)
@@ -0,0 +1,10 @@
+from flask import current_app
+from .ReplyStreamExtension import KEY
+from .ReplyStreamService import ReplyStreamService
+
+def get_reply_stream() -> ReplyStreamService:
+  """
+  Resolve in the request, pass it to the thread generating the reply
+  """
+  service: ReplyStreamService = current_app.extensions[KEY]
+  return service
@@ -0,0 +1,134 @@
+import json
+from time import time
+from typing import List, Tuple
+from redis import Redis
+
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import CHAT_STREAM_EXPIRE_SEC, CHAT_STREAM_ORPHAN_SEC, REDIS_HOST, REDIS_PORT
+
+# a reader waits this long for new entries per read
+READ_BLOCK_MS = 1000
+# a reply without a new entry for this long was interrupted, e.g. its process died
+_STALLED_SEC = 60
+
+class ReplyStreamService:
+  """
+  Buffer of the streamed chat replies
+
+  A reply is the redis stream `c:reply:<id>` of its content chunks
+  (`{ c }`) and events (`{ e }`, `timing`, `done`, `error`) and the hash
+  `c:reply:<id>:meta` of its owner, a stop flag and when it was last
+  written and read. Both expire `CHAT_STREAM_EXPIRE_SEC` after the last
+  write. One producer writes a reply, readers follow it from any entry id
+  (the SSE `Last-Event-ID`), so a client that lost the connection or a
+  second device gets the same reply without a new generation.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=READ_BLOCK_MS / 1000 + 2,
+      socket_connect_timeout=1
+    )
+    self.breaker = Breaker("ReplyStreamService", "streaming unbuffered")
+
+  def _key(self, reply_id: str):
+    return f"c:reply:{reply_id}"
+
+  def _meta(self, reply_id: str):
+    return f"c:reply:{reply_id}:meta"
+
+  def available(self) -> bool:
+    return self.breaker.ok()
+
+  def open(self, reply_id: str, owner: str) -> bool | None:
+    """
+    Returns:
+      True for a new reply, False when it exists (a retried request),
+      None when redis is down
+    """
+    meta = self._meta(reply_id)
+    now = time()
+    try:
+      pipe = self.con_redis.pipeline(transaction=True)
+      pipe.hsetnx(meta, "owner", owner)
+      pipe.hsetnx(meta, "written", now)
+      pipe.hset(meta, "read", now)
+      pipe.expire(meta, CHAT_STREAM_EXPIRE_SEC)
+      return bool(pipe.execute()[0])
+    except Exception as e:
+      self.breaker.failed("open", e)
+      return None
+
+  def owner(self, reply_id: str) -> str | None:
+    try:
+      return self.con_redis.hget(self._meta(reply_id), "owner") # type: ignore
+    except Exception as e:
+      self.breaker.failed("owner", e)
+      return None
+
+  def write(self, reply_id: str, entry: dict) -> bool:
+    """
+    Appends `{ c: text }` or `{ e: event json }`
+
+    Returns:
+      True when the generation should be cancelled, the reply was stopped
+      or no reader read it for `CHAT_STREAM_ORPHAN_SEC`
+    """
+    key, meta = self._key(reply_id), self._meta(reply_id)
+    now = time()
+    try:
+      pipe = self.con_redis.pipeline(transaction=False)
+      pipe.xadd(key, entry)
+      pipe.expire(key, CHAT_STREAM_EXPIRE_SEC)
+      pipe.hset(meta, "written", now)
+      pipe.expire(meta, CHAT_STREAM_EXPIRE_SEC)
+      pipe.hmget(meta, "stop", "read")
+      stop, read = pipe.execute()[-1]
+    except Exception as e:
+      # the reply is still stored when it is done, readers load the conversation
+      self.breaker.failed("write", e)
+      return False
+    return stop != None or now - float(read or now) > CHAT_STREAM_ORPHAN_SEC
+
+  def event(self, reply_id: str, event: dict) -> bool:
+    return self.write(reply_id, { "e": json.dumps(event) })
+
+  def stop(self, reply_id: str):
+    try:
+      self.con_redis.hset(self._meta(reply_id), "stop", 1)
+    except Exception as e:
+      self.breaker.failed("stop", e)
+
+  def read(self, reply_id: str, after: str) -> Tuple[List[Tuple[str, dict]], bool] | None:
+    """
+    Waits up to `READ_BLOCK_MS` for the entries after the id `after`
+    ("0" from the start) and marks the reply read
+
+    Returns:
+      `(entries, stalled)`, `stalled` when nothing was written for a while.
+      None when the reply expired or redis is down
+    """
+    key, meta = self._key(reply_id), self._meta(reply_id)
+    now = time()
+    try:
+      pipe = self.con_redis.pipeline(transaction=False)
+      pipe.hset(meta, "read", now)
+      pipe.expire(meta, CHAT_STREAM_EXPIRE_SEC)
+      pipe.hget(meta, "written")
+      _, _, written = pipe.execute()
+      if written == None:
+        return None
+      res = self.con_redis.xread({ key: after }, block=READ_BLOCK_MS)
+    except Exception as e:
+      self.breaker.failed("read", e)
+      return None
+
+    entries = [ (i, fields) for _, items in res or [] for i, fields in items ] # type: ignore
+    return entries, len(entries) == 0 and now - float(written) > _STALLED_SEC
+
+  def close(self):
+    self.con_redis.close()
@@ -0,0 +1,3 @@
+from .ReplyStreamService import *
+from .ReplyStreamExtension import *
+from .ReplyStream import *
@@ -0,0 +1,128 @@
+from threading import Thread
+from time import sleep
+from typing import Callable, Iterable, List, Tuple
+from uuid import uuid4
+from bson import ObjectId
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from backend.Lib.Config import REDIS_HOST, REDIS_PORT
+from backend.Lib.Logger import Logger
+
+STREAM_KEY = "mem:sync"
+# entries kept, a follower that is behind by more reloads its index
+_MAX_ENTRIES = 10_000
+_BLOCK_MS = 5000
+_RETRY_SEC = 5
+
+def _entry(entry_id: str) -> Tuple[int, int]:
+  ms, _, seq = entry_id.partition("-")
+  return int(ms), int(seq or 0)
+
+class MemorySyncFeed:
+  """
+  Ids of the memories written by every process (Main replicas and
+  `backend.Worker`) in the redis stream `mem:sync`, the indexes kept in
+  process (`VECTOR_SEARCH=memory|hnsw`) follow it
+
+  A follower starts at the end of the stream when the feed is created,
+  create it before the index is loaded so no write falls between. When it
+  fell behind further than the stream keeps (e.g. redis was down) the
+  index is reloaded.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=1,
+      socket_connect_timeout=1
+    )
+    # entries of this process are already applied
+    self.origin = uuid4().hex
+    self._start = self._last_id()
+
+  def _last_id(self) -> str | None:
+    """
+    Returns:
+      the last entry id, "0-0" when there is none, None when redis is down
+    """
+    try:
+      last = self.con_redis.xrevrange(STREAM_KEY, count=1)
+    except Exception as e:
+      Logger.log.warning(f"MemorySyncFeed::last_id {repr(e)}")
+      return None
+    return last[0][0] if len(last) > 0 else "0-0" # type: ignore
+
+  def _missed(self, con: Redis, after: str) -> bool:
+    """
+    Whether entries after `after` were trimmed
+    """
+    try:
+      info = con.xinfo_stream(STREAM_KEY)
+    except ResponseError as _:
+      # no stream yet
+      return False
+    if _entry(info.get("max-deleted-entry-id") or "0-0") > _entry(after): # type: ignore
+      return True
+    # `after` itself is gone, maybe some entries after it too
+    first = info.get("first-entry") # type: ignore
+    return after != "0-0" and first != None and _entry(first[0]) > _entry(after)
+
+  def publish(self, ids: Iterable[ObjectId]):
+    ids = [ str(i) for i in ids ]
+    if len(ids) == 0:
+      return
+    try:
+      self.con_redis.xadd(
+        STREAM_KEY,
+        { "origin": self.origin, "ids": ",".join(ids) },
+        maxlen=_MAX_ENTRIES,
+        approximate=True
+      )
+    except Exception as e:
+      # the other processes see the write on their next reload
+      Logger.log.error(f"MemorySyncFeed::publish {repr(e)}")
+
+  def follow(self, apply: Callable[[List[ObjectId]], None], reload: Callable[[], None]):
+    """
+    Calls `apply` with the ids written by the other processes on its own
+    thread, `reload` when some were missed. An entry is applied again
+    until `apply` succeeds.
+    """
+    Thread(target=self._follow, args=(apply, reload), name="memory-sync", daemon=True).start()
+
+  def _follow(self, apply: Callable[[List[ObjectId]], None], reload: Callable[[], None]):
+    con = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=_BLOCK_MS / 1000 + 5,
+      socket_connect_timeout=1
+    )
+    after = self._start
+    check = after == None
+    while True:
+      try:
+        if check:
+          last = self._last_id()
+          if last == None:
+            raise ConnectionError("redis is down")
+          if after == None or self._missed(con, after):
+            Logger.log.warning("MemorySyncFeed missed memory writes, reloading the index")
+            reload()
+            after = last
+          check = False
+
+        res = con.xread({ STREAM_KEY: after }, count=100, block=_BLOCK_MS)
+        for _, entries in res or []: # type: ignore
+          for entry_id, fields in entries:
+            if fields.get("origin") != self.origin:
+              apply([ ObjectId(i) for i in fields.get("ids", "").split(",") if ObjectId.is_valid(i) ])
+            after = entry_id
+      except Exception as e:
+        Logger.log.warning(f"MemorySyncFeed::follow {repr(e)}")
+        check = True
+        sleep(_RETRY_SEC)
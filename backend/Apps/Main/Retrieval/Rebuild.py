@@ -0,0 +1,20 @@
+"""
+Backfills the redis memory vector set (`VECTOR_SEARCH=redis`) from the database
+
+Run after restoring the database or losing the redis data. Memory writes
+made while it runs may be missing from the rebuilt set, run it again if
+memories were edited meanwhile.
+
+Usage
+  python -m backend.Apps.Main.Retrieval.Rebuild
+"""
+from backend.Apps.Main.Database import db_connection_init
+from backend.Apps.Main.Retrieval.Services.RedisVectorSet import RedisVectorSet
+
+def main():
+  db_connection_init()
+  count = RedisVectorSet(backfill=False).rebuild()
+  print(f"indexed {count} memories")
+
+if __name__ == "__main__":
+  main()
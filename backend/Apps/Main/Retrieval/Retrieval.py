@@ -0,0 +1,10 @@
+from flask import current_app
+from .RetrievalExtension import KEY
+from .RetrievalService import RetrievalService
+
+def get_retrieval() -> RetrievalService:
+  """
+  Resolve in the request, the retrieval worker threads have no app context
+  """
+  service: RetrievalService = current_app.extensions[KEY]
+  return service
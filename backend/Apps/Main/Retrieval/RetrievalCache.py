@@ -0,0 +1,98 @@
+import hashlib
+import json
+from math import sqrt
+from time import monotonic
+from typing import List
+from bson import ObjectId
+from redis import Redis
+
+from backend.Lib.Breaker import Breaker
+from backend.Lib.Config import REDIS_HOST, REDIS_PORT, RETRIEVAL_CACHE_EXPIRE_SEC, RETRIEVAL_CACHE_PRECISION
+from backend.Lib.Metrics import CACHE_REQUESTS, RETRIEVAL_CACHE_SAVED
+
+VERSION_KEY = "kb:version"
+
+def quantize(embeddings: List[float], precision: int) -> bytes:
+  """
+  Normalized vector rounded to `precision` decimals, questions that only
+  differ in case or punctuation usually land on the same bytes
+  """
+  norm = sqrt(sum([ x * x for x in embeddings ])) or 1
+  return json.dumps([ round(x / norm, precision) + 0.0 for x in embeddings ]).encode()
+
+class RetrievalCache:
+  """
+  Memory search results keyed by the quantized query embedding and the
+  search parameters
+
+  Entries are stored with the knowledge base version they were computed
+  at, `kb:version` is bumped on every memory write so every entry is
+  invalidated at once. The version and the entry are read in one MGET.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self, namespace: str):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=1,
+      socket_connect_timeout=1
+    )
+    self.namespace = namespace
+    self.breaker = Breaker("RetrievalCache", "searching without the cache")
+    # moving average of a search on a miss, the latency a hit saves
+    self._miss_sec = 0.0
+
+  def key(self, query_embeddings: List[float], limit: int, min_score: float) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{self.namespace}:{limit}:{min_score}:".encode())
+    h.update(quantize(query_embeddings, RETRIEVAL_CACHE_PRECISION))
+    return f"r:mem:{h.hexdigest()}"
+
+  def get(self, key: str):
+    """
+    Returns:
+      `(results, version)`, `results` is None on a miss, store the search
+      with `version` so a write during the search is not cached
+    """
+    if not self.breaker.ok():
+      return None, None
+    start = monotonic()
+    try:
+      version, cached = self.con_redis.mget(VERSION_KEY, key) # type: ignore
+    except Exception as e:
+      self.breaker.failed("get", e)
+      return None, None
+
+    version = version or "0"
+    if cached != None:
+      entry = json.loads(cached)
+      if entry["v"] == version:
+        CACHE_REQUESTS.inc("retrieval", "hit")
+        RETRIEVAL_CACHE_SAVED.inc(value=max(0.0, self._miss_sec - (monotonic() - start)))
+        return [ { **i, "_id": ObjectId(i["_id"]) } for i in entry["r"] ], version
+    CACHE_REQUESTS.inc("retrieval", "miss")
+    return None, version
+
+  def put(self, key: str, version: str | None, results: List[dict], search_sec: float):
+    self._miss_sec = 0.9 * self._miss_sec + 0.1 * search_sec if self._miss_sec > 0 else search_sec
+    if version == None or not self.breaker.ok():
+      return
+    entry = {
+      "v": version,
+      "r": [ { "_id": str(i["_id"]), "text": i.get("text", ""), "token_count": i.get("token_count"), "score": i.get("score", 0) } for i in results ]
+    }
+    try:
+      self.con_redis.set(key, json.dumps(entry), ex=RETRIEVAL_CACHE_EXPIRE_SEC)
+    except Exception as e:
+      self.breaker.failed("put", e)
+
+  def invalidate(self):
+    """
+    Call after any memory write, always tries redis
+    """
+    try:
+      self.con_redis.incr(VERSION_KEY)
+    except Exception as e:
+      self.breaker.failed("invalidate", e)
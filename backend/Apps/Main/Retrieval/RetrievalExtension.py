@@ -0,0 +1,16 @@
+from .RetrievalService import RetrievalService
+from flask import Flask
+
+KEY = "cedrik-retrieval"
+
+class RetrievalExtension:
+  def __init__(self, app: Flask | None = None, search: bool = True):
+    self.search = search
+    if not app or not isinstance(app, Flask):
+        raise TypeError("Invalid Flask app instance.")
+
+    if app:
+      self.init_app(app)
+
+  def init_app(self, app: Flask):
+    app.extensions[KEY] = RetrievalService(search=self.search)
@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Iterable, List
+from bson import ObjectId
+from backend.Apps.Main.Retrieval.Services.Atlas import AtlasVectorSearch
+from backend.Apps.Main.Retrieval.Services.Exact import ExactVectorSearch
+from backend.Apps.Main.Retrieval.Services.RedisVectorSet import RedisVectorSet
+from backend.Apps.Main.Retrieval.RetrievalCache import RetrievalCache
+from backend.Apps.Main.Retrieval.MemorySync import MemorySyncFeed
+from backend.Lib.Config import RETRIEVAL_CACHE, RETRIEVAL_WORKERS, VECTOR_INDEX_EF, VECTOR_SEARCH
+from backend.Lib.Logger import Logger
+
+class RetrievalService:
+  service = None
+  cache: RetrievalCache | None = None
+  feed: MemorySyncFeed | None = None
+  executor: ThreadPoolExecutor
+
+  def __init__(self, search: bool = True):
+    """
+    Args:
+      search: False in a process that only writes memories (`backend.Worker`),
+        `sync_memories` updates the shared index (redis), publishes to the
+        indexes kept in process and invalidates the cache, no index is loaded
+    """
+    # shared by every chat request so concurrent searches are bounded per process
+    self.executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+    if VECTOR_SEARCH in ("memory", "hnsw"):
+      # before the index loads, the writes of the other processes come through it
+      self.feed = MemorySyncFeed()
+    if VECTOR_SEARCH == "redis":
+      # shared by every process, the writes of `backend.Worker` go to it too
+      self.service = RedisVectorSet(ef=VECTOR_INDEX_EF, backfill=search)
+    elif search:
+      if VECTOR_SEARCH == "exact":
+        self.service = ExactVectorSearch()
+      elif VECTOR_SEARCH in ("memory", "hnsw"):
+        from backend.Apps.Main.Retrieval.Services.InProcess import InProcessVectorIndex
+        self.service = InProcessVectorIndex(hnsw=VECTOR_SEARCH == "hnsw", ef=VECTOR_INDEX_EF)
+      else:
+        self.service = AtlasVectorSearch()
+    if RETRIEVAL_CACHE:
+      self.cache = RetrievalCache(namespace=VECTOR_SEARCH)
+    if self.feed != None and self.service != None:
+      self.feed.follow(self._apply_synced, self.service.load)
+    Logger.log.info(f"vector search: {type(self.service).__name__ if self.service != None else 'none, publishing writes'}")
+
+  def search_memory(self, query_embeddings: List[float], limit: int, min_score: float) -> List[dict]:
+    """
+    Returns:
+      up to `limit` non deleted memories `{ _id, text, token_count, score }` with `score >= min_score`,
+      best first. `score` is on the Atlas cosine scale `(1 + cos) / 2`, `token_count` None when not stored
+    """
+    if self.cache == None:
+      return self.service.search_memory(query_embeddings, limit, min_score)
+
+    key = self.cache.key(query_embeddings, limit, min_score)
+    cached, version = self.cache.get(key)
+    if cached != None:
+      return cached
+    start = perf_counter()
+    results = self.service.search_memory(query_embeddings, limit, min_score)
+    self.cache.put(key, version, results, perf_counter() - start)
+    return results
+
+  def sync_memories(self, ids: Iterable[ObjectId]):
+    """
+    Call after memories are created, updated, deleted or restored, with the
+    ids of every affected memory (all the chunks of a file). An index kept
+    in process is synced in every process through `MemorySyncFeed`
+    """
+    ids = list(ids)
+    sync = getattr(self.service, "sync_memories", None)
+    if sync != None:
+      try:
+        sync(ids)
+      except Exception as e:
+        # the write is already committed
+        Logger.log.error(f"vector index sync failed: {e}")
+    if self.feed != None:
+      self.feed.publish(ids)
+    # after the index so the next miss sees the write
+    if self.cache != None:
+      self.cache.invalidate()
+
+  def _apply_synced(self, ids: List[ObjectId]):
+    # a search of this process may have cached results without the write
+    self.service.sync_memories(ids)
+    if self.cache != None:
+      self.cache.invalidate()
@@ -0,0 +1,34 @@
+from typing import List
+from backend.Apps.Main.Database import Memory
+from backend.Apps.Main.Utils.Enum import VectorIndex
+
+class AtlasVectorSearch:
+  def search_memory(self, query_embeddings: List[float], limit: int, min_score: float) -> List[dict]:
+    # Text only vector search
+    pipeline = [
+      {
+        "$vectorSearch": {
+          "index": VectorIndex.MEMORY.value,
+          "path": "embeddings",
+          "queryVector": query_embeddings,
+          "numCandidates": 100,
+          "limit": limit,
+          "filter": {
+            "deleted_at": None # Only include non-deleted memories
+          }
+        }
+      },
+      {
+        "$project": {
+          "text": 1,
+          "token_count": 1,
+          "score": { "$meta": "vectorSearchScore" } # include similarity score
+        }
+      },
+      {
+        "$match": {
+          "score": { "$gte": min_score }
+        }
+      }
+    ]
+    return list(Memory.objects.aggregate(*pipeline)) # type: ignore
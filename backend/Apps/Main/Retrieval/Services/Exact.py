@@ -0,0 +1,29 @@
+from math import sqrt
+from typing import List
+from backend.Apps.Main.Database import Memory
+
+class ExactVectorSearch:
+  """
+  Brute force cosine similarity over every memory
+
+  For databases without Atlas `$vectorSearch` (a local mongod, the load
+  test harness). Scans the whole collection on each query.
+  """
+  def search_memory(self, query_embeddings: List[float], limit: int, min_score: float) -> List[dict]:
+    q_norm = sqrt(sum([ x * x for x in query_embeddings ]))
+    if q_norm == 0:
+      return []
+
+    hits = []
+    for doc in Memory.objects(deleted_at=None).only("text", "token_count", "embeddings").as_pymongo(): # type: ignore
+      emb = doc.get("embeddings") or []
+      if len(emb) != len(query_embeddings):
+        continue
+      norm = sqrt(sum([ x * x for x in emb ]))
+      if norm == 0:
+        continue
+      cos = sum([ a * b for a, b in zip(query_embeddings, emb) ]) / (q_norm * norm)
+      hits.append({ "_id": doc["_id"], "text": doc.get("text", ""), "token_count": doc.get("token_count"), "score": (1 + cos) / 2 })
+
+    hits.sort(key=lambda x: x["score"], reverse=True)
+    return [ i for i in hits[:limit] if i["score"] >= min_score ]
@@ -0,0 +1,150 @@
+from threading import Event, Lock, RLock, Thread
+from typing import Dict, Iterable, List, Set
+from bson import ObjectId
+import numpy as np
+
+from backend.Apps.Main.Database import Memory
+from backend.Lib.Logger import Logger
+from backend.Lib.VectorIndex import FlatIndex, HnswIndex, hnswlib, normalize
+
+class InProcessVectorIndex:
+  """
+  Normalized float32 vectors of the non deleted memories, searched in process
+
+  Loaded from the database in the background when the service starts and
+  kept in sync by `sync_memories` on the memory writes of this process and,
+  through `MemorySyncFeed`, of the other Main replicas and the workers.
+  Scores and `min_score` use the Atlas cosine scale `(1 + cos) / 2`.
+  """
+  def __init__(self, hnsw: bool = False, ef: int = 64):
+    if hnsw and hnswlib == None:
+      Logger.log.warning("hnswlib is not installed, using the exact index")
+    self.hnsw = hnsw and hnswlib != None
+    self.ef = ef
+    self.index: FlatIndex | HnswIndex | None = None
+    self.texts: Dict[ObjectId, str] = {}
+    self.token_counts: Dict[ObjectId, int | None] = {}
+    self._lock = RLock()
+    self._load_lock = Lock()
+    self._ready = Event()
+    # ids synced while a load is reading the collection
+    self._loading = False
+    self._dirty: Set[ObjectId] = set()
+    Thread(target=self._load_once, name="memory-index-load", daemon=True).start()
+
+  def _new_index(self, dim: int, capacity: int):
+    if self.hnsw:
+      return HnswIndex(dim, capacity=max(1024, capacity), ef=self.ef)
+    return FlatIndex(dim, capacity=max(1024, capacity))
+
+  def _load_once(self):
+    try:
+      self.load()
+    except Exception as e:
+      Logger.log.error(f"memory index load failed, retrying on the next search: {e}")
+
+  def load(self):
+    """
+    (Re)builds the index from every non deleted memory
+    """
+    with self._load_lock:
+      self._load()
+
+  def _ensure_loaded(self):
+    if self._ready.is_set():
+      return
+    # waits for the startup load, bounded by the retrieval stage deadline
+    with self._load_lock:
+      if not self._ready.is_set():
+        self._load()
+
+  def _load(self):
+    with self._lock:
+      self._loading = True
+      self._dirty.clear()
+    try:
+      keys, texts, token_counts, vectors = [], {}, {}, []
+      dim = None
+      for doc in Memory.objects(deleted_at=None).only("text", "token_count", "embeddings").as_pymongo(): # type: ignore
+        emb = doc.get("embeddings") or []
+        if len(emb) == 0:
+          continue
+        if dim == None:
+          dim = len(emb)
+        if len(emb) != dim:
+          continue
+        keys.append(doc["_id"])
+        texts[doc["_id"]] = doc.get("text", "")
+        token_counts[doc["_id"]] = doc.get("token_count")
+        vectors.append(emb)
+
+      index = None
+      if dim != None:
+        index = self._new_index(dim, len(keys))
+        index.add(keys, normalize(np.asarray(vectors, dtype=np.float32)))
+
+      with self._lock:
+        self.index = index
+        self.texts = texts
+        self.token_counts = token_counts
+        dirty = list(self._dirty)
+    finally:
+      with self._lock:
+        self._loading = False
+
+    self._ready.set()
+    if len(dirty) > 0:
+      self.sync_memories(dirty)
+    Logger.log.info(f"memory index loaded {len(keys)} memories ({type(index).__name__})")
+
+  def sync_memories(self, ids: Iterable[ObjectId]):
+    """
+    Reads `ids` back from the database, adds or replaces the non deleted
+    ones and removes the deleted or missing ones
+    """
+    ids = [ ObjectId(i) for i in ids ]
+    if len(ids) == 0:
+      return
+    docs = list(Memory.objects(id__in=ids).only("text", "token_count", "embeddings", "deleted_at").as_pymongo()) # type: ignore
+
+    with self._lock:
+      if self._loading:
+        self._dirty.update(ids)
+      found = set()
+      for doc in docs:
+        emb = doc.get("embeddings") or []
+        if doc.get("deleted_at") != None or len(emb) == 0:
+          continue
+        if self.index == None:
+          self.index = self._new_index(len(emb), 0)
+        if len(emb) != self.index.dim:
+          continue
+        found.add(doc["_id"])
+        self.index.add([ doc["_id"] ], normalize(np.asarray([ emb ], dtype=np.float32)))
+        self.texts[doc["_id"]] = doc.get("text", "")
+        self.token_counts[doc["_id"]] = doc.get("token_count")
+
+      for i in ids:
+        if i in found:
+          continue
+        self.texts.pop(i, None)
+        self.token_counts.pop(i, None)
+        if self.index != None:
+          self.index.remove(i)
+
+  def search_memory(self, query_embeddings: List[float], limit: int, min_score: float) -> List[dict]:
+    self._ensure_loaded()
+
+    query = normalize(np.asarray(query_embeddings, dtype=np.float32))
+    with self._lock:
+      if self.index == None or len(query) != self.index.dim:
+        return []
+      hits = self.index.search(query, limit)
+      docs = [ (self.texts.get(key, ""), self.token_counts.get(key)) for key, _ in hits ]
+
+    results = []
+    for (key, cos), (text, token_count) in zip(hits, docs):
+      score = (1 + cos) / 2
+      if score >= min_score:
+        results.append({ "_id": key, "text": text, "token_count": token_count, "score": score })
+    return results
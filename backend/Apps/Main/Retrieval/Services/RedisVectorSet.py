@@ -0,0 +1,166 @@
+import struct
+from threading import Thread
+from typing import Iterable, List
+from bson import ObjectId
+from redis import Redis
+
+from backend.Apps.Main.Database import Memory
+from backend.Lib.Config import REDIS_HOST, REDIS_PORT
+from backend.Lib.Logger import Logger
+
+KEY = "mem:vectors"
+TEXT_KEY = "mem:text"
+TOKENS_KEY = "mem:tokens"
+# held by the replica that backfills an empty set
+_BACKFILL_LOCK = "mem:vectors:backfill"
+_BATCH = 256
+
+def _fp32(v: List[float]) -> bytes:
+  return struct.pack(f"<{len(v)}f", *v)
+
+class RedisVectorSet:
+  """
+  Memory vectors in a redis vector set shared by every Main replica
+
+  Elements are memory ids, texts are in the `mem:text` hash and their
+  token counts in `mem:tokens`. Deleted memories are removed from all of
+  them so searches only see live memories. VSIM scores are already on the
+  Atlas cosine scale `(1 + cos) / 2`.
+
+  An empty set is backfilled from the database by the first replica that
+  starts, `python -m backend.Apps.Main.Retrieval.Rebuild` rebuilds it.
+  """
+  con_redis: Redis = None # type: ignore
+
+  def __init__(self, ef: int | None = None, backfill: bool = True):
+    self.con_redis = Redis(
+      host=REDIS_HOST,
+      port=REDIS_PORT,
+      decode_responses=True,
+      socket_timeout=1,
+      socket_connect_timeout=1
+    )
+    self.ef = ef
+    if backfill:
+      Thread(target=self._backfill_if_empty, name="memory-vectors-backfill", daemon=True).start()
+
+  def _backfill_if_empty(self):
+    try:
+      if self.con_redis.exists(KEY):
+        return
+      if not self.con_redis.set(_BACKFILL_LOCK, "1", nx=True, ex=600):
+        return
+      try:
+        self.rebuild()
+      finally:
+        self.con_redis.delete(_BACKFILL_LOCK)
+    except Exception as e:
+      Logger.log.error(f"RedisVectorSet::backfill {repr(e)}")
+
+  def _add(self, pipe, key: str, text_key: str, tokens_key: str, doc: dict, cas: bool = False):
+    args = [ "VADD", key, "FP32", _fp32(doc["embeddings"]), str(doc["_id"]) ]
+    if cas:
+      args.append("CAS")
+    pipe.execute_command(*args)
+    pipe.hset(text_key, str(doc["_id"]), doc.get("text", ""))
+    if doc.get("token_count") != None:
+      pipe.hset(tokens_key, str(doc["_id"]), doc["token_count"])
+    else:
+      pipe.hdel(tokens_key, str(doc["_id"]))
+
+  def rebuild(self) -> int:
+    """
+    Rebuilds the set from every non deleted memory into temporary keys that
+    replace the live ones at the end, searches keep working meanwhile
+
+    Returns:
+      memories indexed
+    """
+    # long enough for a batch of inserts
+    con = Redis(**{ **self.con_redis.connection_pool.connection_kwargs, "socket_timeout": 60 })
+    tmp_key, tmp_text_key, tmp_tokens_key = f"{KEY}:rebuild", f"{TEXT_KEY}:rebuild", f"{TOKENS_KEY}:rebuild"
+    con.delete(tmp_key, tmp_text_key, tmp_tokens_key)
+
+    count = 0
+    dim = None
+    pipe = con.pipeline(transaction=False)
+    for doc in Memory.objects(deleted_at=None).only("text", "token_count", "embeddings").as_pymongo(): # type: ignore
+      emb = doc.get("embeddings") or []
+      if len(emb) == 0:
+        continue
+      if dim == None:
+        dim = len(emb)
+      if len(emb) != dim:
+        continue
+      self._add(pipe, tmp_key, tmp_text_key, tmp_tokens_key, doc, cas=True)
+      count += 1
+      if count % _BATCH == 0:
+        pipe.execute()
+    pipe.execute()
+
+    if count == 0:
+      con.delete(KEY, TEXT_KEY, TOKENS_KEY)
+    else:
+      swap = con.pipeline(transaction=True)
+      swap.rename(tmp_key, KEY)
+      swap.rename(tmp_text_key, TEXT_KEY)
+      # none of the memories may have a token count
+      if con.exists(tmp_tokens_key):
+        swap.rename(tmp_tokens_key, TOKENS_KEY)
+      else:
+        swap.delete(TOKENS_KEY)
+      swap.execute()
+    Logger.log.info(f"memory vector set rebuilt with {count} memories")
+    return count
+
+  def sync_memories(self, ids: Iterable[ObjectId]):
+    """
+    Reads `ids` back from the database, adds or replaces the non deleted
+    ones and removes the deleted or missing ones
+    """
+    ids = [ ObjectId(i) for i in ids ]
+    if len(ids) == 0:
+      return
+    docs = Memory.objects(id__in=ids).only("text", "token_count", "embeddings", "deleted_at").as_pymongo() # type: ignore
+
+    pipe = self.con_redis.pipeline(transaction=False)
+    found = set()
+    for doc in docs:
+      if doc.get("deleted_at") != None or len(doc.get("embeddings") or []) == 0:
+        continue
+      found.add(doc["_id"])
+      self._add(pipe, KEY, TEXT_KEY, TOKENS_KEY, doc)
+    for i in ids:
+      if i in found:
+        continue
+      pipe.execute_command("VREM", KEY, str(i))
+      pipe.hdel(TEXT_KEY, str(i))
+      pipe.hdel(TOKENS_KEY, str(i))
+    pipe.execute()
+
+  def search_memory(self, query_embeddings: List[float], limit: int, min_score: float) -> List[dict]:
+    hits = self.con_redis.vset().vsim(KEY, _fp32(query_embeddings), with_scores=True, count=limit, ef=self.ef) # type: ignore
+    if not hits:
+      return []
+    ids = [ i for i, score in hits.items() if score >= min_score ] # type: ignore
+    if len(ids) == 0:
+      return []
+    pipe = self.con_redis.pipeline(transaction=False)
+    pipe.hmget(TEXT_KEY, ids)
+    pipe.hmget(TOKENS_KEY, ids)
+    texts, token_counts = pipe.execute()
+
+    results = []
+    for i, text, token_count in zip(ids, texts, token_counts): # type: ignore
+      # removed between the two reads
+      if text == None:
+        continue
+      results.append({
+        "_id": ObjectId(i),
+        "text": text,
+        # None for a memory indexed before token counts were stored
+        "token_count": int(token_count) if token_count != None else None,
+        "score": hits[i] # type: ignore
+      })
+    results.sort(key=lambda x: x["score"], reverse=True)
+    return results
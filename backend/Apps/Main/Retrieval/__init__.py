@@ -0,0 +1,3 @@
+from .RetrievalService import *
+from .RetrievalExtension import *
+from .Retrieval import *
@@ -1,31 +1,49 @@
+from bson import ObjectId
 from dataclasses import dataclass
 from mongoengine import ValidationError
-from flask import request, jsonify, Response, stream_with_context
+from flask import copy_current_request_context, request, jsonify
 from flask.blueprints import Blueprint
 from flask_jwt_extended import jwt_required
-from werkzeug.exceptions import InternalServerError, NotAcceptable
+from werkzeug.exceptions import InternalServerError, NotAcceptable, NotFound
 from werkzeug.datastructures import FileStorage
 
 import random
+import re
 import json
+from threading import Thread
+from time import perf_counter
 from backend.Apps.Main.Database.Models import Audit
 from backend.Apps.Main.Database.Models import Message, Conversation
 from backend.Apps.Main.Utils.UserToken import get_object_id
 from backend.Apps.Main.Filter.Filter import FILTER_ERR_MSG, m_filter
+from backend.Apps.Main.Admission import Slot, get_admission
+from backend.Apps.Main.AuditLog import get_audit_log
+from backend.Apps.Main.ReplyStream import ReplyStreamService, get_reply_stream
 from backend.Apps.Main.Utils.Audit import audit_message
-from backend.Apps.Main.Utils.Enum import AuditType
+from backend.Apps.Main.Utils.Enum import AuditType, Role
+from backend.Apps.Main.Utils.Decorator import protect
 from backend.Lib.Error import BadBody, HttpInvalidId, HttpValidationError, InvalidId, TooManyFiles
 from backend.Apps.Main.Database import Transaction
 from backend.Lib.Sanitizer import contains_html
+from backend.Lib.Cancellation import Cancellation
+from backend.Lib.Config import CHAT_COMMIT, CHAT_STREAM_BUFFER, SSE_COALESCE_CHARS, SSE_COALESCE_MS, SSE_MAX_PENDING
+from backend.Lib.ContextPacker import estimate_tokens
 from backend.Lib.Logger import Logger
+from backend.Lib.Metrics import CHAT_REPLIES, CHAT_REPLY_TOKENS, CHAT_STREAM_READERS, GENERATION_TOKENS_SAVED
+from backend.Lib.StreamCoalescer import coalesce, content_frame, event_stream
+from backend.Lib.Timing import CHAT_LATENCY, StageTimer
 # ✅ FIXED: Import both generate_reply and generate_reply_stream
-from backend.Apps.Main.Service.Chat.CreateChat import generate_reply, generate_reply_stream
+from backend.Apps.Main.Service.Chat.CreateChat import generate_reply, generate_reply_stream, remember_chat, reply_message_id, stored_reply
+from backend.Apps.Main.ChatContext import get_chat_context
 from backend.Apps.Main.Utils import get_token, Collections
-from backend.Apps.Main.Service import create_chat
+from backend.Apps.Main.Service import commit_chat, create_chat
 from backend.Lib.Common import Prompt
 
 ai = Blueprint("Ai", __name__)
 
+# redis stream entry id
+_ENTRY_ID = re.compile(r"0|\d+-\d+")
+
 
 @dataclass
 class ChatBody:
@@ -36,12 +54,92 @@ class ChatBody:
     def __post_init__(self):
         self.prompt = Prompt(**self.prompt) # type: ignore
 
+def get_idempotency_key() -> str | None:
+    """
+    `Idempotency-Key` header of the request, a retry of the same turn
+    with the same key gets the stored reply and does not store the turn
+    twice. None without one, the turn is not looked up
+    """
+    key = request.headers.get("Idempotency-Key", "").strip()
+    if len(key) > 128:
+        raise BadBody()
+    return key if len(key) > 0 else None
+
+def find_stored_reply(user_token, idempotency_key: str | None, body: ChatBody) -> Message | None:
+    """
+    The reply stored by an earlier request with the same key, only looked
+    up when the client sent one and turns are committed with derived ids
+    """
+    if idempotency_key == None or CHAT_COMMIT == "transaction":
+        return None
+    return stored_reply(user_token, idempotency_key, body.conversation, body.prompt)
+
+def count_reply(reply: str, cancelled: bool):
+    """
+    Counts a streamed reply, the tokens saved by a cancelled one are
+    estimated from the mean length of the complete replies
+    """
+    tokens = estimate_tokens(reply)
+    CHAT_REPLIES.inc("cancelled" if cancelled else "complete")
+    CHAT_REPLY_TOKENS.inc("cancelled" if cancelled else "complete", value=tokens)
+    if not cancelled:
+        return
+    complete = CHAT_REPLIES.values().get(("complete",), 0)
+    if complete > 0:
+        mean = CHAT_REPLY_TOKENS.values().get(("complete",), 0) / complete
+        GENERATION_TOKENS_SAVED.inc(value=max(0, round(mean) - tokens))
+
+def get_last_event_id() -> str:
+    """
+    Entry id of the last event the client got, "0" for the start of a reply
+    """
+    value = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
+    if _ENTRY_ID.fullmatch(value) == None:
+        raise BadBody()
+    return value
+
+def follow(streams: ReplyStreamService, reply_id: str, after: str):
+    """
+    SSE frames of a buffered reply after the entry `after`, each with its
+    entry id. Ends with the reply or when it expired or was interrupted
+    """
+    # no id, the client keeps its Last-Event-ID
+    yield f"data: {json.dumps({'type': 'stream', 'id': reply_id})}\n\n"
+    while True:
+        res = streams.read(reply_id, after)
+        if res == None:
+            yield f"data: {json.dumps({'type': 'error', 'content': 'The reply is no longer available'})}\n\n"
+            return
+        entries, stalled = res
+        if stalled:
+            yield f"data: {json.dumps({'type': 'error', 'content': 'The reply was interrupted'})}\n\n"
+            return
+
+        for entry_id, fields in entries:
+            after = entry_id
+            if "c" in fields:
+                yield f"id: {entry_id}\n" + content_frame(fields["c"])
+                continue
+            yield f"id: {entry_id}\ndata: {fields['e']}\n\n"
+            if json.loads(fields["e"]).get("type") in ("done", "error"):
+                return
+
+def stored_frames(reply: Message):
+    """
+    SSE frames of a reply `commit_chat` already stored
+    """
+    yield content_frame(reply.text) # type: ignore
+    yield f"data: {json.dumps({'type': 'done', 'conversation': str(reply.conversation.id), 'ai_message_id': str(reply.id)})}\n\n"
+
 @ai.route("/chat-stream", methods=["POST"])
 @jwt_required(optional=False)
 def chat_stream():
     '''
     Streaming version of chat endpoint.
+
+    The last event before `done` is `timing` with the stage timings in ms
     '''
+    timer = StageTimer()
     body = None
 
     if not request.content_type or not request.content_type.startswith("multipart/form-data"):
@@ -52,21 +150,22 @@ def chat_stream():
     agent = request.form.get("agent", "professor")
 
     try:
-        json_data = {}
-        conversation = request.form.get("conversation", "")
-        json_data["conversation"] = conversation if conversation and len(conversation.strip()) > 0 else None
+        with timer.stage("parse"):
+            json_data = {}
+            conversation = request.form.get("conversation", "")
+            json_data["conversation"] = conversation if conversation and len(conversation.strip()) > 0 else None
         
-        json_data["prompt"] = {
-            "role": "user",
-            "content": request.form.get("content", "")
-        }
-        json_data["file"] = request.files.get("file")
-        json_data["overrides"] = json.loads(request.form.get("overrides", "{}"))
-
-        body = ChatBody(**json_data)
-        if body.overrides == None:
-            body.overrides = {}
-        body.overrides["agent"] = agent
+            json_data["prompt"] = {
+                "role": "user",
+                "content": request.form.get("content", "")
+            }
+            json_data["file"] = request.files.get("file")
+            json_data["overrides"] = json.loads(request.form.get("overrides", "{}"))
+
+            body = ChatBody(**json_data)
+            if body.overrides == None:
+                body.overrides = {}
+            body.overrides["agent"] = agent
     except Exception as e:
         Logger.log.error(f"Error parsing chat body: {repr(e)}")
         raise BadBody()
@@ -74,90 +173,217 @@ def chat_stream():
     user_token = get_token()
     if (user_token == None): 
         raise HttpInvalidId()
+    idempotency_key = get_idempotency_key()
+    last_event_id = get_last_event_id()
+    streams = get_reply_stream()
+    reply_id = str(reply_message_id(user_token, idempotency_key, body.conversation, body.prompt) if idempotency_key != None else ObjectId())
+
+    # a retried request (same Idempotency-Key) follows its buffered reply or gets the stored one and does not generate
+    slot = Slot()
+    following = idempotency_key != None and CHAT_STREAM_BUFFER and streams.available() and streams.owner(reply_id) == str(user_token.id)
+    if not following:
+        stored = find_stored_reply(user_token, idempotency_key, body)
+        if stored != None:
+            return event_stream(stored_frames(stored))
+        with timer.stage("admission"):
+            slot = get_admission().admit(str(user_token.id))
+
+    def save(full_reply: str, embeddings: list):
+        """
+        Stores the turn, the reply can be the part streamed before the
+        client disconnected
+
+        Returns:
+            `(conv_id, ai_message_id)`
+        """
+        commit_start = perf_counter()
+        default_title = body.prompt.content
+        if len(default_title) > 20:
+            default_title = default_title[:20]
+
+        # Create Reply object for database storage
+        from backend.Apps.Main.Utils.LLM import Reply
+        model_reply = Reply(
+            reply=full_reply,
+            embeddings=embeddings,
+            prompt=body.prompt
+        )
+
+        inserted = 2
+        if CHAT_COMMIT == "transaction":
+            with Transaction() as (session, db):
+                col_conversation = db.get_collection(Collections.CONVERSATION.value)
+                col_message = db.get_collection(Collections.MESSAGE.value)
+                col_audit = db.get_collection(Collections.AUDIT.value)
+
+                # ✅ Get all three IDs from create_chat
+                result = create_chat(
+                    session,
+                    col_audit,
+                    col_conversation,
+                    col_message,
+                    model_reply,
+                    default_title,
+                    body.conversation,
+                    body.prompt,
+                    user_token
+                )
+        else:
+            *result, inserted = commit_chat(model_reply, default_title, body.conversation, body.prompt, user_token, idempotency_key)
+
+        # ✅ Unpack the tuple
+        conv_id, user_message_id, ai_message_id = result
+
+        if conv_id != None:
+            conv_id = str(conv_id)
+        if ai_message_id != None:
+            ai_message_id = str(ai_message_id)
+        timer.add("commit", (perf_counter() - commit_start) * 1000)
+        # a retry already remembered the turn it stored
+        if inserted == 2:
+            remember_chat(conv_id, conv_id != body.conversation, user_token, user_message_id, ai_message_id, body.prompt, full_reply, embeddings) # type: ignore
+        return conv_id, ai_message_id
+
+    def produce(slot: Slot):
+        """
+        Generates the reply into the buffer, runs on its own thread so a
+        reader that disconnects does not stop it. Cancelled when the reply
+        is stopped or nobody read it for `CHAT_STREAM_ORPHAN_SEC`. Releases
+        `slot` when it ends
+        """
+        full_reply = ""
+        embeddings = []
+        cancel = Cancellation()
+
+        try:
+            chunks = coalesce(
+                generate_reply_stream(
+                    conversation_id=body.conversation,
+                    user=user_token,
+                    prompt=body.prompt,
+                    overrides=body.overrides,
+                    timer=timer,
+                    cancel=cancel
+                ),
+                max_chars=SSE_COALESCE_CHARS,
+                max_delay_ms=SSE_COALESCE_MS,
+                max_pending=SSE_MAX_PENDING,
+                wrap=copy_current_request_context
+            )
+            for item in chunks:
+                if isinstance(item, dict):
+                    embeddings = item.get("embeddings", embeddings)
+                    full_reply = item.get("full_reply", full_reply)
+                    continue
+                full_reply += item
+                if streams.write(reply_id, { "c": item }):
+                    Logger.log.warning(f"reply {reply_id} stopped or not read - stopping generation")
+                    cancel.cancel()
+                    chunks.close()
+                    break
+
+            count_reply(full_reply, cancelled=cancel.is_cancelled)
+            if cancel.is_cancelled and len(full_reply) == 0:
+                streams.event(reply_id, { "type": "error", "content": "Stopped" })
+                return
+            conv_id, ai_message_id = save(full_reply, embeddings)
+
+            timings = timer.as_dict()
+            CHAT_LATENCY.observe(timings)
+            Logger.log.info(f"chat-stream timings {timer}")
+            streams.event(reply_id, { "type": "timing", "timings": timings })
+            streams.event(reply_id, { "type": "done", "conversation": conv_id, "ai_message_id": ai_message_id })
+
+        except Exception as e:
+            Logger.log.error(f"Streaming error: {repr(e)}")
+            import traceback
+            Logger.log.error(traceback.format_exc())
+            streams.event(reply_id, { "type": "error", "content": str(e) })
+        finally:
+            slot.release()
 
     def generate():
-        conv_id = body.conversation
         full_reply = ""
         embeddings = []
-        ai_message_id = None  # ✅ Track the AI message ID
+        cancel = Cancellation()
         
         try:
-            audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\"").save()
-            if contains_html(body.prompt.content):
+            with timer.stage("audit"):
+                get_audit_log().write(audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\""))
+            with timer.stage("sanitize"):
+                is_html = contains_html(body.prompt.content)
+            if is_html:
                 yield f"data: {json.dumps({'type': 'error', 'content': "BadBody"})}\n\n"
                 return
 
             # Filter check
-            filter_result = m_filter(body.prompt.content)
+            with timer.stage("filter"):
+                filter_result = m_filter(body.prompt.content)
             Logger.log.warning(f"FilterResult {filter_result}")
             
             if filter_result.is_filtered:
-                audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\" is filtered", AuditType.FILTERED).save()
+                get_audit_log().write(audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\" is filtered", AuditType.FILTERED))
                 error_msg = FILTER_ERR_MSG[random.randint(0, len(FILTER_ERR_MSG)-1)]
                 yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
                 return
 
             Logger.log.warning(f"Finding Related Context...")
-            
-            # Stream the reply
-            for item in generate_reply_stream(
-                conversation_id=body.conversation,
-                user=user_token,
-                prompt=body.prompt,
-                overrides=body.overrides
-            ):
+
+            # Buffered reply, a retried request (same Idempotency-Key) follows the first one
+            opened = streams.open(reply_id, str(user_token.id)) if CHAT_STREAM_BUFFER and streams.available() else None
+            if opened != None:
+                if opened:
+                    # the thread generating the buffered reply releases the slot
+                    Thread(target=copy_current_request_context(produce), args=(slot.hand_off(),), name="chat-reply", daemon=True).start()
+                CHAT_STREAM_READERS.inc("new" if opened else "retry")
+                yield from follow(streams, reply_id, last_event_id)
+                return
+
+            # Stream the reply, deltas are joined into fewer content frames
+            chunks = coalesce(
+                generate_reply_stream(
+                    conversation_id=body.conversation,
+                    user=user_token,
+                    prompt=body.prompt,
+                    overrides=body.overrides,
+                    timer=timer,
+                    cancel=cancel
+                ),
+                max_chars=SSE_COALESCE_CHARS,
+                max_delay_ms=SSE_COALESCE_MS,
+                max_pending=SSE_MAX_PENDING,
+                wrap=copy_current_request_context
+            )
+            for item in chunks:
                 try:
                     if isinstance(item, dict):
-                        # This is the final metadata chunk
-                        embeddings = item.get("embeddings", [])
+                        # the query embeddings, then the final metadata chunk
+                        embeddings = item.get("embeddings", embeddings)
                         full_reply = item.get("full_reply", full_reply)
                     else:
                         # This is a text chunk
                         full_reply += item
-                        yield f"data: {json.dumps({'type': 'content', 'content': item})}\n\n"
+                        yield content_frame(item)
                 except GeneratorExit:
+                    # the write of a frame failed, abort the model request and keep what was sent
                     Logger.log.warning("Client disconnected - stopping generation")
+                    cancel.cancel()
+                    chunks.close()
+                    count_reply(full_reply, cancelled=True)
+                    if len(full_reply) > 0:
+                        conv_id, ai_message_id = save(full_reply, embeddings)
+                        Logger.log.info(f"stored the partial reply {ai_message_id} of {conv_id} ({len(full_reply)} chars)")
                     return
             
             # Save to database after streaming is complete
-            with Transaction() as (session, db):
-                col_conversation = db.get_collection(Collections.CONVERSATION.value)
-                col_message = db.get_collection(Collections.MESSAGE.value)
-                col_audit = db.get_collection(Collections.AUDIT.value)
+            count_reply(full_reply, cancelled=False)
+            conv_id, ai_message_id = save(full_reply, embeddings)
 
-                default_title = body.prompt.content
-                if len(default_title) > 20:
-                    default_title = default_title[:20]
-
-                # Create Reply object for database storage
-                from backend.Apps.Main.Utils.LLM import Reply
-                model_reply = Reply(
-                    reply=full_reply,
-                    embeddings=embeddings,
-                    prompt=body.prompt
-                )
+            timings = timer.as_dict()
+            CHAT_LATENCY.observe(timings)
+            Logger.log.info(f"chat-stream timings {timer}")
+            yield f"data: {json.dumps({'type': 'timing', 'timings': timings})}\n\n"
 
-                # ✅ Get all three IDs from create_chat
-                result = create_chat(
-                    session,
-                    col_audit,
-                    col_conversation,
-                    col_message,
-                    model_reply,
-                    default_title,
-                    body.conversation,
-                    body.prompt,
-                    user_token
-                )
-                
-                # ✅ Unpack the tuple
-                conv_id, user_message_id, ai_message_id = result
-
-                if conv_id != None:
-                    conv_id = str(conv_id)
-                if ai_message_id != None:
-                    ai_message_id = str(ai_message_id)
-            
             # ✅ Send completion with both conversation ID and AI message ID
             yield f"data: {json.dumps({'type': 'done', 'conversation': conv_id, 'ai_message_id': ai_message_id})}\n\n"
             
@@ -166,16 +392,45 @@ def chat_stream():
             import traceback
             Logger.log.error(traceback.format_exc())
             yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+        finally:
+            slot.release()
     
-    return Response(
-        stream_with_context(generate()),
-        mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no',
-            'Connection': 'keep-alive'
-        }
-    )
+    # a response closed before its first frame never runs the finally of generate
+    return event_stream(generate(), on_close=slot.release)
+
+@ai.route("/chat-stream/<reply_id>", methods=["GET"])
+@jwt_required(optional=False)
+def chat_stream_resume(reply_id: str):
+    '''
+    Follows a buffered reply of `/chat-stream` after the `Last-Event-ID`
+    header (or `last_event_id` query), from its start without one
+    '''
+    user_token = get_token()
+    if (user_token == None):
+        raise HttpInvalidId()
+    last_event_id = get_last_event_id()
+
+    streams = get_reply_stream()
+    if streams.owner(reply_id) != str(user_token.id):
+        raise NotFound()
+    CHAT_STREAM_READERS.inc("resume")
+    return event_stream(follow(streams, reply_id, last_event_id))
+
+@ai.route("/chat-stream/<reply_id>/stop", methods=["POST"])
+@jwt_required(optional=False)
+def chat_stream_stop(reply_id: str):
+    '''
+    Stops the generation of a buffered reply, the part generated is stored
+    '''
+    user_token = get_token()
+    if (user_token == None):
+        raise HttpInvalidId()
+
+    streams = get_reply_stream()
+    if streams.owner(reply_id) != str(user_token.id):
+        raise NotFound()
+    streams.stop(reply_id)
+    return jsonify({ "stopped": True }), 200
 
 @ai.route("/truncate-message", methods=["POST"])
 @jwt_required(optional=False)
@@ -211,7 +466,7 @@ def truncate_message():
             return jsonify({"error": "Invalid message ID"}), 400
         
         # Find the message
-        message = Message.objects(id=msg_obj_id).first()
+        message = Message.objects(id=msg_obj_id).only("conversation", "text").first()
         
         if not message:
             Logger.log.error(f"Message not found: {msg_obj_id}")
@@ -239,14 +494,15 @@ def truncate_message():
         Logger.log.info(f"✂️ Truncating from {len(message.text)} to {len(truncated_content)} chars")
         message.text = truncated_content
         message.save()
+        get_chat_context().invalidate(str(conversation.id))
         
         Logger.log.info(f"✅ Truncated message {message_id} successfully")
         
         # Audit log
-        audit_message(
+        get_audit_log().write(audit_message(
             f"user: {user_token.username}\ntruncated message: {message_id} to {len(truncated_content)} chars",
             AuditType.UPDATE
-        ).save()
+        ))
         
         return jsonify({
             "success": True,
@@ -271,7 +527,11 @@ def chat():
     - conversation  str
     - content       str
     - file          File
+
+    **Headers**
+    - Server-Timing stage timings in ms
     """
+    timer = StageTimer()
     body = None
 
     if not request.content_type or not request.content_type.startswith("multipart/form-data"):
@@ -281,23 +541,24 @@ def chat():
     agent = request.form.get("agent", "professor")
 
     try:
-        json_dict = {}
-        # FIX: Handle empty conversation as None
-        conversation = request.form.get("conversation", "")
-        json_dict["conversation"] = conversation if conversation and len(conversation.strip()) > 0 else None
+        with timer.stage("parse"):
+            json_dict = {}
+            # FIX: Handle empty conversation as None
+            conversation = request.form.get("conversation", "")
+            json_dict["conversation"] = conversation if conversation and len(conversation.strip()) > 0 else None
         
-        json_dict["prompt"] = {
-            "role": "user",
-            "content": request.form.get("content", "")
-        }
-        # TODO handle file
-        json_dict["file"] = request.files.get("file")
-        json_dict["overrides"] = json.loads(request.form.get("overrides", "{}"))
-
-        body = ChatBody(**json_dict)
-        if body.overrides == None:
-            body.overrides = {}
-        body.overrides["agent"] = agent
+            json_dict["prompt"] = {
+                "role": "user",
+                "content": request.form.get("content", "")
+            }
+            # TODO handle file
+            json_dict["file"] = request.files.get("file")
+            json_dict["overrides"] = json.loads(request.form.get("overrides", "{}"))
+
+            body = ChatBody(**json_dict)
+            if body.overrides == None:
+                body.overrides = {}
+            body.overrides["agent"] = agent
     except Exception as e:
         Logger.log.error(f"Error parsing chat body: {repr(e)}")
         raise BadBody()
@@ -305,14 +566,26 @@ def chat():
     user_token = get_token()
     if (user_token == None): 
         raise HttpInvalidId()
+    idempotency_key = get_idempotency_key()
+    # a retried request gets the reply stored by the first one
+    stored = find_stored_reply(user_token, idempotency_key, body)
+    if stored != None:
+        return jsonify({
+            "conversation": str(stored.conversation.id),
+            "reply": stored.text
+        }), 200
+    with timer.stage("admission"):
+        slot = get_admission().admit(str(user_token.id))
     
     try:
-        audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\"").save()
-        filter_result = m_filter(body.prompt.content)
+        with timer.stage("audit"):
+            get_audit_log().write(audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\""))
+        with timer.stage("filter"):
+            filter_result = m_filter(body.prompt.content)
         Logger.log.warning(f"FilterResult {filter_result}")
         
         if filter_result.is_filtered:
-            audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\" is filtered", AuditType.FILTERED).save()
+            get_audit_log().write(audit_message(f"user: {user_token.username}\nquery: \"{body.prompt.content}\" is filtered", AuditType.FILTERED))
             return jsonify({
                 "conversation": "",
                 "reply": FILTER_ERR_MSG[random.randint(0,len(FILTER_ERR_MSG)-1)]
@@ -322,42 +595,64 @@ def chat():
         # !!! Do not run inside transaction
         Logger.log.warning(f"Finding Related Context...")
 
-        model_reply = generate_reply(
-            conversation_id=body.conversation,
-            user=user_token,
-            prompt=body.prompt,
-            overrides=body.overrides
-        )
+        try:
+            model_reply = generate_reply(
+                conversation_id=body.conversation,
+                user=user_token,
+                prompt=body.prompt,
+                overrides=body.overrides,
+                timer=timer
+            )
+        finally:
+            slot.release()
         Logger.log.info(f"Reply {model_reply.reply} {model_reply.embeddings[:5]}")
 
-        with Transaction() as (session, db):
-            col_conversation = db.get_collection(Collections.CONVERSATION.value)
-            col_message = db.get_collection(Collections.MESSAGE.value)
-            col_audit = db.get_collection(Collections.AUDIT.value)
+        commit_start = perf_counter()
+        default_title = body.prompt.content
+        if len(default_title) > 20:
+            default_title = default_title[:20]
 
-            default_title = body.prompt.content
-            if len(default_title) > 20:
-                default_title = default_title[:20]
+        inserted = 2
+        if CHAT_COMMIT == "transaction":
+            with Transaction() as (session, db):
+                col_conversation = db.get_collection(Collections.CONVERSATION.value)
+                col_message = db.get_collection(Collections.MESSAGE.value)
+                col_audit = db.get_collection(Collections.AUDIT.value)
 
-            conv_id = create_chat(
-                session,
-                col_audit,
-                col_conversation,
-                col_message,
+                conv_id, user_message_id, ai_message_id = create_chat(
+                    session,
+                    col_audit,
+                    col_conversation,
+                    col_message,
+                    model_reply,
+                    default_title,
+                    body.conversation,
+                    body.prompt,
+                    user_token
+                )
+        else:
+            conv_id, user_message_id, ai_message_id, inserted = commit_chat(
                 model_reply,
                 default_title,
                 body.conversation,
                 body.prompt,
-                user_token
+                user_token,
+                idempotency_key
             )
 
-            if conv_id != None:
-                conv_id = str(conv_id)
-            
-            return jsonify({
-                "conversation": conv_id,
-                "reply": model_reply.reply
-            }), 200
+        if conv_id != None:
+            conv_id = str(conv_id)
+        timer.add("commit", (perf_counter() - commit_start) * 1000)
+        # a retry already remembered the turn it stored
+        if inserted == 2:
+            remember_chat(conv_id, conv_id != body.conversation, user_token, user_message_id, ai_message_id, body.prompt, model_reply.reply, model_reply.embeddings) # type: ignore
+
+        CHAT_LATENCY.observe(timer.as_dict())
+        Logger.log.info(f"chat timings {timer}")
+        return jsonify({
+            "conversation": conv_id,
+            "reply": model_reply.reply
+        }), 200, { "Server-Timing": timer.header() }
 
     except InvalidId as e:
         raise HttpInvalidId()
@@ -366,3 +661,14 @@ def chat():
     except Exception as e:
         Logger.log.error(f"{repr(e)} {str(body)}")
         raise InternalServerError()
+    finally:
+        slot.release()
+
+@ai.route("/latency")
+@jwt_required(optional=False)
+@protect(role=Role.ADMIN)
+def latency():
+    """
+    p50, p95 and p99 in ms of each chat stage over the last requests
+    """
+    return jsonify(CHAT_LATENCY.snapshot()), 200
@@ -7,6 +7,7 @@ from mongoengine import ValidationError
 from pymongo.errors import DuplicateKeyError
 from werkzeug.exceptions import HTTPException, InternalServerError, Unauthorized
 
+from backend.Apps.Main.AuditLog import get_audit_log
 from backend.Apps.Main.Utils.Audit import audit_collection, audit_message
 from backend.Lib.Error import BadBody, UserAlreadyExist, UserDoesNotExist, HttpValidationError
 from backend.Apps.Main.Hasher import verify_password, hash as hash_password
@@ -73,7 +74,7 @@ def reset_password():
             msg=f"User {user.email} changed password via reset",
             type=AuditType.OTP
         )
-        audit.save()
+        get_audit_log().write(audit)
         
         return jsonify({"message": "Password reset successful"}), 200
         
@@ -107,10 +108,10 @@ def check_email():
         # otp.validate()
         # otp.save()
 
-        audit_message(
+        get_audit_log().write(audit_message(
             msg = f"Email {user} Generated OTP",
             type = AuditType.OTP
-        ).save()
+        ))
         return jsonify(generatedOTP), 200
     
     except HTTPException as e:
@@ -136,10 +137,10 @@ def signup_otp():
 
         generatedOTP = str(random.randint(100000, 999999))
 
-        audit_message(
+        get_audit_log().write(audit_message(
             msg = f"Email {user} Generated Signup OTP",
             type = AuditType.OTP
-        ).save()
+        ))
         return jsonify(generatedOTP), 200
     
     except HTTPException as e:
@@ -162,16 +163,16 @@ def login():
     try:
         userQS = User.objects(email=req_login.email) # type: ignore
         if (len(userQS) == 0):
-            audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN).save()
+            get_audit_log().write(audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN))
             raise UserDoesNotExist()
 
         user: User = userQS.first()
         if not isinstance(user, User):
-            audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN).save()
+            get_audit_log().write(audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN))
             raise UserDoesNotExist()
 
         if not verify_password(str(user.password), req_login.password):
-            audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN).save()
+            get_audit_log().write(audit_message(f"a user tried to login with email: \"{req_login.email}\"", AuditType.FAILED_LOGIN))
             raise UserDoesNotExist()
 
         raw_is_active = getattr(user, "is_active", True)
@@ -194,9 +195,9 @@ def login():
                 "is_active": user_is_active,
             },
         )
-        audit_message(f"User: {user.email} successfully logged in", AuditType.LOGIN, UserToken({
+        get_audit_log().write(audit_message(f"User: {user.email} successfully logged in", AuditType.LOGIN, UserToken({
             "id": str(user.id) # type: ignore
-        })).save()
+        })))
 
         # Create response with user data
         resp = make_response(jsonify({
@@ -7,7 +7,8 @@ from datetime import datetime
 from werkzeug.exceptions import BadRequest
 
 from backend.Lib.Error import InvalidId
-from backend.Apps.Main.Database import Conversation, Message
+from backend.Apps.Main.ChatContext import get_chat_context
+from backend.Apps.Main.Database import Conversation, Message, MessageEmbedding
 from backend.Apps.Main.Utils.UserToken import get_token
 from backend.Lib.Logger import Logger
 from backend.Lib.Sanitizer import raise_on_bad_input
@@ -68,7 +69,7 @@ def get_id(id: str):
 
     messages: List[Message] = Message.objects( # type: ignore
       conversation=id
-    ).only("id", "text", "created_at").order_by("created_at")
+    ).only("id", "text", "created_at").order_by("created_at", "position", "id")
 
     results = []
     for msg in messages:
@@ -165,9 +166,11 @@ def delete(id: str):
 
     # Delete all messages in the conversation
     Message.objects(conversation=id).delete()
+    MessageEmbedding.objects(conversation=id).delete()
     
     # Delete the conversation
     conversation.delete()
+    get_chat_context().invalidate(id)
 
     return jsonify({"success": True, "message": "Conversation deleted"}), 200
 
@@ -11,6 +11,7 @@ from backend.Apps.Main.LabsSession.LabsSession import create_session, get_sessio
 from backend.Lib.Error import CouldNotCreateSession, InvalidId, InvalidSession
 from backend.Apps.Main.Utils.UserToken import get_token
 from backend.Lib.Logger import Logger
+from backend.Apps.Main.AuditLog import get_audit_log
 from backend.Apps.Main.Utils.Audit import audit_message
 
 b_labs = Blueprint("Labs", __name__)
@@ -35,13 +36,13 @@ def create():
   if user_id == None or user_id.id == None:
     raise InvalidId()
 
-  audit_message(f"user: {user_id.username} is trying to create a labs session").save()
+  get_audit_log().write(audit_message(f"user: {user_id.username} is trying to create a labs session"))
 
   session = create_session(user_id.id)
   if session == None:
     raise CouldNotCreateSession()
 
-  audit_message(f"user: {user_id.username} successfully created a labs session").save()
+  get_audit_log().write(audit_message(f"user: {user_id.username} successfully created a labs session"))
 
   return jsonify(
     asdict(
@@ -83,7 +84,7 @@ def get():
     raise Unauthorized()
 
   if session.refresh:
-    audit_message(f"user: {session.uid} refreshed the labs session").save()
+    get_audit_log().write(audit_message(f"user: {session.uid} refreshed the labs session"))
 
   return jsonify(SessionGetResult(
     uid=session.uid,
@@ -7,19 +7,25 @@ from flask import jsonify, request
 from flask.blueprints import Blueprint
 from flask_jwt_extended import jwt_required # type: ignore
 from mongoengine import ValidationError
-from werkzeug.exceptions import NotAcceptable, HTTPException
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import NotAcceptable, NotFound, HTTPException, ServiceUnavailable
 from bson import ObjectId
 from gridfs import GridFS
 from mongoengine.connection import get_db
 
+from backend.Apps.Main.AuditLog import get_audit_log
 from backend.Apps.Main.Database import Transaction
+from backend.Apps.Main.Ingestion import get_ingestion
 from backend.Apps.Main.Database.Models import Memory
+from backend.Apps.Main.Retrieval import get_retrieval
 from backend.Apps.Main.Utils.Aggregate import Pagination, PaginationResults, match_list, match_regex
 from backend.Apps.Main.Utils.Decorator import protect
 from backend.Apps.Main.Utils.UserToken import get_token
+from backend.Lib.Config import INGEST_ASYNC
+from backend.Lib.ContextPacker import estimate_tokens
 from backend.Lib.Error import BadBody, HttpValidationError, InvalidId, TooManyFiles
 from backend.Lib.Logger import Logger
-from backend.Apps.Main.Service.Memory import create_memory, DCreateMemory # type: ignore
+from backend.Apps.Main.Service.Memory import create_memory, discard_file, ingest_file, replaced_memories, spool_file, DCreateMemory # type: ignore
 from backend.Apps.Main.Utils import get_schema_of_dataclass, Collections, generate_embeddings, AuditType # type: ignore
 from backend.Apps.Main.Utils.Enum import MemoryType, Role
 from backend.Apps.Main.Utils.Audit import audit_collection
@@ -34,16 +40,17 @@ def delete(memory_id):
   """
   Soft delete a memory by ID
   If memory is a file type, deletes ALL chunks with the same file_id
+  The file stays in GridFS for `/restore` until `/permanent-delete`
   """
   if not ObjectId.is_valid(memory_id):
     raise InvalidId()
 
   try:
     user_token = get_token()
+    audits = []
     
     with Transaction() as (session, db):
       col_mem = db.get_collection(Collections.MEMORY.value)
-      col_audit = db.get_collection(Collections.AUDIT.value)
 
       # Get the memory to check for file
       memory_obj = Memory.objects(id=memory_id).first()
@@ -58,14 +65,6 @@ def delete(memory_id):
         # Get all memory chunks with this file_id
         all_chunks = Memory.objects(file_id=file_id)
         chunk_ids = [chunk.id for chunk in all_chunks]
-        
-        # Delete the file from GridFS
-        fs = GridFS(get_db())
-        try:
-          fs.delete(file_id)
-          Logger.log.info(f"Deleted file from GridFS: {file_id}")
-        except Exception as e:
-          Logger.log.error(f"Error deleting file: {e}")
 
         # Soft delete ALL chunks
         result = Memory.objects(file_id=file_id).update(
@@ -81,10 +80,11 @@ def delete(memory_id):
             collection=Collections.MEMORY,
             id=chunk_id,
           )
-          col_audit.insert_one(audit.to_mongo(), session=session)
+          audits.append(audit)
           
       else:
         # This is a text-only memory - delete single item
+        chunk_ids = [ ObjectId(memory_id) ]
         result = Memory.objects(id=memory_id).update_one(
           deleted_at=datetime.utcnow()
         )
@@ -98,8 +98,10 @@ def delete(memory_id):
           collection=Collections.MEMORY,
           id=ObjectId(memory_id),
         )
-        col_audit.insert_one(audit.to_mongo(), session=session)
+        audits.append(audit)
 
+    get_audit_log().write(*audits)
+    get_retrieval().sync_memories(chunk_ids)
     return jsonify({"message": "Memory deleted successfully"}), 200
 
   except InvalidId:
@@ -122,10 +124,10 @@ def permanent_delete(memory_id):
 
   try:
     user_token = get_token()
+    audits = []
     
     with Transaction() as (session, db):
       col_mem = db.get_collection(Collections.MEMORY.value)
-      col_audit = db.get_collection(Collections.AUDIT.value)
 
       # Get the memory to check for file
       memory_obj = Memory.objects(id=memory_id).first()
@@ -161,10 +163,11 @@ def permanent_delete(memory_id):
             collection=Collections.MEMORY,
             id=chunk_id,
           )
-          col_audit.insert_one(audit.to_mongo(), session=session)
+          audits.append(audit)
           
       else:
         # This is a text-only memory - permanently delete single item
+        chunk_ids = [ ObjectId(memory_id) ]
         result = Memory.objects(id=memory_id).delete()
 
         if result == 0:
@@ -176,8 +179,10 @@ def permanent_delete(memory_id):
           collection=Collections.MEMORY,
           id=ObjectId(memory_id),
         )
-        col_audit.insert_one(audit.to_mongo(), session=session)
+        audits.append(audit)
 
+    get_audit_log().write(*audits)
+    get_retrieval().sync_memories(chunk_ids)
     return jsonify({"message": "Memory permanently deleted"}), 200
 
   except InvalidId:
@@ -194,6 +199,8 @@ def update(memory_id):
   Update a memory by ID
   For file memories, updates ALL chunks with the same file_id
   For text memories, updates the single memory
+  With a file, the file replaces the memory (all its chunks) like `/create`:
+  only the chunks whose text changed are embedded
   """
   if not request.content_type or not request.content_type.startswith("multipart/form-data"):
     raise NotAcceptable(description="Content-Type must be multipart/form-data")
@@ -209,6 +216,11 @@ def update(memory_id):
     existing_memory = Memory.objects(id=memory_id).first()
     if not existing_memory:
       raise InvalidId()
+
+    # memories to resync in the vector index, the old chunks of a replaced file included
+    affected_ids = [ ObjectId(memory_id) ]
+    if existing_memory.file_id:
+      affected_ids = [ chunk.id for chunk in Memory.objects(file_id=existing_memory.file_id).only("id") ]
     
     # Get form data
     if request.form.get("title"):
@@ -216,6 +228,7 @@ def update(memory_id):
     
     if request.form.get("text"):
       update_data["text"] = request.form.get("text")
+      update_data["token_count"] = estimate_tokens(update_data["text"])
     
     tags = request.form.getlist("tags")
     if tags:
@@ -226,35 +239,17 @@ def update(memory_id):
 
     raise_on_bad_input(update_data)
 
-    # Handle file replacement
+    # Handle file replacement, only the changed chunks are embedded
     file = request.files.get("file")
     if file and file.filename:
-      # Delete old file if it exists
-      if existing_memory.file_id:
-        fs = GridFS(get_db())
-        try:
-          fs.delete(existing_memory.file_id)
-          Logger.log.info(f"Deleted old file: {existing_memory.file_id}")
-        except Exception as e:
-          Logger.log.error(f"Error deleting old file: {e}")
-        
-        # Delete old chunks
-        Memory.objects(file_id=existing_memory.file_id).delete()
-        Logger.log.info(f"Deleted old memory chunks for file_id: {existing_memory.file_id}")
-
-      # Upload new file and create new chunks
-      # This should use the create_memory function to handle chunking
-      # For now, we'll just upload the file
-      file.stream.seek(0)
-      fs = GridFS(get_db())
-      file_id = fs.put(
-        file.stream,
-        filename=file.filename,
-        content_type=file.content_type
+      return submit_file_job(
+        file,
+        update_data.get("title", existing_memory.title),
+        list(update_data.get("tags", existing_memory.tags)),
+        get_token(),
+        replaces=existing_memory,
+        queue=INGEST_ASYNC and get_ingestion().available()
       )
-      update_data["file_id"] = file_id
-      update_data["mem_type"] = MemoryType.FILE
-      Logger.log.info(f"Uploaded new file: {file_id}")
 
     # Regenerate embeddings if text changed (for text-only memories)
     if "text" in update_data or "title" in update_data:
@@ -282,31 +277,25 @@ def update(memory_id):
 
     # Log audit
     user_token = get_token()
-    with Transaction() as (session, db):
-      col_audit = db.get_collection(Collections.AUDIT.value)
-      
-      if existing_memory.file_id:
-        # Log audit for all chunks
-        audits = []
-        chunks = Memory.objects(file_id=existing_memory.file_id).only("id")
-        for chunk in chunks:
-          audits.append(
-            audit_collection(
-              type=AuditType.UPDATE,
-              collection=Collections.MEMORY,
-              id=chunk.id,
-            ).to_mongo()
-          )
-        col_audit.insert_many(audits, session=session)
-      else:
-        # Log audit for single memory
-        audit = audit_collection(
+    if existing_memory.file_id:
+      # Log audit for all chunks
+      chunks = Memory.objects(file_id=existing_memory.file_id).only("id")
+      get_audit_log().write(*[
+        audit_collection(
           type=AuditType.UPDATE,
           collection=Collections.MEMORY,
-          id=ObjectId(memory_id),
-        )
-        col_audit.insert_one(audit.to_mongo(), session=session)
+          id=chunk.id,
+        ) for chunk in chunks
+      ])
+    else:
+      # Log audit for single memory
+      get_audit_log().write(audit_collection(
+        type=AuditType.UPDATE,
+        collection=Collections.MEMORY,
+        id=ObjectId(memory_id),
+      ))
 
+    get_retrieval().sync_memories(affected_ids)
     return jsonify({"message": "Memory updated successfully"}), 200
 
   except InvalidId:
@@ -346,12 +335,16 @@ def create():
 
   
   user_token = get_token()
+  if body.file != None and INGEST_ASYNC and get_ingestion().available():
+    assert(body.file != None)
+    return submit_file_job(body.file, body.title, body.tags if isinstance(body.tags, list) else [], user_token)
+
   try:
     with Transaction() as (session, db): # type: ignore
       col_mem = db.get_collection(Collections.MEMORY.value) # type: ignore
       col_audit = db.get_collection(Collections.AUDIT.value) # type: ignore
 
-      create_memory(
+      memory_ids = create_memory(
         user_token=user_token,
         session=session,
         col_audit=col_audit,
@@ -364,8 +357,72 @@ def create():
   except Exception as e:
     raise HTTPException(description=str(e))
 
+  get_retrieval().sync_memories(memory_ids)
   return "", 200
 
+def submit_file_job(
+  file: FileStorage, title: str, tags: List[str], user_token,
+  replaces: Memory | None = None, queue: bool = True
+):
+  """
+  Spools the file and queues its ingestion (unless not `queue`), 202
+  `{ job }` to poll at `/jobs/<job>`. Ingested on the request when redis
+  is down.
+
+  `replaces` the memory (all the chunks of its file) the file replaces,
+  see `ingest_file`
+  """
+  try:
+    file_id = spool_file(file)
+  except Exception as e:
+    raise HTTPException(description=str(e))
+
+  replaces_id = replaces.id if replaces != None else None
+  replaces_file = replaces.file_id if replaces != None else None
+  if queue:
+    job_id = get_ingestion().submit(
+      str(file_id), file.filename or "", title, tags, str(user_token.id), request.remote_addr or "",
+      str(replaces_id or ""), str(replaces_file or "")
+    )
+    if job_id != None:
+      return jsonify({ "job": job_id }), 202
+
+  try:
+    memory_ids = ingest_file(file_id, title, tags, replaces=replaces_id)
+  except ValidationError as e:
+    discard_file(file_id)
+    raise HttpValidationError(e.to_dict()) # type: ignore
+  except Exception as e:
+    discard_file(file_id)
+    raise HTTPException(description=str(e))
+  if replaces_id != None:
+    memory_ids = memory_ids + replaced_memories(replaces_id, replaces_file)
+  get_retrieval().sync_memories(memory_ids)
+  return "", 200
+
+@memory.route("/jobs/<job_id>", methods=["GET"])
+@jwt_required(optional=False)
+@protect(role=Role.ADMIN)
+def job(job_id):
+  """
+  Status of a file ingestion job of `/create` or `/update`
+
+  { id, status: queued|running|done|failed, stage: queued|extract|embed|insert|done,
+    chunks, attempts, error, memories, filename, title, tags, created_at, updated_at }
+  """
+  ingestion = get_ingestion()
+  try:
+    job = ingestion.get(job_id)
+  except Exception as e:
+    Logger.log.error(f"job {job_id}: {repr(e)}")
+    raise ServiceUnavailable()
+  if job == None:
+    raise NotFound(description="Job not found")
+
+  for field in ("user", "ip", "file_id", "replaces", "replaces_file"):
+    job.pop(field, None)
+  return jsonify(job), 200
+
 @dataclass
 class MemoryResult:
   id: str
@@ -566,10 +623,10 @@ def restore(memory_id):
 
   try:
     user_token = get_token()
+    audits = []
     
     with Transaction() as (session, db):
       col_mem = db.get_collection(Collections.MEMORY.value)
-      col_audit = db.get_collection(Collections.AUDIT.value)
 
       # Get the memory to check for file
       memory_obj = Memory.objects(id=memory_id).first()
@@ -587,16 +644,18 @@ def restore(memory_id):
 
         # Log audit for all chunks
         chunks = Memory.objects(file_id=memory_obj.file_id)
+        chunk_ids = [ chunk.id for chunk in chunks ]
         for chunk in chunks:
           audit = audit_collection(
             type=AuditType.UPDATE,  # Or add AuditType.RESTORE if you have it
             collection=Collections.MEMORY,
             id=chunk.id,
           )
-          col_audit.insert_one(audit.to_mongo(), session=session)
+          audits.append(audit)
           
       else:
         # This is a text-only memory - restore single item
+        chunk_ids = [ ObjectId(memory_id) ]
         result = Memory.objects(id=memory_id).update_one(
           deleted_at=None
         )
@@ -610,8 +669,10 @@ def restore(memory_id):
           collection=Collections.MEMORY,
           id=ObjectId(memory_id),
         )
-        col_audit.insert_one(audit.to_mongo(), session=session)
+        audits.append(audit)
 
+    get_audit_log().write(*audits)
+    get_retrieval().sync_memories(chunk_ids)
     return jsonify({"message": "Memory restored successfully"}), 200
 
   except InvalidId:
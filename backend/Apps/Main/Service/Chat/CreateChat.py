@@ -1,160 +1,147 @@
+from pymongo import InsertOne
 from pymongo.collection import Collection
 from pymongo.client_session import ClientSession
+from pymongo.errors import BulkWriteError
 from typing import List
+from hashlib import blake2b
 from concurrent.futures import ThreadPoolExecutor
-import time
+from functools import partial
+from time import perf_counter
 
-from backend.Apps.Main.Database import Conversation, Message, Audit, Memory
+from backend.Apps.Main.AuditLog import get_audit_log
+from backend.Apps.Main.ChatContext import ChatContextService, ContextMessage, get_chat_context, split_context
+from backend.Apps.Main.Database import Conversation, Message, MessageEmbedding, Audit, Memory
+from backend.Apps.Main.Retrieval import RetrievalService, get_retrieval
 from backend.Apps.Main.Utils.Audit import audit_collection
 from backend.Lib.Logger import Logger
 from backend.Apps.Main.Utils import UserToken, get_object_id, Collections, AuditType, ObjectId
-from backend.Apps.Main.Utils.Enum import VectorIndex
-from backend.Lib.Config import MAX_CONTEXT_SIZE
+from backend.Lib.Cancellation import Cancellation
+from backend.Lib.Config import CONTEXT_TOKEN_BUDGET, MAX_CONTEXT_SIZE, RETRIEVAL_CONTEXT_DEADLINE_MS, RETRIEVAL_MEMORY_DEADLINE_MS
+from backend.Lib.ContextPacker import pack_context
+from backend.Lib.Deadline import Stage, run_stages
+from backend.Lib.Metrics import CONTEXT_TOKENS_SAVED, DOWNSTREAM_DURATION, RETRIEVAL_DEGRADED
+from backend.Lib.Timing import StageTimer
 from backend.Apps.Main.Utils.LLM import Prompt, generate_embeddings, generate_model_reply, Reply
 
-def __search_similarity_from_memory(query_embeddings: List[float]):
-  # Text only vector search
-  # ✅ FIXED: Added filter to exclude soft-deleted memories
-  pipeline = [
-    {
-        "$vectorSearch": {
-            "index": VectorIndex.MEMORY.value,
-            "path": "embeddings",
-            "queryVector": query_embeddings,
-            "numCandidates": 100,
-            "limit": MAX_CONTEXT_SIZE,
-            "filter": {
-                "deleted_at": None  # ✅ Only include non-deleted memories
-            }
-        }
-    },
-    {
-        "$project": {
-            "text": 1,
-            "score": {"$meta": "vectorSearchScore"}  # include similarity score
-        }
-    },
-    {
-        "$match": {
-            "score": { "$gte": 0.65 }
-        }
-    }
-  ]
-  return list(Memory.objects.aggregate(*pipeline)) # type: ignore
-
-def __get_conversation_history(
-    conversation_id: ObjectId,
-    limit: int = 5
-) -> List[dict]:
-    """Get the last N messages from a conversation in chronological order"""
-    messages = Message.objects(
-        conversation=conversation_id
-    ).order_by("-created_at").limit(limit)
-    
-    # Reverse to get chronological order (oldest first)
-    history = []
-    for msg in reversed(list(messages)):
-        history.append({
-            "role": "assistant" if msg.sender is None else "user",
-            "content": msg.text
-        })
-    
-    return history
+def __search_similarity_from_memory(retrieval: RetrievalService, query_embeddings: List[float]):
+  return retrieval.search_memory(query_embeddings, limit=MAX_CONTEXT_SIZE, min_score=0.65)
 
-def __get_last_message(
+def __get_conversation_context(
+  chat_context: ChatContextService,
   conversation_id: ObjectId,
-  sender_id: ObjectId,
+  sender_id: str | None
+):
+  """
+  Returns:
+    `(last_messages, conversation_history)` from one load of the recent messages
+  """
+  return split_context(
+    chat_context.load(conversation_id),
+    sender_id,
+    last_limit=MAX_CONTEXT_SIZE,
+    history_limit=5
+  )
+
+def __retrieve(
+  conversation_id: str | None,
+  user: UserToken,
+  query_embeddings: List[float],
+  timer: StageTimer
 ):
-  return [ { "text": i.text } for i in list(
-    Message.objects( # type: ignore
-        conversation=conversation_id,
-        sender=sender_id
-       )
-      .only("text")
-      .order_by("-created_at")
-      .limit(MAX_CONTEXT_SIZE)
-  ) ]
+  """
+  Runs the memory search and the conversation context on the shared
+  retrieval executor. A stage that misses its deadline or fails is left
+  out and the reply is generated with what finished.
+
+  The memories and the user's last messages are packed into
+  `CONTEXT_TOKEN_BUDGET`, duplicates of each other or of the history
+  are dropped.
+
+  Returns:
+    `(context, conversation_history)`
+  """
+  if len(query_embeddings) == 0:
+    return [], []
+
+  retrieval = get_retrieval()
+  stages = [
+    Stage(
+      name="vector_search",
+      fn=partial(timer.timed("vector_search", __search_similarity_from_memory), retrieval, query_embeddings),
+      deadline_ms=RETRIEVAL_MEMORY_DEADLINE_MS,
+      default=[]
+    )
+  ]
+
+  # FIX: Check if conversation_id is not None AND not empty
+  if conversation_id is not None and len(conversation_id) > 0:
+    try:
+      conv_obj_id = get_object_id(conversation_id)
+      Logger.log.info(f"Valid conversation ObjectId: {conv_obj_id}")
+
+      chat_context = get_chat_context()
+      stages.append(Stage(
+        name="context",
+        fn=partial(timer.timed("context", __get_conversation_context), chat_context, conv_obj_id, user.id),
+        deadline_ms=RETRIEVAL_CONTEXT_DEADLINE_MS,
+        default=([], [])
+      ))
+    except Exception as e:
+      Logger.log.error(f"Error getting conversation context: {e}")
+
+  results, degraded = run_stages(retrieval.executor, stages)
+  for stage, reason in degraded.items():
+    RETRIEVAL_DEGRADED.inc(stage, reason)
+    Logger.log.warning(f"retrieval stage {stage} skipped ({reason}), replying without it")
+
+  sim_results = list(results["vector_search"])
+  last_messages, conversation_history = results.get("context", ([], []))
+  sim_results.extend(last_messages)
+  Logger.log.info(f"Retrieved {len(last_messages)} last messages for RAG")
+  Logger.log.info(f"Retrieved conversation_history with {len(conversation_history)} messages")
+
+  with timer.stage("pack"):
+    context, stats = pack_context(sim_results, conversation_history, CONTEXT_TOKEN_BUDGET)
+  CONTEXT_TOKENS_SAVED.inc(value=stats.saved_tokens)
+  Logger.log.info(
+    f"context packed {stats.packed}/{stats.passages} passages, {stats.packed_tokens} tokens, "
+    f"saved {stats.saved_tokens} prompt tokens ({stats.duplicates} duplicates, {stats.over_budget} over budget)"
+  )
+
+  return context, conversation_history
 
 def generate_reply(
   conversation_id: str | None,  # Allow None
   user: UserToken,
   prompt: Prompt,
-  overrides: dict
+  overrides: dict,
+  timer: StageTimer | None = None
 ):
-  query_embeddings = generate_embeddings([prompt.content])
+  if timer == None:
+    timer = StageTimer()
+
+  with timer.stage("embed"):
+    query_embeddings = generate_embeddings([prompt.content])
 
   if len(query_embeddings) == 0:
     Logger.log.warning("Embeddings length is 0")
 
-  sim_results = []
-  conversation_history = []
-  
   # DEBUG: Log the conversation_id
   Logger.log.info(f"conversation_id: '{conversation_id}'")
-  
-  if len(query_embeddings) > 0:
-    start = time.perf_counter()
-    with ThreadPoolExecutor(max_workers=3) as executer:
-      ex1 = executer.submit(__search_similarity_from_memory, query_embeddings=query_embeddings)
-      
-      ex2 = None
-      ex3 = None
-      # FIX: Check if conversation_id is not None AND not empty
-      if conversation_id is not None and len(conversation_id) > 0:
-        try:
-          conv_obj_id = get_object_id(conversation_id)
-          Logger.log.info(f"Valid conversation ObjectId: {conv_obj_id}")
-          
-          ex2 = executer.submit(
-            __get_last_message,
-            conversation_id=conv_obj_id,
-            sender_id=get_object_id(user.id),
-          )
-          
-          ex3 = executer.submit(
-            __get_conversation_history,
-            conversation_id=conv_obj_id,
-            limit=5
-          )
-        except Exception as e:
-          Logger.log.error(f"Error getting conversation context: {e}")
-
-      sim_results.extend(ex1.result())
-      
-      if ex2 is not None:
-        try:
-          last_messages = ex2.result()
-          sim_results.extend(last_messages)
-          Logger.log.info(f"Retrieved {len(last_messages)} last messages for RAG")
-        except Exception as e:
-          Logger.log.error(f"Error getting last messages: {e}")
-          
-      if ex3 is not None:
-        try:
-          conversation_history = ex3.result()
-          Logger.log.info(f"Retrieved conversation_history with {len(conversation_history)} messages")
-        except Exception as e:
-          Logger.log.error(f"Error getting conversation history: {e}")
-      
-    end = time.perf_counter()
-    elapsed = end - start
-    Logger.log.info(f"Query Context took {elapsed}ms")
-
-  Logger.log.info(f"context {sim_results}")
+
+  context, conversation_history = __retrieve(conversation_id, user, query_embeddings, timer)
+
+  Logger.log.info(f"context {context}")
   Logger.log.info(f"conversation_history {conversation_history}")
-  
-  context = [ i["text"] for i in sim_results ]
-
-  start = time.perf_counter()
-  reply = generate_model_reply(
-    prompt=prompt, 
-    context=context, 
-    conversation_history=conversation_history,
-    overrides=overrides
-  )
-  end = time.perf_counter()
-  elapsed = end - start
-  Logger.log.info(f"Reply Generation took {elapsed}ms")
+
+  with timer.stage("generate"):
+    reply = generate_model_reply(
+      prompt=prompt, 
+      context=context, 
+      conversation_history=conversation_history,
+      overrides=overrides
+    )
+  Logger.log.info(f"Reply Generation took {timer.stages['generate']:.1f}ms")
 
   return Reply(
     reply=reply,
@@ -167,90 +154,54 @@ def generate_reply_stream(
     conversation_id: str | None,
     user: UserToken,
     prompt: Prompt,
-    overrides: dict
+    overrides: dict,
+    timer: StageTimer | None = None,
+    cancel: Cancellation | None = None
 ):
     """
     Streaming version of generate_reply that yields chunks as they come from the model.
     This allows for real-time response streaming and proper cancellation.
+
+    `{ "embeddings" }` is yielded before the first chunk, so a cancelled
+    reply can be stored with them. `cancel` aborts the model request.
     """
-    query_embeddings = generate_embeddings([prompt.content])
+    if timer == None:
+        timer = StageTimer()
+
+    with timer.stage("embed"):
+        query_embeddings = generate_embeddings([prompt.content])
 
     if len(query_embeddings) == 0:
         Logger.log.warning("Embeddings length is 0")
+    yield { "embeddings": query_embeddings }
 
-    sim_results = []
-    conversation_history = []
-    
     Logger.log.info(f"conversation_id: '{conversation_id}'")
-    
-    if len(query_embeddings) > 0:
-        start = time.perf_counter()
-        with ThreadPoolExecutor(max_workers=3) as executer:
-            ex1 = executer.submit(__search_similarity_from_memory, query_embeddings=query_embeddings)
-            
-            ex2 = None
-            ex3 = None
-            if conversation_id is not None and len(conversation_id) > 0:
-                try:
-                    conv_obj_id = get_object_id(conversation_id)
-                    Logger.log.info(f"Valid conversation ObjectId: {conv_obj_id}")
-                    
-                    ex2 = executer.submit(
-                        __get_last_message,
-                        conversation_id=conv_obj_id,
-                        sender_id=get_object_id(user.id),
-                    )
-                    
-                    ex3 = executer.submit(
-                        __get_conversation_history,
-                        conversation_id=conv_obj_id,
-                        limit=5
-                    )
-                except Exception as e:
-                    Logger.log.error(f"Error getting conversation context: {e}")
-
-            sim_results.extend(ex1.result())
-            
-            if ex2 is not None:
-                try:
-                    last_messages = ex2.result()
-                    sim_results.extend(last_messages)
-                    Logger.log.info(f"Retrieved {len(last_messages)} last messages for RAG")
-                except Exception as e:
-                    Logger.log.error(f"Error getting last messages: {e}")
-                    
-            if ex3 is not None:
-                try:
-                    conversation_history = ex3.result()
-                    Logger.log.info(f"Retrieved conversation_history with {len(conversation_history)} messages")
-                except Exception as e:
-                    Logger.log.error(f"Error getting conversation history: {e}")
-        
-        end = time.perf_counter()
-        elapsed = end - start
-        Logger.log.info(f"Query Context took {elapsed}ms")
-
-    Logger.log.info(f"context {sim_results}")
+
+    context, conversation_history = __retrieve(conversation_id, user, query_embeddings, timer)
+
+    Logger.log.info(f"context {context}")
     Logger.log.info(f"conversation_history {conversation_history}")
-    
-    context = [i["text"] for i in sim_results]
 
-    start = time.perf_counter()
-    
     # ✅ Stream the model reply
     full_reply = ""
+    start = perf_counter()
+    is_first = True
     for chunk in generate_model_reply_stream(
         prompt=prompt,
         context=context,
         conversation_history=conversation_history,
-        overrides=overrides
+        overrides=overrides,
+        cancel=cancel
     ):
+        if is_first:
+            timer.add("ttft", (perf_counter() - start) * 1000)
+            is_first = False
         full_reply += chunk
         yield chunk  # Yield each chunk to the client
-    
-    end = time.perf_counter()
-    elapsed = end - start
-    Logger.log.info(f"Reply Generation took {elapsed}ms")
+
+    # wall time of the whole stream, includes writing the chunks to the client
+    timer.add("generate", (perf_counter() - start) * 1000)
+    Logger.log.info(f"Reply Generation took {timer.stages['generate']:.1f}ms")
     
     # Return the full reply and embeddings after streaming is done
     yield {
@@ -264,7 +215,8 @@ def generate_model_reply_stream(
     prompt: Prompt,
     context: List[str],
     conversation_history: List[dict],
-    overrides: dict
+    overrides: dict,
+    cancel: Cancellation | None = None
 ):
     """Stream model reply chunks"""
     from backend.Apps.Model.Engine import GroqEngine
@@ -291,8 +243,44 @@ Answer based on the context provided. If the answer isn't in the context, use yo
     
     # Stream from engine
     engine = GroqEngine()
-    for chunk in engine.generate_stream(query, overrides):
-        yield chunk
+    with DOWNSTREAM_DURATION.time("groq"):
+        yield from engine.generate_stream(query, overrides, cancel)
+
+# nothing waits on the message embeddings, one writer is enough
+_embedding_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-embeddings")
+
+def __save_message_embeddings(conversation_id: ObjectId, message_id: ObjectId, embeddings: List[float]):
+  try:
+    doc = MessageEmbedding(
+      id=message_id,
+      conversation=conversation_id,
+      embeddings=MessageEmbedding.pack(embeddings)
+    )
+    doc.validate()
+    MessageEmbedding._get_collection().insert_one(doc.to_mongo()) # type: ignore
+  except Exception as e:
+    Logger.log.error(f"saving embeddings of message {message_id} failed: {repr(e)}")
+
+def remember_chat(
+  conversation_id: str,
+  is_new: bool,
+  user_token: UserToken,
+  user_message_id: ObjectId,
+  ai_message_id: ObjectId,
+  prompt: Prompt,
+  reply: str,
+  embeddings: List[float]
+):
+  """
+  Adds a committed turn to the recent message cache of the conversation
+  and queues the write of the prompt embeddings
+  """
+  get_chat_context().append(conversation_id, [
+    ContextMessage(id=str(user_message_id), sender=user_token.id, text=prompt.content),
+    ContextMessage(id=str(ai_message_id), sender=None, text=reply)
+  ], is_new=is_new)
+  if len(embeddings) > 0:
+    _embedding_writer.submit(__save_message_embeddings, ObjectId(conversation_id), user_message_id, embeddings)
 
 def create_chat(
   session: ClientSession,
@@ -362,7 +350,7 @@ def create_chat(
     sender=user_id,
     conversation=conv_id,
     text=prompt.content,
-    embeddings=model_reply.embeddings
+    position=0
   )
   message.validate()
 
@@ -370,7 +358,7 @@ def create_chat(
     sender=None,
     conversation=conv_id,
     text=model_reply.reply,
-    embeddings=[]
+    position=1
   )
   ai_reply.validate()
 
@@ -394,4 +382,108 @@ def create_chat(
   user_message_id = messages_id[0]
   ai_message_id = messages_id[1]
   
-  return (conv_id, user_message_id, ai_message_id)
\ No newline at end of file
+  return (conv_id, user_message_id, ai_message_id)
+
+def _turn_key(idempotency_key: str, conversation_id: str | None, prompt: Prompt) -> str:
+  # a key reused for another conversation or prompt derives other ids
+  turn = blake2b(f"{conversation_id or ''}\0{prompt.content}".encode(), digest_size=8).hexdigest()
+  return f"{idempotency_key}:{turn}"
+
+def _idempotent_id(user_id: str, turn_key: str, name: str) -> ObjectId:
+  return ObjectId(blake2b(f"{user_id}:{turn_key}:{name}".encode(), digest_size=12).digest())
+
+def reply_message_id(user_token: UserToken, idempotency_key: str, conversation_id: str | None, prompt: Prompt) -> ObjectId:
+  """
+  Id `commit_chat` gives the model reply of the request `idempotency_key`
+  """
+  return _idempotent_id(str(get_object_id(user_token.id)), _turn_key(idempotency_key, conversation_id, prompt), "reply")
+
+def stored_reply(user_token: UserToken, idempotency_key: str, conversation_id: str | None, prompt: Prompt) -> Message | None:
+  """
+  The model reply `commit_chat` stored for the request `idempotency_key`,
+  a retry returns it instead of generating another one
+  """
+  reply_id = reply_message_id(user_token, idempotency_key, conversation_id, prompt)
+  return Message.objects(id=reply_id).only("conversation", "text").no_dereference().first() # type: ignore
+
+def _insert_once(col: Collection, docs: List[dict]) -> int:
+  """
+  Returns:
+    documents inserted, the others were already stored
+  """
+  try:
+    return col.bulk_write([ InsertOne(i) for i in docs ], ordered=False).inserted_count
+  except BulkWriteError as e:
+    errors = e.details.get("writeErrors", [])
+    if any([ i.get("code") != 11000 for i in errors ]):
+      raise
+    return e.details.get("nInserted", 0)
+
+def commit_chat(
+  model_reply: Reply,
+  default_title: str,
+  conversation_id: str | None,
+  prompt: Prompt,
+  user_token: UserToken,
+  idempotency_key: str | None
+):
+  """
+  Stores the same documents as `create_chat` without a transaction
+
+  With an `idempotency_key` the ids of a new conversation, of the 2
+  `Message` and of their audits are derived from the user, the key, the
+  conversation and the prompt, a retry of the request with the same key
+  stores nothing twice and returns the same ids. The messages are one unordered `bulk_write` so
+  a retry also completes a half written turn, the audits go to the audit
+  log.
+
+  Returns:
+    tuple: (conv_id, user_message_id, ai_message_id, inserted), `inserted`
+    messages of the 2, less when the turn was already stored
+
+  Throws:
+    `mongoengine.ValidationError`
+  """
+  user_id = get_object_id(user_token.id)
+  derive = lambda _: ObjectId()
+  if idempotency_key != None:
+    derive = partial(_idempotent_id, str(user_id), _turn_key(idempotency_key, conversation_id, prompt))
+  audits: List[Audit] = []
+
+  conv_id = None
+  try:
+    if conversation_id != None and len(conversation_id) > 0:
+      conv_id = get_object_id(conversation_id)
+  except Exception as _:
+    pass
+
+  # Conversation, a missing one is replaced by a new one like `create_chat`
+  col_conversation = Conversation._get_collection() # type: ignore
+  if conv_id != None and col_conversation.find_one({ "_id": conv_id }, { "_id": 1 }) == None:
+    conv_id = None
+  if conv_id == None:
+    conv = Conversation(id=derive("conversation"), owner=user_id, title=default_title)
+    conv.validate()
+    _insert_once(col_conversation, [conv.to_mongo()])
+    conv_id = conv.id
+    audits.append(audit_collection(type=AuditType.ADD, collection=Collections.CONVERSATION, id=conv_id))
+  # ============
+
+  message = Message(id=derive("message"), sender=user_id, conversation=conv_id, text=prompt.content, position=0)
+  message.validate()
+  ai_reply = Message(id=derive("reply"), sender=None, conversation=conv_id, text=model_reply.reply, position=1)
+  ai_reply.validate()
+
+  inserted = _insert_once(Message._get_collection(), [message.to_mongo(), ai_reply.to_mongo()]) # type: ignore
+  if inserted < 2:
+    Logger.log.info(f"chat commit {idempotency_key} retried, {2 - inserted} messages were already stored")
+
+  audits.extend([
+    audit_collection(type=AuditType.ADD, collection=Collections.CONVERSATION, id=i.id)
+    for i in (message, ai_reply)
+  ])
+  for i, audit in enumerate(audits):
+    audit.id = derive(f"audit-{i}")
+  get_audit_log().write(*audits)
+
+  return (conv_id, message.id, ai_reply.id, inserted)
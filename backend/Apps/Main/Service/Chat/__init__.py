@@ -1 +1 @@
-from .CreateChat import create_chat
\ No newline at end of file
+from .CreateChat import commit_chat, create_chat
\ No newline at end of file
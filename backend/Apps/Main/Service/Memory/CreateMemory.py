@@ -1,22 +1,28 @@
 from dataclasses import dataclass
-import io
-from typing import List
+from collections import deque
+from datetime import datetime
+import hashlib
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 from pymongo.client_session import ClientSession
 from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import HTTPException
 from gridfs import GridFS
 from mongoengine.connection import get_db
-from bson import ObjectId
+from bson import SON, ObjectId
 
-from backend.Apps.Main.Database import Audit, Memory
-from backend.Apps.Main.RAG.Chunk import chunkify
+from backend.Apps.Main.Database import Audit, Memory, Transaction
+from backend.Apps.Main.RAG.Chunk import chunkify_pages
 from backend.Apps.Main.RAG.Dataclass import FileInfo
-from backend.Apps.Main.RAG.Extract import extract
-from backend.Apps.Main.Utils import Collections, AuditType, UserToken, generate_embeddings
+from backend.Apps.Main.RAG.Extract import extract_pages
+from backend.Apps.Main.RAG.Spool import spool
+from backend.Apps.Main.Utils import Collections, AuditType, UserToken, embed_chunks, generate_embeddings
 from backend.Apps.Main.Utils.Audit import audit_collection
 from backend.Apps.Main.Utils.Enum import MemoryType, Permission
+from backend.Lib.ContextPacker import estimate_tokens
 from backend.Lib.Logger import Logger
+from backend.Lib.Timing import StageTimer
 
 @dataclass
 class DCreateMemory:
@@ -32,6 +38,7 @@ def _text_memory(data: DCreateMemory, session: ClientSession, col_memory: Collec
     title=data.title,
     mem_type=MemoryType.TEXT,
     text=data.text,
+    token_count=estimate_tokens(data.text),
     tags=data.tags,
     permission=[Permission.ALL.value],
     embeddings=embeddings
@@ -40,93 +47,260 @@ def _text_memory(data: DCreateMemory, session: ClientSession, col_memory: Collec
   mem.validate() # type: ignore
   return col_memory.insert_one(mem.to_mongo(), session=session).inserted_id # type: ignore
 
-def _file_memory(data: DCreateMemory, session: ClientSession, col_memory: Collection): # type: ignore
+def _file_memory(data: DCreateMemory, session: ClientSession, col_memory: Collection, timer: StageTimer | None = None): # type: ignore
+    """
+    `timer` stages: buffer, extract, gridfs, chunk, embed, insert
+    """
     assert(data.file != None)
+    if timer == None:
+        timer = StageTimer()
     
-    # Reset stream to beginning and extract content
-    data.file.stream.seek(0)
-    file_info = FileInfo(
-        filename=data.file.filename, # type: ignore
-        content_type=data.file.content_type, # type: ignore
-        stream=io.BytesIO(data.file.stream.read())
-    )
-    
+    # The readers read the upload itself (spooled, `RAG/Spool.SpooledRequest`)
+    with timer.stage("buffer"):
+        data.file.stream.seek(0)
+        file_info = FileInfo(
+            filename=data.file.filename, # type: ignore
+            content_type=data.file.content_type, # type: ignore
+            stream=data.file.stream # type: ignore
+        )
     
-    # Extract text from file
-    extracted = extract(file_info)
-    Logger.log.info(f"Extracted text length: {len(extracted)}")
     
-    # Convert extracted text to bytes for chunking
-    extracted_bytes = extracted.encode('utf-8')
-    chunks = chunkify(io.BytesIO(extracted_bytes))
-    Logger.log.info(f"Generated {len(chunks)} chunks from file")
+    # Pick the reader of the file, its pages are read while they are chunked
+    with timer.stage("extract"):
+        pages = extract_pages(file_info)
     
-    # Upload original file to GridFS
-    data.file.stream.seek(0)  # Reset stream again for GridFS
-    fs = GridFS(get_db())
+    # Upload original file to GridFS, streamed from the same upload
     Logger.log.info("Uploading File to GridFS")
-    file_id: ObjectId = fs.put(
-        data.file.stream,
-        filename=data.file.filename,
-        content_type=data.file.content_type
-    )
+    with timer.stage("gridfs"):
+        file_id = spool_file(data.file)
     
     if file_id is None:
         raise HTTPException(description="Something went wrong please try again")
     Logger.log.info(f"File Uploaded with ID: {file_id}")
     
     try:
-        memories = []
-        for i, chunk in enumerate(chunks):
-            # Handle chunk decoding safely
-            try:
-                decoded = chunk.decode('utf-8')
-            except UnicodeDecodeError:
-                decoded = chunk.decode('utf-8', errors='replace')
-                Logger.log.warning(f"Chunk {i} decoded with replaced characters")
-            
-            # Skip empty chunks
-            if not decoded.strip():
-                Logger.log.info(f"Skipping empty chunk {i}")
-                continue
-            
-            # Generate embeddings and create memory
-            embeddings = generate_embeddings([decoded])
-            mem = Memory(
-                title=data.title,
-                mem_type=MemoryType.FILE,
-                tags=data.tags,
-                embeddings=embeddings,
-                text=decoded,
-                file_id=file_id
-            )
-            mem.validate() # type: ignore
-            memories.append(mem.to_mongo()) # type: ignore
-            Logger.log.info(f"Created memory chunk {i+1}/{len(chunks)}")
-        
-        if not memories:
-            raise HTTPException(description="No valid text chunks could be extracted from the file")
+        memories, _ = _chunk_memories(pages, data.title, data.tags, file_id, timer)
             
-        result = col_memory.insert_many(memories, session=session)
+        with timer.stage("insert"):
+            result = col_memory.insert_many(memories, session=session)
         Logger.log.info(f"Inserted {len(result.inserted_ids)} memory chunks")
+        Logger.log.info(f"file memory timings {timer}")
         return result.inserted_ids
         
     except Exception as e:
         # Clean up GridFS file if memory insertion fails
         Logger.log.error(f"Error creating file memories: {e}")
-        try:
-            fs.delete(file_id)
-            Logger.log.info(f"Cleaned up GridFS file: {file_id}")
-        except Exception as delete_error:
-            Logger.log.error(f"Failed to clean up GridFS file: {delete_error}")
+        discard_file(file_id)
         raise
 
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _pages(first: int, last: int) -> List[int]:
+    return [ first, last ] if first > 0 else []
+
+def _chunk_memories(
+    pages: Iterable[Tuple[int, str]], title: str, tags: List[str] | str, file_id: ObjectId,
+    timer: StageTimer, progress: Callable[[int], None] | None = None,
+    reuse: Dict[str, List[ObjectId]] | None = None
+) -> Tuple[List[SON], List[Tuple[ObjectId, List[int]]]]:
+    """
+    `reuse` ids of existing chunks by `chunk_hash`, a chunk with the same
+    text takes one of them instead of being embedded
+
+    `timer` stages: extract (reading the pages), chunk (includes reading),
+    embed (waiting for the batches, includes chunking)
+
+    Returns:
+      the memories to insert and the `(id, pages)` of the reused chunks
+    """
+    memories = []
+    kept: List[Tuple[ObjectId, List[int]]] = []
+    # Pages are chunked as they are read, chunks are made while they are embedded
+    chunks = timer.timed_iter("chunk", chunkify_pages(timer.timed_iter("extract", pages)))
+    # (first, last, hash) of the chunks sent to embed, they come back in order
+    chunk_info: Deque[Tuple[int, int, str]] = deque()
+    def texts():
+        for text, first, last in chunks:
+            content_hash = chunk_hash(text)
+            if reuse and reuse.get(content_hash):
+                kept.append((reuse[content_hash].pop(), _pages(first, last)))
+                continue
+            chunk_info.append((first, last, content_hash))
+            yield text
+
+    for chunk, embeddings in timer.timed_iter("embed", embed_chunks(texts(), progress=progress)):
+        first, last, content_hash = chunk_info.popleft()
+        mem = Memory(
+            title=title,
+            mem_type=MemoryType.FILE,
+            tags=tags,
+            embeddings=embeddings,
+            text=chunk,
+            token_count=estimate_tokens(chunk),
+            file_id=file_id,
+            pages=_pages(first, last),
+            content_hash=content_hash
+        )
+        mem.validate() # type: ignore
+        memories.append(mem.to_mongo()) # type: ignore
+    Logger.log.info(f"Generated {len(memories)} chunks from file, {len(kept)} unchanged")
+
+    if not memories and not kept:
+        raise HTTPException(description="No valid text chunks could be extracted from the file")
+    return memories, kept
+
+def spool_file(file: FileStorage) -> ObjectId:
+    """
+    Uploads a file memory to GridFS for `ingest_file`
+    """
+    file.stream.seek(0)
+    return GridFS(get_db()).put(
+        file.stream,
+        filename=file.filename,
+        content_type=file.content_type
+    )
+
+def discard_file(file_id: ObjectId):
+    try:
+        GridFS(get_db()).delete(file_id)
+        Logger.log.info(f"Cleaned up GridFS file: {file_id}")
+    except Exception as delete_error:
+        Logger.log.error(f"Failed to clean up GridFS file: {delete_error}")
+
+def replaced_memories(replaces: ObjectId, file_id: ObjectId | None) -> List[ObjectId]:
+    """
+    Ids to sync of the memories replaced by `ingest_file`, `file_id` the
+    file of `replaces` before (None for a text memory). The chunks kept are
+    in the ids `ingest_file` returns.
+    """
+    if file_id == None:
+        return [ replaces ]
+    return [ m.id for m in Memory.objects(file_id=file_id).only("id") ] # type: ignore
+
+def _reusable(replaces: ObjectId | None) -> Tuple[Dict[str, List[ObjectId]], List[ObjectId], ObjectId | None]:
+    """
+    Only file chunks are reused, the embeddings of a text memory are of
+    its title and text (`generate_embeddings`), not of a chunk
+
+    Returns:
+      ids of the live file chunks replaced by the file by `chunk_hash`, ids
+      of the other live memories replaced (a text memory) and their file
+    """
+    reuse: Dict[str, List[ObjectId]] = {}
+    other: List[ObjectId] = []
+    if replaces == None:
+        return reuse, other, None
+    old = Memory.objects(id=replaces).only("file_id").first() # type: ignore
+    if old == None:
+        return reuse, other, None
+    query = { "file_id": old.file_id } if old.file_id != None else { "_id": old.id }
+    for doc in Memory._get_collection().find({ **query, "deleted_at": None }, { "text": 1, "content_hash": 1, "mem_type": 1 }): # type: ignore
+        if doc.get("mem_type") != MemoryType.FILE.value:
+            other.append(doc["_id"])
+            continue
+        # chunks ingested before the hashes were stored
+        content_hash = doc.get("content_hash") or chunk_hash(doc.get("text") or "")
+        reuse.setdefault(content_hash, []).append(doc["_id"])
+    return reuse, other, old.file_id
+
+def ingest_file(
+    file_id: ObjectId, title: str, tags: List[str],
+    progress: Callable[[str, int], None] | None = None,
+    user_id: ObjectId | None = None, ip: str | None = None,
+    replaces: ObjectId | None = None
+) -> List[ObjectId]:
+    """
+    Creates the memories of the file spooled by `spool_file`, inserted
+    with their audits (by `user_id` from `ip`, default: of the request) in
+    one transaction. The file is kept when it fails.
+
+    `replaces` a memory, the file replaces the file of its chunks (or the
+    text memory): the new chunks are diffed by `chunk_hash` against its
+    live chunks. A chunk with the same text keeps its id and embeddings and
+    moves to the new file, only the other new chunks are embedded and
+    inserted, the old chunks left are soft deleted in the same transaction.
+    A text memory is never reused, it is soft deleted. The old file is
+    deleted after when no chunk of it is left, else it stays with the soft
+    deleted chunks (they can be restored) until they are permanently
+    deleted. See `replaced_memories`.
+
+    `progress(stage, chunks)` is called when a stage (extract, insert)
+    starts and after each batch of chunks is embedded (embed), the pages
+    are read while the chunks are embedded
+
+    Returns:
+      ids of the memories of the file, the existing ones when the file was
+      already ingested (a job run again after its insert committed)
+    """
+    if progress == None:
+        progress = lambda stage, chunks: None
+    existing = [ m.id for m in Memory.objects(file_id=file_id).only("id") ] # type: ignore
+    if len(existing) > 0:
+        return existing
+
+    timer = StageTimer()
+    progress("extract", 0)
+    reuse, replaced, old_file_id = _reusable(replaces)
+    with timer.stage("buffer"):
+        stored = GridFS(get_db()).get(file_id)
+        file_info = FileInfo(
+            filename=stored.filename or "",
+            content_type=stored.content_type or "",
+            # on disk over UPLOAD_SPOOL_BYTES, a GridOut fetches its chunks again on each seek back
+            stream=spool(stored) # type: ignore
+        )
+    try:
+        with timer.stage("extract"):
+            pages = extract_pages(file_info)
+        memories, kept = _chunk_memories(pages, title, tags, file_id, timer, lambda chunks: progress("embed", chunks), reuse)
+    finally:
+        file_info.stream.close()
+    removed = [ i for ids in reuse.values() for i in ids ] + replaced
+
+    progress("insert", len(memories))
+    with timer.stage("insert"):
+        with Transaction() as (session, db):
+            col_memory = db.get_collection(Collections.MEMORY.value)
+            ids = col_memory.insert_many(memories, session=session).inserted_ids if memories else []
+            now = datetime.utcnow()
+            if kept:
+                col_memory.bulk_write([
+                    UpdateOne({ "_id": i }, { "$set": { "file_id": file_id, "pages": pages, "title": title, "tags": tags, "updated_at": now } })
+                    for i, pages in kept
+                ], session=session)
+            if removed:
+                col_memory.update_many({ "_id": { "$in": removed } }, { "$set": { "deleted_at": now } }, session=session)
+            audits = _audits(ids, user_id, ip) \
+                + _audits([ i for i, _ in kept ], user_id, ip, AuditType.UPDATE) \
+                + _audits(removed, user_id, ip, AuditType.DELETE)
+            db.get_collection(Collections.AUDIT.value).insert_many(audits, session=session)
+    if old_file_id != None and len(removed) == 0:
+        discard_file(old_file_id)
+    Logger.log.info(f"Inserted {len(ids)} memory chunks, kept {len(kept)}, deleted {len(removed)}, file memory timings {timer}")
+    return ids + [ i for i, _ in kept ]
+
+def _audits(ids: List[ObjectId], user_id: ObjectId | None, ip: str | None, type: AuditType = AuditType.ADD) -> List[SON]:
+    return [
+        audit_collection(
+            type=type,
+            collection=Collections.MEMORY,
+            id=inserted_id,
+            user_id=user_id,
+            ip=ip
+        ).to_mongo() for inserted_id in ids
+    ]
+
 def create_memory(
   user_token: UserToken | None,
   session: ClientSession,
   col_audit: Collection, col_memory: Collection, # type: ignore
   data: DCreateMemory
-):
+) -> List[ObjectId]:
+  """
+  Returns:
+    ids of the inserted memories, one per chunk for a file
+  """
   res_insert = []
   if data.file != None:
     # inserted id array for file for each individual chunks
@@ -160,4 +334,5 @@ def create_memory(
         id=res_insert,
       ).to_mongo()
     )
-  col_audit.insert_many(audits, session=session) # type: ignore
\ No newline at end of file
+  col_audit.insert_many(audits, session=session) # type: ignore
+  return res_insert if isinstance(res_insert, list) else [ res_insert ]
@@ -1 +1 @@
-from .CreateMemory import create_memory, DCreateMemory
\ No newline at end of file
+from .CreateMemory import create_memory, discard_file, ingest_file, replaced_memories, spool_file, DCreateMemory
\ No newline at end of file
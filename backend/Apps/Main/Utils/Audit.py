@@ -11,25 +11,31 @@ def audit_collection(
     collection: Collections,
     id: ObjectId,
     from_data: dict | None = None,
-    to_data: dict | None = None
+    to_data: dict | None = None,
+    user_id: ObjectId | None = None,
+    ip: str | None = None
 ):
     """
     for AuditType `ADD` or `DELETE` keep `from_data` and `to_data` to None
+
+    `user_id` and `ip` are of the request unless given (outside of a request)
     """
 
-    user_id = None
-    try:
-        user_token = get_token()
-        if user_token != None:
-            user_id = get_object_id(user_token.id)
-    except Exception as _:
-        pass
+    if user_id == None and ip == None:
+        try:
+            user_token = get_token()
+            if user_token != None:
+                user_id = get_object_id(user_token.id)
+        except Exception as _:
+            pass
+    if ip == None:
+        ip = request.remote_addr if request.remote_addr != None else ""
     return Audit(
         type=type,
         user=user_id,
         data={
             "collection": collection.value,
-            "ip": request.remote_addr if request.remote_addr != None else "",
+            "ip": ip,
             "id": str(id),
             "from": from_data,
             "to": to_data
@@ -22,6 +22,7 @@ class Collections(Enum):
   USER = "user"
   AUDIT = "audit"
   MESSAGE = "message"
+  MESSAGE_EMBEDDING = "message_embedding"
   CONVERSATION = "conversation"
   MEMORY = "memory"
   OTP = "otp"
@@ -1,4 +1,7 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass
+from time import sleep
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -6,8 +9,9 @@ from urllib3.util.retry import Retry
 import json
 from backend.Lib.Logger import Logger
 from backend.Lib.Common import Prompt
-from backend.Lib.Config import ENCODER_SERVER, MODEL_SERVER, FILTER_SERVER
-from typing import Any, List
+from backend.Lib.Config import ENCODER_SERVER, MODEL_SERVER, FILTER_SERVER, EMBED_BATCH_SIZE, EMBED_CONCURRENCY, EMBED_RETRIES
+from backend.Lib.Metrics import DOWNSTREAM_DURATION, DOWNSTREAM_ERRORS
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
 
 @dataclass
 class Reply:
@@ -28,20 +32,22 @@ def classify_text(text: str) -> str:
       s.mount("http://", adapter)
       s.mount("https://", adapter)
 
-      response = s.post(
-          url=FILTER_SERVER,
-          data=json.dumps({
-              "context": [],
-              "prompt": asdict(Prompt(role="user", content=text))
-          }),
-          headers={ "Content-Type": "application/json" },
-          # timeout=10
-      )
+      with DOWNSTREAM_DURATION.time("filter"):
+        response = s.post(
+            url=FILTER_SERVER,
+            data=json.dumps({
+                "context": [],
+                "prompt": asdict(Prompt(role="user", content=text))
+            }),
+            headers={ "Content-Type": "application/json" },
+            # timeout=10
+        )
       response.raise_for_status()
       d = response.json()
 
       return d["reply"]
   except Exception as e:
+      DOWNSTREAM_ERRORS.inc("filter")
       Logger.log.error(repr(e))
       return ""
 
@@ -62,21 +68,23 @@ def generate_model_reply(
         s.mount("http://", adapter)
         s.mount("https://", adapter)
 
-        response = s.post(
-            url=MODEL_SERVER,
-            data=json.dumps({
-                "context": context,
-                "conversation_history": conversation_history,  # ← NEW
-                "prompt": asdict(prompt),
-                "overrides": overrides
-            }),
-            headers={ "Content-Type": "application/json" },
-        )
+        with DOWNSTREAM_DURATION.time("model"):
+          response = s.post(
+              url=MODEL_SERVER,
+              data=json.dumps({
+                  "context": context,
+                  "conversation_history": conversation_history,  # ← NEW
+                  "prompt": asdict(prompt),
+                  "overrides": overrides
+              }),
+              headers={ "Content-Type": "application/json" },
+          )
         response.raise_for_status()
         d = response.json()
 
         return d["reply"]
     except Exception as e:
+        DOWNSTREAM_ERRORS.inc("model")
         Logger.log.error(repr(e))
         return ""
 
@@ -92,18 +100,101 @@ def generate_embeddings(buffer: List[Any]) -> List[float]:
         s.mount("http://", adapter)
         s.mount("https://", adapter)
 
-        response = s.post(
-          url=ENCODER_SERVER,
-          data=json.dumps({
-              "data": buffer
-          }),
-          headers={ "Content-Type": "application/json" },
-          timeout=30
-        )
+        with DOWNSTREAM_DURATION.time("encoder"):
+          response = s.post(
+            url=ENCODER_SERVER,
+            data=json.dumps({
+                "data": buffer
+            }),
+            headers={ "Content-Type": "application/json" },
+            timeout=30
+          )
         response.raise_for_status()
         d = response.json()
         return d["embeddings"]
 
     except Exception as e:
+        DOWNSTREAM_ERRORS.inc("encoder")
         Logger.log.error(repr(e))
         return []
+
+def generate_embeddings_batch(buffer: List[str]) -> List[List[float]]:
+    """
+    Embeddings of each text of `buffer` in one encoder request
+
+    Throws:
+      when the request fails or does not return a vector per text
+    """
+    with requests.Session() as s:
+      with DOWNSTREAM_DURATION.time("encoder"):
+        response = s.post(
+          url=ENCODER_SERVER,
+          data=json.dumps({
+              "data": buffer,
+              "batch": True
+          }),
+          headers={ "Content-Type": "application/json" },
+          timeout=60
+        )
+      response.raise_for_status()
+      embeddings = response.json()["embeddings"]
+    if len(embeddings) != len(buffer):
+      raise Exception(f"encoder returned {len(embeddings)} vectors for {len(buffer)} texts")
+    return embeddings
+
+# process wide, the batches of concurrent files share the encoder requests
+_embedding_pool = ThreadPoolExecutor(max_workers=max(1, EMBED_CONCURRENCY), thread_name_prefix="embed-batch")
+
+def _embed_batch(batch: List[str]) -> List[List[float]]:
+    for attempt in range(EMBED_RETRIES + 1):
+      try:
+        return generate_embeddings_batch(batch)
+      except Exception as e:
+        DOWNSTREAM_ERRORS.inc("encoder")
+        if attempt == EMBED_RETRIES:
+          raise
+        Logger.log.warning(f"embedding batch of {len(batch)} failed, retrying: {repr(e)}")
+        sleep(0.5 * 2 ** attempt)
+    return []
+
+def embed_chunks(
+    chunks: Iterable[str],
+    batch_size: int = EMBED_BATCH_SIZE,
+    concurrency: int = EMBED_CONCURRENCY,
+    progress: Callable[[int], None] | None = None
+) -> Iterator[Tuple[str, List[float]]]:
+    """
+    `(chunk, embeddings)` of each chunk in order
+
+    Chunks are sent `batch_size` per encoder request with up to
+    `concurrency` requests in flight, reading `chunks` only as far as
+    needed. A failed request is retried `EMBED_RETRIES` times on its own.
+    `progress` is called with the number of chunks embedded after each
+    batch.
+
+    Throws:
+      when a batch still fails
+    """
+    pending = deque()
+    done = 0
+    it = iter(chunks)
+    try:
+      while True:
+        while len(pending) < max(1, concurrency):
+          batch = [ c for _, c in zip(range(max(1, batch_size)), it) ]
+          if len(batch) == 0:
+            break
+          pending.append((batch, _embedding_pool.submit(_embed_batch, batch)))
+        if len(pending) == 0:
+          return
+
+        batch, future = pending.popleft()
+        embeddings = future.result()
+        done += len(batch)
+        Logger.log.info(f"embedded {done} chunks")
+        if progress != None:
+          progress(done)
+        yield from zip(batch, embeddings)
+    finally:
+      for _, future in pending:
+        future.cancel()
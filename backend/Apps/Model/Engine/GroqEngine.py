@@ -1,4 +1,5 @@
 from dataclasses import asdict
+from backend.Lib.Cancellation import Cancellation
 from backend.Lib.Common import Prompt
 from backend.Lib.Logger import Logger
 from .Base import LLMEngine
@@ -148,8 +149,12 @@ SAFETY GUIDELINES:
             }
         }
 
-    def generate_stream(self, query: List[Prompt], overrides: dict = {}):
-        '''Streaming version that yields chunks as they arrive from Groq'''
+    def generate_stream(self, query: List[Prompt], overrides: dict = {}, cancel: Cancellation | None = None):
+        '''
+        Streaming version that yields chunks as they arrive from Groq.
+        `cancel` or closing the generator aborts the request to Groq
+        '''
+        stream = None
         try:
             agent_type = overrides.get("agent", "professor")
             agent = self.agents.get(agent_type, self.agents['professor'])
@@ -182,6 +187,9 @@ SAFETY GUIDELINES:
             
             Logger.log.info(f"📨 Streaming {len(messages)} messages to Groq")
             
+            if cancel != None and cancel.is_cancelled:
+                return
+
             # ✅ Enable streaming in Groq API
             stream = self.client.chat.completions.create(
                 model=self.model,
@@ -191,6 +199,9 @@ SAFETY GUIDELINES:
                 top_p=overrides.get("top_p", 0.9),
                 stream=True  # ✅ This enables streaming
             )
+            if cancel != None:
+                # closes the connection, the read below fails at once
+                cancel.on_cancel(stream.close)
             
             # Yield chunks as they arrive
             for chunk in stream:
@@ -200,9 +211,15 @@ SAFETY GUIDELINES:
             Logger.log.info(f"✅ {agent['name']} streaming complete")
             
         except Exception as e:
+            if cancel != None and cancel.is_cancelled:
+                Logger.log.info(f"🛑 {agent['name']} streaming cancelled")
+                return
             Logger.log.error(f"Groq streaming error: {str(e)}")
             Logger.log.error(traceback.format_exc())
             yield "I apologize, but I encountered an error. Please try again."
+        finally:
+            if stream != None:
+                stream.close()
     
     def generate(self, query: List[Prompt], overrides: dict = {}) -> str:
         try:
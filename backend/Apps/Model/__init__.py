@@ -6,6 +6,7 @@ from backend.Apps.Model.Engine import DeepSeekV3, DistilGPT2, LLMEngine, LLamaSe
 from backend.Lib.Common import Prompt
 from backend.Lib.Logger import Logger
 from backend.Lib.Config import AI_MODEL, FILTER_MODE, MAIN_SERVER
+from backend.Lib.Metrics import REGISTRY, register_metrics
 from dataclasses import dataclass, field
 import traceback
 
@@ -21,6 +22,10 @@ CORS(
       }
   },
 )
+register_metrics(app)
+
+MODEL_QUEUE_DEPTH = REGISTRY.gauge("model_queue_depth", "Generate calls waiting on or running in the engine")
+MODEL_GENERATE_DURATION = REGISTRY.histogram("model_generate_duration_seconds", "Engine generate time", ("engine",))
 
 CHAT_TEMPLATE = {}
 class Model:
@@ -50,7 +55,8 @@ class Model:
     
     @classmethod
     def generate(cls, query: List[Prompt], overrides: dict = {}) -> str:
-        return cls._engine.generate(query, overrides)
+        with MODEL_QUEUE_DEPTH.track(), MODEL_GENERATE_DURATION.time(cls._engine.__class__.__name__):
+            return cls._engine.generate(query, overrides)
 
 @dataclass
 class GenerateReplyBody:
@@ -0,0 +1,163 @@
+"""
+Latency of storing a chat turn, `CHAT_COMMIT=transaction` vs `bulk`
+
+Runs `create_chat` inside a `Transaction` and `commit_chat` (unordered
+inserts keyed by an idempotency key) in process against `--mongo`, the
+same turns for both modes: `--clients` conversations of `--turns` turns
+each at every `--concurrency` level. Audits go through the audit log
+configured by the environment (write behind by default) for `bulk` and
+inside the transaction for `transaction`, as in `/ai/chat`.
+
+Reported per mode and level: p50/p95/p99 commit latency, commits/s, the
+turns that read back out of order (reply before prompt, should be 0) and,
+for `bulk`, the documents added when every turn is committed again with
+its key (should be 0).
+
+Transactions need a replica set, run against a scratch one for
+meaningful numbers (writes to its `CyberSync` db)
+  docker run -d -p 27017:27017 mongo:7 --replSet rs0 && docker exec <id> mongosh --eval "rs.initiate()"
+  python -m backend.Bench.ChatCommit --mongo "mongodb://localhost:27017/?replicaSet=rs0&directConnection=true"
+With `--mongo memory` (mongomock) the transaction is a no-op.
+"""
+import argparse
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import List, Tuple
+
+from backend.Lib.Timing import percentile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@dataclass
+class Result:
+  mode: str
+  concurrency: int
+  commits: int
+  p50_ms: float
+  p95_ms: float
+  p99_ms: float
+  commits_per_sec: float
+  retry_duplicates: int
+  misordered: int
+
+def _env(mongo: str):
+  for k, v in {
+    "AI_MODEL": "groq",
+    "GROQ_API_KEY": "bench",
+    "SENTENCE_TRANSFORMER_MODEL": "bench",
+    "PIPE_CONFIG": os.path.join(REPO_DIR, "pipe_config.json"),
+    "TOKENIZER_CONFIG": os.path.join(REPO_DIR, "tokenizer_config.json"),
+    "JWT_SECRET": uuid.uuid4().hex,
+    "DATABASE_TLS": "0",
+    "VECTOR_SEARCH": "exact",
+  }.items():
+    os.environ.setdefault(k, v)
+  os.environ["CyberSync_DatabaseUri"] = "mongodb://localhost/CyberSync" if mongo == "memory" else mongo
+
+def _commit(app, mode: str, user, conversation: str | None, prompt: str, key: str) -> Tuple[float, str]:
+  from backend.Apps.Main.Database import Transaction
+  from backend.Apps.Main.Service import commit_chat, create_chat
+  from backend.Apps.Main.Utils import Collections
+  from backend.Apps.Main.Utils.LLM import Reply
+  from backend.Lib.Common import Prompt
+
+  with app.test_request_context():
+    body = Prompt(role="user", content=prompt)
+    reply = Reply(reply=f"reply to {prompt} " * 20, embeddings=[], prompt=body)
+    start = perf_counter()
+    if mode == "transaction":
+      with Transaction() as (session, db):
+        conv_id, _, _ = create_chat(
+          session,
+          db.get_collection(Collections.AUDIT.value),
+          db.get_collection(Collections.CONVERSATION.value),
+          db.get_collection(Collections.MESSAGE.value),
+          reply, prompt[:20], conversation, body, user
+        )
+    else:
+      conv_id, _, _, _ = commit_chat(reply, prompt[:20], conversation, body, user, key)
+    return (perf_counter() - start) * 1000, str(conv_id)
+
+def run_level(app, mode: str, concurrency: int, args) -> Result:
+  from backend.Apps.Main.Database import Conversation, Message
+  from backend.Apps.Main.Utils import UserToken
+
+  user = UserToken(None)
+  user.id = uuid.uuid4().hex[:24]
+  user.username = "bench"
+
+  def client(i: int) -> List[Tuple[float, str, str | None, str]]:
+    conversation, done = None, []
+    for turn in range(args.turns):
+      key = f"{i}-{turn}"
+      latency, conv_id = _commit(app, mode, user, conversation, f"prompt {i} {turn}", key)
+      done.append((latency, key, conversation, f"prompt {i} {turn}", conv_id))
+      conversation = conv_id
+    return done
+
+  start = perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    turns = [ t for c in pool.map(client, range(args.clients)) for t in c ]
+  wall = perf_counter() - start
+
+  duplicates = 0
+  if mode == "bulk":
+    before = Message.objects.count() + Conversation.objects.count() # type: ignore
+    for _, key, conversation, prompt, _ in turns:
+      _commit(app, mode, user, conversation, prompt, key)
+    duplicates = Message.objects.count() + Conversation.objects.count() - before # type: ignore
+
+  # read back like /conversation/get, prompts and replies alternate
+  misordered = 0
+  for conv_id in set([ t[4] for t in turns ]):
+    senders = [ m.get("sender") for m in Message.objects(conversation=conv_id).order_by("created_at", "position", "id").as_pymongo() ] # type: ignore
+    misordered += sum([ 1 for i in range(0, len(senders), 2) if senders[i] == None or senders[i + 1 : i + 2] != [ None ] ])
+
+  latencies = sorted([ t[0] for t in turns ])
+  return Result(
+    mode, concurrency, len(turns),
+    round(percentile(latencies, 50), 2), round(percentile(latencies, 95), 2), round(percentile(latencies, 99), 2),
+    round(len(turns) / wall, 1), duplicates, misordered
+  )
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--mongo", default="memory", help="`memory` (mongomock) or a mongodb uri of a replica set")
+  parser.add_argument("--modes", default="transaction,bulk")
+  parser.add_argument("--concurrency", default="1,16")
+  parser.add_argument("--clients", type=int, default=32, help="conversations per level")
+  parser.add_argument("--turns", type=int, default=8, help="turns per conversation")
+  parser.add_argument("--json", default="", help="write results to this file")
+  args = parser.parse_args()
+
+  _env(args.mongo)
+  if args.mongo == "memory":
+    from backend.Bench.ChatLoad import _use_in_memory_mongo
+    _use_in_memory_mongo()
+  from backend.Apps.Main import app
+  from backend.Apps.Main.AuditLog import get_audit_log
+
+  results: List[Result] = []
+  for mode in args.modes.split(","):
+    for level in [ int(i) for i in args.concurrency.split(",") ]:
+      r = run_level(app, mode, level, args)
+      results.append(r)
+      print(json.dumps(asdict(r)), flush=True)
+  with app.app_context():
+    get_audit_log().close()
+
+  print()
+  print(f"{'mode':<12} {'conc':>5} {'commits':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'commits/s':>10} {'dups':>5} {'order':>5}")
+  for r in results:
+    print(f"{r.mode:<12} {r.concurrency:>5} {r.commits:>8} {r.p50_ms:>8} {r.p95_ms:>8} {r.p99_ms:>8} {r.commits_per_sec:>10} {r.retry_duplicates:>5} {r.misordered:>5}")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
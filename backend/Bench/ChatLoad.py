@@ -0,0 +1,484 @@
+"""
+End to end load test of `/api/ai/chat` and `/api/ai/chat-stream`
+
+Starts the stub encoder and model of `backend.Bench.Stubs` and Main on the
+greenlet server (`backend.Serve`) pointed at them, seeds a user and
+`--memories` memories, then replays the prompts of `--corpus` at each
+`--concurrency` level. Clients are closed loop, each sends its next prompt
+when the previous reply is done and continues its conversation for `--turns`
+prompts.
+
+Reported per endpoint and level: p50/p95/p99 latency (stream: until `done`),
+time to first content event for streams, requests/s, tokens/s, content
+frames per streamed reply and the p95 of the server side stages
+(`Server-Timing` / the `timing` event).
+
+`--stop-after N` closes every other stream after N content frames, like
+the stop button of the UI, and prints the cancellation counters of Main's
+`/metrics` at the end.
+
+Redis
+  --redis memory           fakeredis inside the Main process (pip install fakeredis)
+  --redis host:port        a local redis
+
+Mongo
+  --mongo memory           mongomock inside the Main process (pip install mongomock).
+                           Transactions are no-ops
+  --mongo mongodb://...    a scratch local mongod, a replica set for transactions
+                           (writes to its `CyberSync` db)
+  `$vectorSearch` is Atlas only, `--vector-search` picks exact (default), memory or hnsw
+
+Corpus
+  jsonl, the first of `prompt`, `content`, `text`, `title`, `body` of each line,
+  or plain text with one prompt per line
+
+Usage
+  python -m backend.Bench.ChatLoad --corpus requests.jsonl --concurrency 1,16,64 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
+
+from backend.Bench.StreamCapacity import _free_port, _raise_nofile_limit, _wait_port
+from backend.Lib.Timing import percentile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_CORPUS = [
+  "What is SQL injection and how do prepared statements prevent it?",
+  "Explain the difference between symmetric and asymmetric encryption.",
+  "How does a cross site scripting attack steal session cookies?",
+  "What is the principle of least privilege?",
+  "How do I use nmap to find open ports on my own lab machine?",
+  "What is a buffer overflow and why are stack canaries used?",
+  "Explain how TLS certificates are validated by a browser.",
+  "What is the difference between hashing and encryption for passwords?",
+  "How does a man in the middle attack work on public wifi?",
+  "What are common indicators of a phishing email?",
+]
+
+def load_corpus(path: str) -> List[str]:
+  if len(path) == 0:
+    return list(DEFAULT_CORPUS)
+
+  prompts = []
+  with open(path, encoding="utf-8") as f:
+    for line in f:
+      line = line.strip()
+      if len(line) == 0:
+        continue
+      try:
+        item = json.loads(line)
+      except json.JSONDecodeError:
+        prompts.append(line)
+        continue
+      if isinstance(item, dict):
+        for key in ("prompt", "content", "text", "title", "body"):
+          if isinstance(item.get(key), str) and len(item[key]) > 0:
+            prompts.append(item[key])
+            break
+      elif isinstance(item, str):
+        prompts.append(item)
+  if len(prompts) == 0:
+    raise ValueError(f"no prompts in {path}")
+  return prompts
+
+# ============ Main ============
+def _use_in_memory_mongo():
+  import mongoengine
+  import mongomock
+  import mongomock.gridfs
+
+  class _NoTransaction:
+    """
+    mongomock has no sessions, `Transaction` writes go straight to the collections
+    """
+    def start_transaction(self): pass
+    def commit_transaction(self): pass
+    def abort_transaction(self): pass
+    def end_session(self): pass
+    # mongomock rejects a truthy `session=`
+    def __bool__(self): return False
+
+  mongomock.MongoClient.start_session = lambda self, *args, **kwargs: _NoTransaction() # type: ignore
+  # mongomock's bulk_write does not take the `sort` of pymongo's UpdateOne
+  from pymongo import UpdateOne
+  bulk_write = mongomock.collection.Collection.bulk_write
+  def _bulk_write(self, requests, *args, **kwargs):
+    if not all([ isinstance(r, UpdateOne) for r in requests ]):
+      return bulk_write(self, requests, *args, **kwargs)
+    for r in requests:
+      self.update_one(r._filter, r._doc, upsert=r._upsert)
+  mongomock.collection.Collection.bulk_write = _bulk_write # type: ignore
+  # memory uploads go to GridFS
+  mongomock.gridfs.enable_gridfs_integration()
+
+  connect = mongoengine.connect
+  def _connect(*args, **kwargs):
+    kwargs["mongo_client_class"] = mongomock.MongoClient
+    return connect(*args, **kwargs)
+  mongoengine.connect = _connect
+
+def _use_in_memory_redis():
+  import fakeredis
+  import redis
+
+  server = fakeredis.FakeServer()
+  class _Redis(fakeredis.FakeRedis):
+    def __init__(self, *args, **kwargs):
+      for k in ("host", "port", "socket_timeout", "socket_connect_timeout"):
+        kwargs.pop(k, None)
+      super().__init__(*args, server=server, **kwargs)
+  redis.Redis = _Redis # type: ignore
+
+def _seed(corpus: List[str], memories: int, dim: int) -> Dict[str, str]:
+  from flask_jwt_extended import create_access_token, get_csrf_token
+  from backend.Apps.Main.Database import Memory, User
+  from backend.Apps.Main.Retrieval import get_retrieval
+  from backend.Apps.Main.Utils.Enum import Role
+  from backend.Bench.Stubs import embed
+  from backend.Lib.ContextPacker import estimate_tokens
+
+  user = User.objects(username="loadtest").first() # type: ignore
+  if user == None:
+    user = User(email="loadtest@example.com", username="loadtest", password="LoadTest123!", role=Role.USER)
+    user.hash_password()
+    user.save(validate=False)
+
+  memory_ids = [ i.id for i in Memory.objects(tags="loadtest").only("id") ] # type: ignore
+  Memory.objects(tags="loadtest").delete() # type: ignore
+  docs = []
+  for i in range(memories):
+    text = corpus[i % len(corpus)]
+    docs.append(Memory(title=f"loadtest {i}", text=text, token_count=estimate_tokens(text), tags=["loadtest"], embeddings=embed(text, dim)).to_mongo())
+  if len(docs) > 0:
+    memory_ids.extend(Memory._get_collection().insert_many(docs).inserted_ids) # type: ignore
+  # same as the memory routes, for the in process indexes
+  get_retrieval().sync_memories(memory_ids)
+
+  token = create_access_token(
+    identity=str(user.id),
+    additional_claims={
+      "aud": Role.USER.value,
+      "id": str(user.id),
+      "email": user.email,
+      "username": user.username,
+      "is_active": True,
+    },
+  )
+  return { "token": token, "csrf": get_csrf_token(token) }
+
+def _serve_main(args):
+  from gevent import monkey
+  monkey.patch_all()
+  if args.mongo == "memory":
+    _use_in_memory_mongo()
+  if args.redis == "memory":
+    _use_in_memory_redis()
+
+  from backend.Serve import serve
+  from backend.Apps.Main import app
+
+  with app.app_context():
+    auth = _seed(load_corpus(args.corpus), args.memories, args.dim)
+  with open(args.auth_file, "w") as f:
+    json.dump(auth, f)
+  serve()
+
+# ============ Client ============
+@dataclass
+class Result:
+  ok: bool
+  latency_ms: float
+  ttft_ms: float = 0.0
+  tokens: int = 0
+  frames: int = 0
+  stopped: bool = False
+  conversation: str = ""
+  stages: Dict[str, float] = field(default_factory=dict)
+
+@dataclass
+class LevelResult:
+  endpoint: str
+  concurrency: int
+  requests: int
+  ok: int
+  failed: int
+  p50_ms: float
+  p95_ms: float
+  p99_ms: float
+  ttft_p50_ms: float
+  ttft_p95_ms: float
+  ttft_p99_ms: float
+  rps: float
+  tokens_per_sec: float
+  frames_per_reply: float
+  wall_s: float
+  stages_p95_ms: Dict[str, float]
+
+_OBJECT_ID = re.compile(r"[0-9a-f]{24}")
+
+def _multipart(fields: Dict[str, str]) -> Tuple[bytes, str]:
+  boundary = uuid.uuid4().hex
+  body = ""
+  for k, v in fields.items():
+    body += f"--{boundary}\r\nContent-Disposition: form-data; name=\"{k}\"\r\n\r\n{v}\r\n"
+  body += f"--{boundary}--\r\n"
+  return body.encode(), f"multipart/form-data; boundary={boundary}"
+
+def _parse_server_timing(value: str) -> Dict[str, float]:
+  out = {}
+  for item in value.split(","):
+    name, _, dur = item.strip().partition(";dur=")
+    try:
+      out[name] = float(dur)
+    except ValueError:
+      pass
+  return out
+
+async def _chat(port: int, endpoint: str, auth: Dict[str, str], prompt: str, conversation: str, timeout: float, stop_after: int = 0) -> Result:
+  body, content_type = _multipart({ "content": prompt, "conversation": conversation })
+  head = (
+    f"POST /api/ai/{endpoint} HTTP/1.1\r\n"
+    "Host: loadtest\r\n"
+    "Connection: close\r\n"
+    f"Content-Type: {content_type}\r\n"
+    f"Content-Length: {len(body)}\r\n"
+    f"Cookie: access_token_cookie={auth['token']}\r\n"
+    f"X-CSRF-TOKEN: {auth['csrf']}\r\n"
+    "\r\n"
+  )
+
+  start = time.perf_counter()
+  reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+  try:
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+    status = int((await asyncio.wait_for(reader.readline(), timeout)).split()[1])
+    headers = {}
+    while True:
+      line = (await asyncio.wait_for(reader.readline(), timeout)).decode().strip()
+      if len(line) == 0:
+        break
+      k, _, v = line.partition(":")
+      headers[k.strip().lower()] = v.strip()
+
+    if endpoint == "chat":
+      data = json.loads(await asyncio.wait_for(reader.read(), timeout))
+      return Result(
+        ok=status == 200,
+        latency_ms=(time.perf_counter() - start) * 1000,
+        conversation=str(data.get("conversation") or ""),
+        stages=_parse_server_timing(headers.get("server-timing", ""))
+      )
+
+    res = Result(ok=False, latency_ms=0)
+    while True:
+      line = await asyncio.wait_for(reader.readline(), timeout)
+      if not line:
+        break
+      # chunked transfer, the size lines are skipped
+      if not line.startswith(b"data:"):
+        continue
+      event = json.loads(line[5:])
+      if event["type"] == "content":
+        if res.frames == 0:
+          res.ttft_ms = (time.perf_counter() - start) * 1000
+        res.frames += 1
+        # a stub model token is a word
+        res.tokens += len(event["content"].split())
+        if stop_after > 0 and res.frames >= stop_after:
+          res.ok = status == 200
+          res.stopped = True
+          break
+      elif event["type"] == "timing":
+        res.stages = event["timings"]
+      elif event["type"] == "done":
+        res.ok = status == 200
+        res.conversation = str(event.get("conversation") or "")
+      elif event["type"] == "error":
+        break
+    res.latency_ms = (time.perf_counter() - start) * 1000
+    return res
+  finally:
+    writer.close()
+
+async def _run_level(port: int, endpoint: str, auth: Dict[str, str], corpus: List[str], concurrency: int, requests: int, args) -> Tuple[List[Result], float]:
+  results: List[Result] = []
+  sent = 0
+
+  async def client():
+    nonlocal sent
+    conversation = ""
+    turn = 0
+    while sent < requests:
+      prompt = corpus[sent % len(corpus)]
+      sent += 1
+      if turn % args.turns == 0:
+        conversation = ""
+      turn += 1
+      stop_after = args.stop_after if endpoint == "chat-stream" and sent % 2 == 0 else 0
+      try:
+        res = await _chat(port, endpoint, auth, prompt, conversation, args.timeout, stop_after)
+      except Exception:
+        res = Result(ok=False, latency_ms=0)
+      results.append(res)
+      conversation = res.conversation if _OBJECT_ID.fullmatch(res.conversation) else ""
+
+  start = time.perf_counter()
+  await asyncio.gather(*[ client() for _ in range(concurrency) ])
+  return results, time.perf_counter() - start
+
+def _summarize(endpoint: str, concurrency: int, results: List[Result], wall: float) -> LevelResult:
+  ok = [ r for r in results if r.ok ]
+  latency = sorted([ r.latency_ms for r in ok ])
+  ttft = sorted([ r.ttft_ms for r in ok if r.frames > 0 ])
+  stages: Dict[str, List[float]] = {}
+  for r in ok:
+    for k, v in r.stages.items():
+      stages.setdefault(k, []).append(v)
+
+  return LevelResult(
+    endpoint=endpoint,
+    concurrency=concurrency,
+    requests=len(results),
+    ok=len(ok),
+    failed=len(results) - len(ok),
+    p50_ms=round(percentile(latency, 50), 1),
+    p95_ms=round(percentile(latency, 95), 1),
+    p99_ms=round(percentile(latency, 99), 1),
+    ttft_p50_ms=round(percentile(ttft, 50), 1),
+    ttft_p95_ms=round(percentile(ttft, 95), 1),
+    ttft_p99_ms=round(percentile(ttft, 99), 1),
+    rps=round(len(ok) / wall, 2),
+    tokens_per_sec=round(sum([ r.tokens for r in ok ]) / wall, 1),
+    frames_per_reply=round(sum([ r.frames for r in ok ]) / max(1, len(ok)), 1),
+    wall_s=round(wall, 2),
+    stages_p95_ms={ k: round(percentile(sorted(v), 95), 1) for k, v in stages.items() }
+  )
+
+def _spawn(name: str, argv: List[str], env: dict, cwd: str):
+  with open(os.path.join(cwd, f"{name}.out"), "w") as out:
+    return subprocess.Popen([ sys.executable, *argv ], env=env, cwd=cwd, stdout=out, stderr=subprocess.STDOUT)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--corpus", default="", help="jsonl or text file, default: built-in prompts")
+  parser.add_argument("--endpoints", default="chat,chat-stream")
+  parser.add_argument("--concurrency", default="1,8,32")
+  parser.add_argument("--requests", type=int, default=100, help="requests per endpoint and level")
+  parser.add_argument("--warmup", type=int, default=4, help="requests per endpoint before measuring")
+  parser.add_argument("--turns", type=int, default=3, help="prompts per conversation")
+  parser.add_argument("--mongo", default="memory", help="`memory` or a mongodb uri")
+  parser.add_argument("--redis", default="memory", help="`memory` or host:port")
+  parser.add_argument("--vector-search", default="exact", choices=["exact", "memory", "hnsw"], help="VECTOR_SEARCH of Main")
+  parser.add_argument("--memories", type=int, default=1000, help="memories to seed")
+  parser.add_argument("--dim", type=int, default=384, help="embedding size")
+  parser.add_argument("--encode-ms", type=float, default=5)
+  parser.add_argument("--ttft-ms", type=float, default=300)
+  parser.add_argument("--tokens-per-sec", type=float, default=60)
+  parser.add_argument("--tokens", type=int, default=120, help="tokens per reply")
+  parser.add_argument("--timeout", type=float, default=120)
+  parser.add_argument("--stop-after", type=int, default=0, help="close every other stream after this many content frames")
+  parser.add_argument("--json", default="", help="write results to this file")
+  parser.add_argument("--serve-main", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--auth-file", default="", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.serve_main:
+    _serve_main(args)
+    return
+
+  _raise_nofile_limit()
+  corpus = load_corpus(args.corpus)
+  encoder_port, model_port, main_port = _free_port(), _free_port(), _free_port()
+  # Main writes log/ and reads .env from its cwd
+  workdir = tempfile.mkdtemp(prefix="cedrik-loadtest-")
+  print(f"servers output in {workdir}", flush=True)
+  auth_file = os.path.join(workdir, "auth.json")
+
+  env = dict(os.environ)
+  env.update({
+    "PYTHONPATH": os.pathsep.join([ REPO_DIR, env.get("PYTHONPATH", "") ]),
+    "AI_MODEL": "groq",
+    "GROQ_API_KEY": "loadtest",
+    "GROQ_BASE_URL": f"http://127.0.0.1:{model_port}",
+    "SENTENCE_TRANSFORMER_MODEL": "loadtest",
+    "PIPE_CONFIG": os.path.join(REPO_DIR, "pipe_config.json"),
+    "TOKENIZER_CONFIG": os.path.join(REPO_DIR, "tokenizer_config.json"),
+    "JWT_SECRET": uuid.uuid4().hex,
+    "CyberSync_DatabaseUri": "mongodb://localhost/CyberSync" if args.mongo == "memory" else args.mongo,
+    "DATABASE_TLS": "0",
+    "VECTOR_SEARCH": args.vector_search,
+    "SERVER_ENCODER": f"http://127.0.0.1:{encoder_port}/encode",
+    "SERVER_MODEL": f"http://127.0.0.1:{model_port}/generate-reply",
+    "SERVER_FILTER": f"http://127.0.0.1:{model_port}/filter",
+    "FLASK_RUN_HOST": "127.0.0.1",
+    "FLASK_RUN_PORT": str(main_port),
+  })
+  # one user sends every prompt, the per user rate limit is off unless set
+  env.setdefault("CHAT_RATE_PER_MIN", "0")
+  if args.redis != "memory":
+    env["REDIS_HOST"], _, port = args.redis.partition(":")
+    env["REDIS_PORT"] = port or "6379"
+  if args.corpus:
+    args.corpus = os.path.abspath(args.corpus)
+
+  procs = [
+    _spawn("encoder", [ "-m", "backend.Bench.Stubs", "encoder", "--port", str(encoder_port), "--dim", str(args.dim), "--encode-ms", str(args.encode_ms) ], env, workdir),
+    _spawn("model", [ "-m", "backend.Bench.Stubs", "model", "--port", str(model_port), "--ttft-ms", str(args.ttft_ms), "--tokens-per-sec", str(args.tokens_per_sec), "--tokens", str(args.tokens) ], env, workdir),
+    _spawn("main", [ "-m", "backend.Bench.ChatLoad", "--serve-main", "--auth-file", auth_file, "--mongo", args.mongo, "--redis", args.redis, "--corpus", args.corpus, "--memories", str(args.memories), "--dim", str(args.dim) ], env, workdir),
+  ]
+  results: List[LevelResult] = []
+  cancelled: List[str] = []
+  try:
+    _wait_port(encoder_port, time.time() + 30)
+    _wait_port(model_port, time.time() + 30)
+    _wait_port(main_port, time.time() + 120)
+    with open(auth_file) as f:
+      auth = json.load(f)
+
+    for endpoint in args.endpoints.split(","):
+      asyncio.run(_run_level(main_port, endpoint, auth, corpus, 1, args.warmup, args))
+      for level in [ int(i) for i in args.concurrency.split(",") ]:
+        level_results, wall = asyncio.run(_run_level(main_port, endpoint, auth, corpus, level, args.requests, args))
+        results.append(_summarize(endpoint, level, level_results, wall))
+        print(json.dumps(asdict(results[-1])), flush=True)
+
+    if args.stop_after > 0:
+      with urllib.request.urlopen(f"http://127.0.0.1:{main_port}/metrics", timeout=10) as res:
+        cancelled = [ i for i in res.read().decode().splitlines() if re.match(r"(chat_replies|chat_reply_tokens|generation_tokens_saved)_total", i) ]
+  finally:
+    for p in procs:
+      p.terminate()
+    for p in procs:
+      p.wait(10)
+
+  print()
+  print(f"{'endpoint':<12} {'conc':>5} {'ok':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'ttft p95':>9} {'req/s':>7} {'tok/s':>8} {'frames':>7}")
+  for r in results:
+    print(f"{r.endpoint:<12} {r.concurrency:>5} {r.ok:>6} {r.p50_ms:>8} {r.p95_ms:>8} {r.p99_ms:>8} {r.ttft_p95_ms:>9} {r.rps:>7} {r.tokens_per_sec:>8} {r.frames_per_reply:>7}")
+  print()
+  for r in results:
+    print(f"{r.endpoint} x{r.concurrency} stages p95: " + " ".join([ f"{k}={v}" for k, v in r.stages_p95_ms.items() ]))
+  if args.stop_after > 0:
+    print()
+    print("\n".join(cancelled))
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,372 @@
+"""
+Memory ingestion throughput per document type
+
+Each case (a document type and size, or a sample file) runs in its own
+process so peak RSS is per case. A case spools its file like an upload
+(`RAG/Spool.SpooledRequest`, on disk over `UPLOAD_SPOOL_BYTES`) and runs
+`Service/Memory/CreateMemory._file_memory` end to end with its stage timer
+(upload, buffer, extract, chunk, gridfs, embed, insert) then times the
+file's `Lib.FileSniff.sniff` and each `READERS` entry on the same file
+(`is_document:<Reader>` until one matches and `read:<Reader>`).
+
+Embeddings come from the stub encoder (`backend.Bench.Stubs`) unless
+`--encoder` is given, the database is mongomock unless `--mongo` is a uri.
+
+Reported per case: file and extracted text size, chunks, MB/s (file bytes
+over the `_file_memory` time), chunks/s, peak RSS and its growth over the
+process before the case, and the change against the baseline.
+
+Usage
+  python -m backend.Bench.Ingestion --types pdf,docx,pptx,txt --sizes 64K,256K,1M
+  python -m backend.Bench.Ingestion --samples ./samples --types ""
+  python -m backend.Bench.Ingestion --types pdf --sizes 4M --pdf-workers 1   # pages read serially
+  # after a change to _file_memory
+  python -m backend.Bench.Ingestion --save-baseline   # on the old code
+  python -m backend.Bench.Ingestion                   # on the new code, compared to the baseline
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from time import perf_counter
+from typing import Dict, List
+
+from backend.Bench.StreamCapacity import _free_port, _wait_port
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "ingestion.json")
+
+CONTENT_TYPES = {
+  "pdf": "application/pdf",
+  "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+  "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+  "txt": "text/plain",
+}
+
+# ============ Synthetic documents ============
+_WORDS = (
+  "access attack audit authentication authorization backdoor botnet breach buffer certificate cipher "
+  "credential cryptography defense encryption exploit firewall forensics hash honeypot incident injection "
+  "integrity intrusion kernel malware network overflow packet password patch payload phishing privilege "
+  "protocol ransomware recon rootkit sandbox scanner session shell signature spoofing threat token trojan "
+  "vulnerability worm the a of to and in is for on with by as that this from"
+).split()
+
+def _lines(size: int, seed: int = 1) -> List[str]:
+  """
+  ~80 character lines of words until `size` bytes
+  """
+  rng = random.Random(seed)
+  lines = []
+  total = 0
+  while total < size:
+    words = []
+    n = 0
+    while n < 80:
+      w = rng.choice(_WORDS)
+      words.append(w)
+      n += len(w) + 1
+    line = " ".join(words).capitalize() + "."
+    lines.append(line)
+    total += len(line) + 1
+  return lines
+
+def make_txt(size: int) -> bytes:
+  return "\n".join(_lines(size)).encode()
+
+def make_docx(size: int) -> bytes:
+  from docx import Document
+  doc = Document()
+  lines = _lines(size)
+  for i in range(0, len(lines), 5):
+    doc.add_paragraph(" ".join(lines[i:i + 5]))
+  out = io.BytesIO()
+  doc.save(out)
+  return out.getvalue()
+
+def make_pptx(size: int) -> bytes:
+  from pptx import Presentation
+  from pptx.util import Inches
+  prs = Presentation()
+  lines = _lines(size)
+  for i in range(0, len(lines), 20):
+    slide = prs.slides.add_slide(prs.slide_layouts[6])
+    box = slide.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(6))
+    box.text_frame.text = "\n".join(lines[i:i + 20])
+  out = io.BytesIO()
+  prs.save(out)
+  return out.getvalue()
+
+def make_pdf(size: int) -> bytes:
+  """
+  Uncompressed text pdf, 50 lines per page in Helvetica
+  """
+  lines = _lines(size)
+  pages = [ lines[i:i + 50] for i in range(0, len(lines), 50) ]
+  objs: Dict[int, bytes] = {
+    1: b"<< /Type /Catalog /Pages 2 0 R >>",
+    3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+  }
+  kids = []
+  n = 4
+  for page in pages:
+    stream = ("BT /F1 9 Tf 12 TL 30 810 Td " + " ".join([ f"({line}) '" for line in page ]) + " ET").encode("latin-1")
+    objs[n] = b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (n + 1)
+    objs[n + 1] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+    kids.append(n)
+    n += 2
+  objs[2] = b"<< /Type /Pages /Kids [" + " ".join([ f"{k} 0 R" for k in kids ]).encode() + b"] /Count %d >>" % len(kids)
+
+  out = bytearray(b"%PDF-1.4\n")
+  offsets = {}
+  for i in sorted(objs):
+    offsets[i] = len(out)
+    out += b"%d 0 obj\n" % i + objs[i] + b"\nendobj\n"
+  xref = len(out)
+  out += b"xref\n0 %d\n0000000000 65535 f \n" % n
+  for i in range(1, n):
+    out += b"%010d 00000 n \n" % offsets[i]
+  out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (n, xref)
+  return bytes(out)
+
+MAKERS = { "pdf": make_pdf, "docx": make_docx, "pptx": make_pptx, "txt": make_txt }
+
+def parse_size(v: str) -> int:
+  v = v.strip().upper()
+  for suffix, mul in (("K", 1024), ("M", 1024 * 1024)):
+    if v.endswith(suffix):
+      return int(float(v[:-1]) * mul)
+  return int(v)
+
+# ============ Case ============
+@dataclass
+class CaseResult:
+  case: str
+  file_mb: float
+  text_mb: float
+  chunks: int
+  seconds: float
+  mb_per_sec: float
+  chunks_per_sec: float
+  peak_rss_mb: float
+  rss_growth_mb: float
+  stages_ms: Dict[str, float] = field(default_factory=dict)
+
+def _rss_mb(key: str) -> float:
+  with open("/proc/self/status") as f:
+    for line in f:
+      if line.startswith(key):
+        return int(line.split()[1]) / 1024
+  return 0.0
+
+def run_case(case: str, mongo: str) -> CaseResult:
+  # like backend.Worker, the pdf pool is forked before the app starts its threads
+  from backend.Lib.Config import PDF_WORKERS
+  from backend.Lib.PdfPages import start_pool
+  start_pool(PDF_WORKERS)
+
+  if mongo == "memory":
+    from backend.Bench.ChatLoad import _use_in_memory_mongo
+    _use_in_memory_mongo()
+
+  from werkzeug.datastructures import FileStorage
+  from backend.Apps.Main.Database import Memory, db_connection_init
+  from backend.Apps.Main.RAG.Dataclass import FileInfo
+  from backend.Apps.Main.RAG.Reader import READERS
+  from backend.Apps.Main.RAG.Spool import spool
+  from backend.Lib.FileSniff import sniff
+  from backend.Apps.Main.Service.Memory.CreateMemory import DCreateMemory, _file_memory
+  from backend.Lib.Timing import StageTimer
+  db_connection_init()
+
+  kind, _, arg = case.partition(":")
+  if kind == "file":
+    path = arg
+    filename = os.path.basename(arg)
+  else:
+    filename = f"sample.{kind}"
+    # in the work directory of the run
+    path = os.path.abspath(filename)
+    with open(path, "wb") as f:
+      f.write(MAKERS[kind](parse_size(arg)))
+  file_size = os.path.getsize(path)
+  content_type = CONTENT_TYPES.get(filename.rsplit(".", 1)[-1].lower(), "application/octet-stream")
+
+  rss_before = _rss_mb("VmRSS:")
+  timer = StageTimer()
+  start = perf_counter()
+  # the upload as the app receives it (`SpooledRequest`)
+  with timer.stage("upload"), open(path, "rb") as f:
+    upload = spool(f)
+  ids = _file_memory(
+    DCreateMemory(title=filename, text="", tags=[], file=FileStorage(stream=upload, filename=filename, content_type=content_type)),
+    session=None, # type: ignore
+    col_memory=Memory._get_collection(), # type: ignore
+    timer=timer
+  )
+  seconds = perf_counter() - start
+  peak = _rss_mb("VmHWM:")
+  upload.close()
+
+  # each reader on its own, in `extract` order
+  stages = timer.as_dict()
+  text = ""
+  with open(path, "rb") as f:
+    file_info = FileInfo(filename=filename, stream=f, content_type=content_type)
+    t = perf_counter()
+    file_info.kind, file_info.encoding = sniff(f, filename, content_type)
+    stages["sniff"] = round((perf_counter() - t) * 1000, 1)
+    for reader in READERS:
+      t = perf_counter()
+      is_document = reader.is_document(file_info)
+      stages[f"is_document:{reader.__name__}"] = round((perf_counter() - t) * 1000, 1)
+      if is_document:
+        t = perf_counter()
+        text = reader.read(file_info)
+        stages[f"read:{reader.__name__}"] = round((perf_counter() - t) * 1000, 1)
+        break
+
+  Memory.objects(file_id=Memory.objects.with_id(ids[0]).file_id).delete() # type: ignore
+  return CaseResult(
+    case=case if kind != "file" else f"file:{filename}",
+    file_mb=round(file_size / 1024 / 1024, 3),
+    text_mb=round(len(text.encode()) / 1024 / 1024, 3),
+    chunks=len(ids),
+    seconds=round(seconds, 3),
+    mb_per_sec=round(file_size / 1024 / 1024 / seconds, 3),
+    chunks_per_sec=round(len(ids) / seconds, 1),
+    peak_rss_mb=round(peak, 1),
+    rss_growth_mb=round(peak - rss_before, 1),
+    stages_ms=stages
+  )
+
+# ============ Runner ============
+def _compare(result: CaseResult, baseline: Dict[str, dict]) -> str:
+  base = baseline.get(result.case)
+  if base == None:
+    return ""
+  def pct(new: float, old: float):
+    return f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+  return f"MB/s {pct(result.mb_per_sec, base['mb_per_sec'])} rss {pct(result.rss_growth_mb, base['rss_growth_mb'])}"
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--types", default="pdf,docx,pptx,txt", help="synthetic document types")
+  parser.add_argument("--sizes", default="64K,256K,1M", help="extracted text size of the synthetic documents")
+  parser.add_argument("--samples", default="", help="directory of sample files to add")
+  parser.add_argument("--mongo", default="memory", help="`memory` or a mongodb uri")
+  parser.add_argument("--encoder", default="", help="encoder url, default: stub encoder")
+  parser.add_argument("--encode-ms", type=float, default=2, help="stub encoder latency")
+  parser.add_argument("--encode-item-ms", type=float, default=1, help="stub encoder latency added per chunk of a request")
+  parser.add_argument("--pdf-workers", default="", help="processes reading pdf pages, default: PDF_WORKERS")
+  parser.add_argument("--baseline", default=BASELINE)
+  parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+  parser.add_argument("--json", default="", help="write results to this file")
+  parser.add_argument("--run-case", default="", help=argparse.SUPPRESS)
+  parser.add_argument("--result-file", default="", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run_case:
+    try:
+      result = asdict(run_case(args.run_case, args.mongo))
+    except Exception as e:
+      result = { "error": repr(e) }
+    with open(args.result_file, "w") as f:
+      json.dump(result, f)
+    return
+
+  cases = []
+  for kind in [ i for i in args.types.split(",") if i ]:
+    for size in args.sizes.split(","):
+      cases.append(f"{kind}:{size}")
+  if args.samples:
+    for name in sorted(os.listdir(args.samples)):
+      cases.append(f"file:{os.path.abspath(os.path.join(args.samples, name))}")
+
+  # Main writes log/ and reads .env from its cwd
+  workdir = tempfile.mkdtemp(prefix="cedrik-ingestion-")
+  print(f"output in {workdir}", flush=True)
+  env = dict(os.environ)
+  env.update({
+    "PYTHONPATH": os.pathsep.join([ REPO_DIR, env.get("PYTHONPATH", "") ]),
+    "AI_MODEL": "groq",
+    "GROQ_API_KEY": "bench",
+    "SENTENCE_TRANSFORMER_MODEL": "bench",
+    "PIPE_CONFIG": os.path.join(REPO_DIR, "pipe_config.json"),
+    "TOKENIZER_CONFIG": os.path.join(REPO_DIR, "tokenizer_config.json"),
+    "JWT_SECRET": uuid.uuid4().hex,
+    "CyberSync_DatabaseUri": "mongodb://localhost/CyberSync" if args.mongo == "memory" else args.mongo,
+    "DATABASE_TLS": "0",
+  })
+  if args.pdf_workers:
+    env["PDF_WORKERS"] = args.pdf_workers
+
+  encoder = None
+  if args.encoder:
+    env["SERVER_ENCODER"] = args.encoder
+  else:
+    port = _free_port()
+    env["SERVER_ENCODER"] = f"http://127.0.0.1:{port}/encode"
+    with open(os.path.join(workdir, "encoder.out"), "w") as out:
+      encoder = subprocess.Popen(
+        [ sys.executable, "-m", "backend.Bench.Stubs", "encoder", "--port", str(port), "--encode-ms", str(args.encode_ms), "--encode-item-ms", str(args.encode_item_ms) ],
+        env=env, cwd=workdir, stdout=out, stderr=subprocess.STDOUT
+      )
+    _wait_port(port, time.time() + 30)
+
+  results: List[CaseResult] = []
+  try:
+    for case in cases:
+      result_file = os.path.join(workdir, "result.json")
+      if os.path.exists(result_file):
+        os.remove(result_file)
+      with open(os.path.join(workdir, "case.out"), "a") as out:
+        subprocess.run(
+          [ sys.executable, "-m", "backend.Bench.Ingestion", "--run-case", case, "--result-file", result_file, "--mongo", args.mongo ],
+          env=env, cwd=workdir, stdout=out, stderr=subprocess.STDOUT
+        )
+      result = { "error": f"crashed, see {workdir}/case.out" }
+      if os.path.exists(result_file):
+        with open(result_file) as f:
+          result = json.load(f)
+      if "error" in result:
+        print(f"{case} failed: {result['error']}", flush=True)
+        continue
+      results.append(CaseResult(**result))
+      print(json.dumps(asdict(results[-1])), flush=True)
+  finally:
+    if encoder != None:
+      encoder.terminate()
+      encoder.wait(10)
+
+  baseline = {}
+  if not args.save_baseline and os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = { i["case"]: i for i in json.load(f) }
+
+  print()
+  print(f"{'case':<16} {'file MB':>8} {'chunks':>7} {'MB/s':>8} {'chunks/s':>9} {'peak MB':>8} {'+rss MB':>8}  vs baseline")
+  for r in results:
+    print(f"{r.case[:16]:<16} {r.file_mb:>8} {r.chunks:>7} {r.mb_per_sec:>8} {r.chunks_per_sec:>9} {r.peak_rss_mb:>8} {r.rss_growth_mb:>8}  {_compare(r, baseline)}")
+  print()
+  for r in results:
+    print(f"{r.case} stages ms: " + " ".join([ f"{k}={v}" for k, v in r.stages_ms.items() ]))
+
+  if args.save_baseline:
+    os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+    with open(args.baseline, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+    print(f"baseline written to {args.baseline}")
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,149 @@
+"""
+Conversation reads with the message embeddings inline vs in `message_embedding`
+
+Seeds one conversation of `--messages` messages twice, `inline` with the
+query embedding array on every user message (the layout before
+`message_embedding`) and `split` with the embeddings as float32 bytes in
+their own collection, then times the queries of
+  history   - `ChatContextService.query`, the last CHAT_CONTEXT_MESSAGES
+  get       - `/conversation/get/<id>`, every message oldest first
+  full      - whole documents of the conversation, what an unprojected
+              `Message.objects` load (e.g. `/ai/truncate-message` before) reads
+  delete    - `/conversation/delete/<id>`, timed once per layout
+
+Reported per layout and query: p50/p95 latency, bytes returned by the
+database and the stored size of the message collection(s). Projections
+are applied by mongod, so the latency gap of `history` and `get` comes
+from the smaller documents it reads, run with `--mongo` against a real
+mongod for meaningful numbers (mongomock otherwise).
+
+Usage
+  python -m backend.Bench.MessageReads --mongo mongodb://localhost:27017 --messages 2000
+"""
+import argparse
+import json
+import random
+import struct
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import List
+
+import bson
+from bson import ObjectId
+
+from backend.Lib.Timing import percentile
+
+@dataclass
+class Result:
+  layout: str
+  query: str
+  p50_ms: float
+  p95_ms: float
+  kb_read: float
+  stored_kb: float
+
+def seed(db, layout: str, messages: int, dim: int, words: int) -> ObjectId:
+  rng = random.Random(1)
+  conversation = ObjectId()
+  col_message, col_embedding = db[f"bench_{layout}_message"], db[f"bench_{layout}_message_embedding"]
+  col_message.drop()
+  col_embedding.drop()
+  col_message.create_index("conversation")
+  col_embedding.create_index("conversation")
+
+  docs, embeddings = [], []
+  for i in range(messages):
+    is_user = i % 2 == 0
+    doc = {
+      "_id": ObjectId(),
+      "sender": ObjectId() if is_user else None,
+      "conversation": conversation,
+      "text": " ".join([ "lorem" ] * rng.randint(words // 2, words)),
+      "created_at": i
+    }
+    vector = [ rng.uniform(-1, 1) for _ in range(dim) ]
+    if layout == "inline":
+      doc["embeddings"] = vector if is_user else []
+    elif is_user:
+      embeddings.append({ "_id": doc["_id"], "conversation": conversation, "embeddings": struct.pack(f"<{dim}f", *vector) })
+    docs.append(doc)
+  col_message.insert_many(docs)
+  if len(embeddings) > 0:
+    col_embedding.insert_many(embeddings)
+  return conversation
+
+def stored_kb(db, layout: str) -> float:
+  total = 0
+  for name in (f"bench_{layout}_message", f"bench_{layout}_message_embedding"):
+    total += sum([ len(bson.encode(i)) for i in db[name].find() ])
+  return total / 1024
+
+def measure(layout: str, query: str, fn, runs: int, stored: float) -> Result:
+  latencies, read = [], 0
+  for _ in range(runs):
+    start = perf_counter()
+    docs = fn()
+    latencies.append((perf_counter() - start) * 1000)
+    read += sum([ len(bson.encode(i)) for i in docs ])
+  latencies.sort()
+  return Result(layout, query, round(percentile(latencies, 50), 2), round(percentile(latencies, 95), 2), round(read / runs / 1024, 1), round(stored, 1))
+
+def run(db, layout: str, args) -> List[Result]:
+  conversation = seed(db, layout, args.messages, args.dim, args.words)
+  col_message = db[f"bench_{layout}_message"]
+  stored = stored_kb(db, layout)
+  results = [
+    measure(layout, "history", lambda: list(
+      col_message.find({ "conversation": conversation }, { "sender": 1, "text": 1 }).sort("created_at", -1).limit(args.history)
+    ), args.runs, stored),
+    measure(layout, "get", lambda: list(
+      col_message.find({ "conversation": conversation }, { "text": 1, "created_at": 1 }).sort("created_at", 1)
+    ), args.runs, stored),
+    measure(layout, "full", lambda: list(col_message.find({ "conversation": conversation })), args.runs, stored),
+  ]
+
+  def delete():
+    col_message.delete_many({ "conversation": conversation })
+    db[f"bench_{layout}_message_embedding"].delete_many({ "conversation": conversation })
+    return []
+  results.append(measure(layout, "delete", delete, 1, stored))
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--mongo", default="memory", help="`memory` (mongomock) or a mongodb uri")
+  parser.add_argument("--messages", type=int, default=2000, help="messages in the conversation")
+  parser.add_argument("--dim", type=int, default=384, help="embedding size")
+  parser.add_argument("--words", type=int, default=60, help="max words per message")
+  parser.add_argument("--history", type=int, default=10, help="CHAT_CONTEXT_MESSAGES")
+  parser.add_argument("--runs", type=int, default=30)
+  parser.add_argument("--json", default="", help="write results to this file")
+  args = parser.parse_args()
+
+  if args.mongo == "memory":
+    import mongomock
+    client = mongomock.MongoClient()
+  else:
+    from pymongo import MongoClient
+    client = MongoClient(args.mongo)
+  db = client["CyberSyncBench"]
+
+  results: List[Result] = []
+  for layout in ("inline", "split"):
+    for r in run(db, layout, args):
+      results.append(r)
+      print(json.dumps(asdict(r)), flush=True)
+    db[f"bench_{layout}_message"].drop()
+    db[f"bench_{layout}_message_embedding"].drop()
+
+  print()
+  print(f"{'layout':<8} {'query':<8} {'p50':>8} {'p95':>8} {'KB read':>9} {'stored KB':>10}")
+  for r in results:
+    print(f"{r.layout:<8} {r.query:<8} {r.p50_ms:>8} {r.p95_ms:>8} {r.kb_read:>9} {r.stored_kb:>10}")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,143 @@
+"""
+Chunks embedded when a memory is replaced by a file, and its checks
+
+Runs `Service/Memory/CreateMemory.ingest_file` in process against
+`--mongo`: a text file of `--size` bytes, then the same file edited (one
+paragraph changed, the last `--dropped` removed, `--added` bytes added)
+replacing it, then a text memory replaced by a file of the same text.
+
+Reported: chunks of the first file, chunks embedded and kept for the
+edited one, the removed chunks and the checks, all should be 0
+  missing_file   removed chunks whose file is gone (`/memory/restore` brings them back)
+  text_reused    chunks of the edited file that are a replaced text memory
+  text_live      text memories still live after being replaced by a file
+
+Embeddings come from the stub encoder (`backend.Bench.Stubs`) unless
+`--encoder` is given, the database is mongomock unless `--mongo` is a uri.
+
+Usage
+  python -m backend.Bench.Reingest --size 256K
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass
+
+from backend.Bench.Ingestion import _lines, parse_size
+from backend.Bench.StreamCapacity import _free_port, _wait_port
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@dataclass
+class Result:
+  chunks: int
+  embedded: int
+  kept: int
+  removed: int
+  missing_file: int
+  text_reused: int
+  text_live: int
+
+def _env(args):
+  for k, v in {
+    "AI_MODEL": "groq",
+    "GROQ_API_KEY": "bench",
+    "SENTENCE_TRANSFORMER_MODEL": "bench",
+    "PIPE_CONFIG": os.path.join(REPO_DIR, "pipe_config.json"),
+    "TOKENIZER_CONFIG": os.path.join(REPO_DIR, "tokenizer_config.json"),
+    "JWT_SECRET": uuid.uuid4().hex,
+    "DATABASE_TLS": "0",
+  }.items():
+    os.environ.setdefault(k, v)
+  os.environ["CyberSync_DatabaseUri"] = "mongodb://localhost/CyberSync" if args.mongo == "memory" else args.mongo
+
+def _text(lines) -> bytes:
+  return "\n\n".join(lines).encode()
+
+def run(args) -> Result:
+  from gridfs import GridFS
+  from mongoengine.connection import get_db
+  from werkzeug.datastructures import FileStorage
+  from backend.Apps.Main.Database import Memory, db_connection_init
+  from backend.Apps.Main.Service.Memory import DCreateMemory, ingest_file, spool_file
+  from backend.Apps.Main.Service.Memory.CreateMemory import _text_memory
+  db_connection_init()
+
+  def ingest(data: bytes, replaces=None):
+    file_id = spool_file(FileStorage(stream=io.BytesIO(data), filename="bench.txt", content_type="text/plain"))
+    return ingest_file(file_id, "bench", ["bench"], user_id=None, ip="", replaces=replaces)
+
+  lines = _lines(parse_size(args.size))
+  middle = len(lines) // 2
+  edited = lines[:middle] + [ "A paragraph that was not there before." ] + lines[middle + 1:len(lines) - args.dropped] + _lines(parse_size(args.added), seed=2)
+
+  first = ingest(_text(lines))
+  old_file_id = Memory.objects.with_id(first[0]).file_id # type: ignore
+  second = ingest(_text(edited), replaces=first[0])
+  removed = [ m for m in Memory.objects(file_id=old_file_id).only("id", "deleted_at") ] # type: ignore
+  missing_file = 0
+  if len(removed) > 0 and not GridFS(get_db()).exists(old_file_id):
+    missing_file = len(removed)
+
+  # the file is the text, its chunk has the same hash as the text memory
+  text = _lines(200, seed=3)
+  text_id = _text_memory(DCreateMemory(title="bench", text=text[0], tags=["bench"]), None, Memory._get_collection()) # type: ignore
+  chunks = ingest(_text(text[:1]), replaces=text_id)
+  replaced = Memory.objects.with_id(text_id) # type: ignore
+
+  return Result(
+    chunks=len(first),
+    embedded=len(set(second) - set(first)),
+    kept=len(set(second) & set(first)),
+    removed=len([ m for m in removed if m.deleted_at != None ]),
+    missing_file=missing_file,
+    text_reused=1 if text_id in chunks else 0,
+    text_live=1 if replaced.deleted_at == None else 0,
+  )
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--mongo", default="memory", help="`memory` (mongomock) or a mongodb uri")
+  parser.add_argument("--encoder", default="", help="encoder url, default: stub encoder")
+  parser.add_argument("--size", default="256K", help="text size of the first file")
+  parser.add_argument("--dropped", type=int, default=20, help="paragraphs removed at the end of the edited file")
+  parser.add_argument("--added", default="2K", help="text added at the end of the edited file")
+  parser.add_argument("--json", default="", help="write the result to this file")
+  args = parser.parse_args()
+
+  _env(args)
+  if args.mongo == "memory":
+    from backend.Bench.ChatLoad import _use_in_memory_mongo
+    _use_in_memory_mongo()
+
+  encoder = None
+  if args.encoder:
+    os.environ["SERVER_ENCODER"] = args.encoder
+  else:
+    port = _free_port()
+    os.environ["SERVER_ENCODER"] = f"http://127.0.0.1:{port}/encode"
+    encoder = subprocess.Popen(
+      [ sys.executable, "-m", "backend.Bench.Stubs", "encoder", "--port", str(port) ],
+      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _wait_port(port, time.time() + 30)
+
+  try:
+    result = run(args)
+  finally:
+    if encoder != None:
+      encoder.terminate()
+      encoder.wait(10)
+
+  print(json.dumps(asdict(result)))
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(asdict(result), f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,246 @@
+"""
+Concurrent SSE stream capacity of the serving modes
+
+Starts a server process that streams `--tokens` SSE frames per request with
+`--interval` seconds between them (a stand-in for the Groq stream behind
+`/api/ai/chat-stream`) and opens increasing numbers of concurrent streams.
+A stream is ok when it completes and its first frame arrives within
+`--ttfb-slo-ms`. Capacity is the highest level with >= 99% ok streams.
+One server process is bound to one core (GIL) so capacity is streams/core.
+
+Modes
+  threads   - fixed worker thread pool (uwsgi `--threads N`), the old behaviour
+  werkzeug  - thread per connection (`flask run`)
+  gevent    - greenlet per connection (`python -m backend.Serve`)
+
+Usage
+  python -m backend.Bench.StreamCapacity --modes threads,gevent --levels 50,200,1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import List
+
+def _raise_nofile_limit():
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# ============ Server ============
+def _create_app(tokens: int, interval: float):
+  from flask import Flask, Response, stream_with_context
+
+  app = Flask(__name__)
+
+  @app.route("/stream")
+  def stream():
+    def generate():
+      for _ in range(tokens):
+        time.sleep(interval)
+        yield f"data: {json.dumps({'type': 'content', 'content': 'token '})}\n\n"
+      yield f"data: {json.dumps({'type': 'done'})}\n\n"
+
+    return Response(
+      stream_with_context(generate()),
+      mimetype="text/event-stream",
+      headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" }
+    )
+
+  return app
+
+def _serve(mode: str, port: int, threads: int, tokens: int, interval: float):
+  _raise_nofile_limit()
+  if mode == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("127.0.0.1", port), _create_app(tokens, interval), spawn=Pool(100_000), backlog=4096, log=None).serve_forever()
+    return
+
+  from werkzeug.serving import BaseWSGIServer, make_server
+  # listen() backlog, read while the server is constructed
+  BaseWSGIServer.request_queue_size = 4096
+  app = _create_app(tokens, interval)
+  if mode == "werkzeug":
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+    return
+
+  from concurrent.futures import ThreadPoolExecutor
+  server = make_server("127.0.0.1", port, app, threaded=False)
+  pool = ThreadPoolExecutor(max_workers=threads)
+
+  def process_request(request, client_address):
+    def run():
+      try:
+        server.finish_request(request, client_address)
+      except Exception:
+        server.handle_error(request, client_address)
+      finally:
+        server.shutdown_request(request)
+    pool.submit(run)
+
+  server.process_request = process_request # type: ignore
+  server.serve_forever()
+
+# ============ Client ============
+@dataclass
+class LevelResult:
+  mode: str
+  concurrency: int
+  ok: int
+  failed: int
+  ttfb_p50_ms: float
+  ttfb_p95_ms: float
+  duration_p95_ms: float
+  wall_s: float
+  server_cpu_util: float
+  server_threads: int
+  server_rss_mb: float
+
+def percentile(values: List[float], p: float) -> float:
+  if len(values) == 0:
+    return 0.0
+  s = sorted(values)
+  k = min(len(s) - 1, max(0, int(round(p / 100 * (len(s) - 1)))))
+  return s[k]
+
+async def _one_stream(port: int, timeout: float):
+  start = time.perf_counter()
+  ttfb = None
+  reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+  try:
+    writer.write(b"GET /stream HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    done = False
+    while True:
+      line = await asyncio.wait_for(reader.readline(), timeout)
+      if not line:
+        break
+      if line.startswith(b"data:"):
+        if ttfb is None:
+          ttfb = time.perf_counter() - start
+        if b'"done"' in line:
+          done = True
+    return done, (ttfb or 0.0) * 1000, (time.perf_counter() - start) * 1000
+  finally:
+    writer.close()
+
+async def _run_level(port: int, concurrency: int, timeout: float):
+  results = await asyncio.gather(
+    *[ _one_stream(port, timeout) for _ in range(concurrency) ],
+    return_exceptions=True
+  )
+  return [ r for r in results if not isinstance(r, BaseException) ], concurrency
+
+def _proc_stat(pid: int):
+  with open(f"/proc/{pid}/stat") as f:
+    fields = f.read().rsplit(")", 1)[1].split()
+  cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+  threads = 0
+  rss_kb = 0
+  with open(f"/proc/{pid}/status") as f:
+    for line in f:
+      if line.startswith("Threads:"):
+        threads = int(line.split()[1])
+      elif line.startswith("VmHWM:"):
+        rss_kb = int(line.split()[1])
+  return cpu, threads, rss_kb / 1024
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+def _wait_port(port: int, deadline: float):
+  while time.time() < deadline:
+    try:
+      with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+        return
+    except OSError:
+      time.sleep(0.1)
+  raise TimeoutError(f"server on {port} did not start")
+
+def bench_mode(mode: str, levels: List[int], args) -> List[LevelResult]:
+  port = _free_port()
+  proc = subprocess.Popen([
+    sys.executable, "-m", "backend.Bench.StreamCapacity", "--serve", mode,
+    "--port", str(port), "--threads", str(args.threads),
+    "--tokens", str(args.tokens), "--interval", str(args.interval)
+  ])
+  out: List[LevelResult] = []
+  try:
+    _wait_port(port, time.time() + 15)
+    for level in levels:
+      cpu_before, _, _ = _proc_stat(proc.pid)
+      start = time.perf_counter()
+      results, _ = asyncio.run(_run_level(port, level, args.timeout))
+      wall = time.perf_counter() - start
+      cpu_after, threads, rss = _proc_stat(proc.pid)
+
+      ok = [ r for r in results if r[0] and r[1] <= args.ttfb_slo_ms ]
+      out.append(LevelResult(
+        mode=mode,
+        concurrency=level,
+        ok=len(ok),
+        failed=level - len(ok),
+        ttfb_p50_ms=round(percentile([ r[1] for r in results ], 50), 1),
+        ttfb_p95_ms=round(percentile([ r[1] for r in results ], 95), 1),
+        duration_p95_ms=round(percentile([ r[2] for r in results ], 95), 1),
+        wall_s=round(wall, 2),
+        server_cpu_util=round((cpu_after - cpu_before) / wall, 2),
+        server_threads=threads,
+        server_rss_mb=round(rss, 1)
+      ))
+      print(json.dumps(asdict(out[-1])), flush=True)
+  finally:
+    proc.terminate()
+    proc.wait(10)
+  return out
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--modes", default="threads,gevent")
+  parser.add_argument("--levels", default="16,64,256,1024")
+  parser.add_argument("--threads", type=int, default=8, help="worker threads for mode `threads`")
+  parser.add_argument("--tokens", type=int, default=100, help="frames per stream")
+  parser.add_argument("--interval", type=float, default=0.02, help="seconds between frames")
+  parser.add_argument("--ttfb-slo-ms", type=float, default=1000)
+  parser.add_argument("--timeout", type=float, default=120)
+  parser.add_argument("--json", default="", help="write results to this file")
+  parser.add_argument("--serve", default="", help=argparse.SUPPRESS)
+  parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.serve:
+    _serve(args.serve, args.port, args.threads, args.tokens, args.interval)
+    return
+
+  _raise_nofile_limit()
+  levels = [ int(i) for i in args.levels.split(",") ]
+  results: List[LevelResult] = []
+  for mode in args.modes.split(","):
+    results.extend(bench_mode(mode, levels, args))
+
+  print()
+  print(f"{'mode':<10} {'streams':>8} {'ok':>6} {'ttfb p95':>10} {'cpu':>6} {'threads':>8} {'rss MB':>8}")
+  for r in results:
+    print(f"{r.mode:<10} {r.concurrency:>8} {r.ok:>6} {r.ttfb_p95_ms:>10} {r.server_cpu_util:>6} {r.server_threads:>8} {r.server_rss_mb:>8}")
+  print()
+  for mode in args.modes.split(","):
+    capacity = max([ r.concurrency for r in results if r.mode == mode and r.ok >= 0.99 * r.concurrency ], default=0)
+    print(f"{mode}: {capacity} concurrent streams/core")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
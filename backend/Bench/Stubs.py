@@ -0,0 +1,162 @@
+"""
+Stand-ins for the services behind `backend.Apps.Main` in load tests
+
+Servers
+  encoder  - `POST /encode`, deterministic bag of words vectors so prompts that
+             share words with a memory are close to it
+  model    - `POST /generate-reply` (SERVER_MODEL), `POST /filter` (SERVER_FILTER,
+             always "OK") and the Groq `POST /openai/v1/chat/completions` api
+             (GROQ_BASE_URL), streamed or not. Replies take `--ttft-ms` to the
+             first token then `--tokens-per-sec`
+
+Usage
+  python -m backend.Bench.Stubs encoder --port 5001 --dim 384
+  python -m backend.Bench.Stubs model --port 5002 --ttft-ms 300 --tokens-per-sec 60 --tokens 120
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from functools import lru_cache
+from math import sqrt
+from typing import List
+
+# ============ Encoder ============
+@lru_cache(maxsize=65536)
+def _word_vector(word: str, dim: int) -> tuple:
+  seed = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "big")
+  rng = random.Random(seed)
+  return tuple([ rng.gauss(0, 1) for _ in range(dim) ])
+
+def embed(text: str, dim: int) -> List[float]:
+  """
+  Sum of the random vectors of each word, normalized
+  """
+  v = [0.0] * dim
+  for word in re.findall(r"\w+", text.lower()):
+    for i, x in enumerate(_word_vector(word, dim)):
+      v[i] += x
+  norm = sqrt(sum([ x * x for x in v ]))
+  if norm == 0:
+    return v
+  return [ x / norm for x in v ]
+
+def create_encoder(dim: int, latency_ms: float, item_ms: float = 0):
+  from flask import Flask, jsonify, request
+
+  app = Flask(__name__)
+
+  @app.route("/encode", methods=["POST"])
+  def encode():
+    body = request.get_json()
+    data = list(body["data"])
+    if len(data) == 0:
+      return jsonify({ "error": "cannot encode data" }), 400
+    time.sleep((latency_ms + item_ms * len(data)) / 1000)
+    # same shape as backend.Apps.Encoder, the vector of the first item or of each with `batch`
+    if body.get("batch", False):
+      return jsonify({ "embeddings": [ embed(str(i), dim) for i in data ] }), 200
+    return jsonify({ "embeddings": embed(str(data[0]), dim) }), 200
+
+  return app
+
+# ============ Model ============
+def _reply_tokens(prompt: str, n: int) -> List[str]:
+  words = re.findall(r"\w+", prompt) or ["token"]
+  return [ words[i % len(words)] + " " for i in range(n) ]
+
+def create_model(ttft_ms: float, tokens_per_sec: float, tokens: int):
+  from flask import Flask, Response, jsonify, request
+
+  app = Flask(__name__)
+  interval = 1 / tokens_per_sec if tokens_per_sec > 0 else 0
+
+  def generate(prompt: str):
+    time.sleep(ttft_ms / 1000)
+    for i, tok in enumerate(_reply_tokens(prompt, tokens)):
+      if i > 0:
+        time.sleep(interval)
+      yield tok
+
+  @app.route("/generate-reply", methods=["POST"])
+  def generate_reply():
+    body = request.get_json()
+    return jsonify({ "reply": "".join(generate(body["prompt"]["content"])) }), 200
+
+  @app.route("/filter", methods=["POST"])
+  def filter_reply():
+    return jsonify({ "reply": "OK" }), 200
+
+  @app.route("/openai/v1/chat/completions", methods=["POST"])
+  def chat_completions():
+    body = request.get_json()
+    prompt = body["messages"][-1]["content"]
+    model = body.get("model", "stub")
+    cid = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason: str | None):
+      return {
+        "id": cid,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [ { "index": 0, "delta": delta, "finish_reason": finish_reason } ]
+      }
+
+    if not body.get("stream", False):
+      content = "".join(generate(prompt))
+      return jsonify({
+        "id": cid,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [ {
+          "index": 0,
+          "message": { "role": "assistant", "content": content },
+          "finish_reason": "stop"
+        } ],
+        "usage": { "prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens }
+      }), 200
+
+    def stream():
+      yield f"data: {json.dumps(chunk({ 'role': 'assistant', 'content': '' }, None))}\n\n"
+      for tok in generate(prompt):
+        yield f"data: {json.dumps(chunk({ 'content': tok }, None))}\n\n"
+      yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+      yield "data: [DONE]\n\n"
+
+    return Response(stream(), mimetype="text/event-stream")
+
+  return app
+
+def serve(app, port: int):
+  from gevent.pool import Pool
+  from gevent.pywsgi import WSGIServer
+  WSGIServer(("127.0.0.1", port), app, spawn=Pool(100_000), backlog=4096, log=None).serve_forever()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("server", choices=["encoder", "model"])
+  parser.add_argument("--port", type=int, required=True)
+  parser.add_argument("--dim", type=int, default=384, help="encoder vector size")
+  parser.add_argument("--encode-ms", type=float, default=5, help="encoder latency")
+  parser.add_argument("--encode-item-ms", type=float, default=0, help="encoder latency added per text of a request")
+  parser.add_argument("--ttft-ms", type=float, default=300, help="model time to first token")
+  parser.add_argument("--tokens-per-sec", type=float, default=60)
+  parser.add_argument("--tokens", type=int, default=120, help="tokens per reply")
+  args = parser.parse_args()
+
+  from gevent import monkey
+  monkey.patch_all()
+
+  if args.server == "encoder":
+    serve(create_encoder(args.dim, args.encode_ms, args.encode_item_ms), args.port)
+  else:
+    serve(create_model(args.ttft_ms, args.tokens_per_sec, args.tokens), args.port)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,212 @@
+"""
+Memory vector search latency and recall, in process index vs brute force
+
+For each `--sizes` corpus of unit vectors the queries are answered by
+  flat     - `FlatIndex`, one float32 matrix product (`VECTOR_SEARCH=memory`),
+             also the ground truth for recall
+  hnsw     - `HnswIndex` at each `--ef` (`VECTOR_SEARCH=hnsw`, pip install hnswlib)
+  redis    - a vector set on `--redis` at each `--ef` (`VECTOR_SEARCH=redis`, redis >= 8),
+             latency includes the round trip
+  python   - the pure python cosine scan of `VECTOR_SEARCH=exact` without the
+             database read, up to `--python-max` vectors
+
+Reported per index and size: build time, p50/p95/p99 query latency,
+queries/s, recall@k against the flat top k and the index memory.
+
+Vectors are synthetic clusters (memories of one document are close to each
+other) unless `--mongo` reads the embeddings of the `memory` collection,
+queries are perturbed corpus vectors.
+
+Usage
+  python -m backend.Bench.VectorIndex --sizes 1000,10000,100000 --dim 384 --ef 16,64,128
+  python -m backend.Bench.VectorIndex --mongo mongodb://localhost:27017 --sizes 0
+  python -m backend.Bench.VectorIndex --redis localhost:5004 --sizes 10000
+"""
+import argparse
+import json
+from dataclasses import asdict, dataclass
+from math import sqrt
+from time import perf_counter
+from typing import List
+
+import numpy as np
+
+from backend.Lib.Timing import percentile
+from backend.Lib.VectorIndex import FlatIndex, HnswIndex, hnswlib, normalize
+
+@dataclass
+class Result:
+  index: str
+  size: int
+  build_s: float
+  p50_ms: float
+  p95_ms: float
+  p99_ms: float
+  qps: float
+  recall: float
+  memory_mb: float
+
+def make_corpus(size: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+  centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+  labels = rng.integers(0, clusters, size)
+  return normalize(centers[labels] + 0.6 * rng.standard_normal((size, dim)).astype(np.float32))
+
+def load_mongo(uri: str) -> np.ndarray:
+  from pymongo import MongoClient
+  col = MongoClient(uri)["CyberSync"]["memory"]
+  vectors = [ d["embeddings"] for d in col.find({ "deleted_at": None }, { "embeddings": 1 }) if d.get("embeddings") ]
+  dim = len(vectors[0])
+  return normalize(np.asarray([ v for v in vectors if len(v) == dim ], dtype=np.float32))
+
+def make_queries(corpus: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+  picks = corpus[rng.integers(0, len(corpus), n)]
+  # noise of about the norm of the picked vector
+  noise = rng.standard_normal(picks.shape).astype(np.float32) * (1.2 / sqrt(corpus.shape[1]))
+  return normalize(picks + noise)
+
+def python_scan(corpus: List[List[float]], query: List[float], k: int) -> List[int]:
+  q_norm = sqrt(sum([ x * x for x in query ]))
+  hits = []
+  for i, emb in enumerate(corpus):
+    norm = sqrt(sum([ x * x for x in emb ]))
+    cos = sum([ a * b for a, b in zip(query, emb) ]) / (q_norm * norm)
+    hits.append((cos, i))
+  hits.sort(reverse=True)
+  return [ i for _, i in hits[:k] ]
+
+def measure(name: str, size: int, build_s: float, memory_mb: float, search, queries, truth: List[set], k: int) -> Result:
+  latencies = []
+  found = 0
+  start = perf_counter()
+  for q, expected in zip(queries, truth):
+    t = perf_counter()
+    keys = search(q)
+    latencies.append((perf_counter() - t) * 1000)
+    found += len(expected.intersection(keys))
+  wall = perf_counter() - start
+  latencies.sort()
+  return Result(
+    index=name,
+    size=size,
+    build_s=round(build_s, 2),
+    p50_ms=round(percentile(latencies, 50), 3),
+    p95_ms=round(percentile(latencies, 95), 3),
+    p99_ms=round(percentile(latencies, 99), 3),
+    qps=round(len(queries) / wall, 1),
+    recall=round(found / max(1, sum([ len(i) for i in truth ])), 4),
+    memory_mb=round(memory_mb, 1)
+  )
+
+def run_redis(corpus: np.ndarray, queries: np.ndarray, truth: List[set], args) -> List[Result]:
+  from redis import Redis
+  host, _, port = args.redis.partition(":")
+  con = Redis(host=host, port=int(port or 6379), socket_timeout=60)
+  key = "bench:vectors"
+  con.delete(key)
+  results = []
+  try:
+    start = perf_counter()
+    pipe = con.pipeline(transaction=False)
+    for i, v in enumerate(corpus):
+      pipe.execute_command("VADD", key, "FP32", v.astype("<f4").tobytes(), str(i), "CAS")
+      if i % 256 == 255:
+        pipe.execute()
+    pipe.execute()
+    build = perf_counter() - start
+    memory_mb = (con.memory_usage(key) or 0) / 2**20
+
+    def search(q, ef):
+      hits = con.vset().vsim(key, q.astype("<f4").tobytes(), count=args.k, ef=ef)
+      return [ int(i) for i in hits ]
+
+    for ef in args.ef:
+      results.append(measure(
+        f"redis ef={ef}", len(corpus), build, memory_mb,
+        lambda q: search(q, ef), queries, truth, args.k
+      ))
+  finally:
+    con.delete(key)
+  return results
+
+def run_size(corpus: np.ndarray, args, rng: np.random.Generator) -> List[Result]:
+  size, dim = corpus.shape
+  keys = list(range(size))
+  queries = make_queries(corpus, args.queries, rng)
+  results = []
+
+  start = perf_counter()
+  flat = FlatIndex(dim, capacity=size)
+  flat.add(keys, corpus)
+  flat_build = perf_counter() - start
+  truth = [ set([ key for key, _ in flat.search(q, args.k) ]) for q in queries ]
+  results.append(measure(
+    "flat", size, flat_build, flat.matrix.nbytes / 2**20,
+    lambda q: [ key for key, _ in flat.search(q, args.k) ], queries, truth, args.k
+  ))
+
+  if hnswlib != None:
+    start = perf_counter()
+    hnsw = HnswIndex(dim, capacity=size)
+    hnsw.add(keys, corpus)
+    hnsw_build = perf_counter() - start
+    # vectors plus M * 2 links per element at layer 0
+    hnsw_mb = size * (dim * 4 + 16 * 2 * 4) / 2**20
+    for ef in args.ef:
+      hnsw.ef = ef
+      results.append(measure(
+        f"hnsw ef={ef}", size, hnsw_build, hnsw_mb,
+        lambda q: [ key for key, _ in hnsw.search(q, args.k) ], queries, truth, args.k
+      ))
+  else:
+    print("hnswlib not installed, skipping hnsw", flush=True)
+
+  if args.redis:
+    results.extend(run_redis(corpus, queries, truth, args))
+
+  if size <= args.python_max:
+    as_lists = corpus.tolist()
+    n = min(len(queries), 20)
+    results.append(measure(
+      "python", size, 0, 0,
+      lambda q: python_scan(as_lists, q.tolist(), args.k), queries[:n], truth[:n], args.k
+    ))
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", default="1000,10000,100000", help="synthetic corpus sizes")
+  parser.add_argument("--dim", type=int, default=384)
+  parser.add_argument("--clusters", type=int, default=200)
+  parser.add_argument("--queries", type=int, default=500)
+  parser.add_argument("--k", type=int, default=5, help="top k, MAX_CONTEXT_SIZE in the chat")
+  parser.add_argument("--ef", default="16,64,128", help="hnsw search breadths (VECTOR_INDEX_EF)")
+  parser.add_argument("--python-max", type=int, default=10000, help="largest size for the python scan")
+  parser.add_argument("--mongo", default="", help="also run on the embeddings of this database")
+  parser.add_argument("--redis", default="", help="host:port of a redis >= 8 for the vector set")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--json", default="", help="write results to this file")
+  args = parser.parse_args()
+  args.ef = [ int(i) for i in args.ef.split(",") if i ]
+
+  rng = np.random.default_rng(args.seed)
+  corpora = [ make_corpus(int(i), args.dim, args.clusters, rng) for i in args.sizes.split(",") if int(i) > 0 ]
+  if args.mongo:
+    corpora.append(load_mongo(args.mongo))
+
+  results: List[Result] = []
+  for corpus in corpora:
+    for r in run_size(corpus, args, rng):
+      results.append(r)
+      print(json.dumps(asdict(r)), flush=True)
+
+  print()
+  print(f"{'index':<12} {'size':>8} {'build s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'q/s':>9} {'recall':>7} {'MB':>7}")
+  for r in results:
+    print(f"{r.index:<12} {r.size:>8} {r.build_s:>8} {r.p50_ms:>8} {r.p95_ms:>8} {r.p99_ms:>8} {r.qps:>9} {r.recall:>7} {r.memory_mb:>7}")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump([ asdict(r) for r in results ], f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,45 @@
+import unittest
+from time import monotonic
+from typing import Callable
+
+from .Logger import Logger
+
+class Breaker:
+  """
+  Skips a dependency (redis) for `retry_after_sec` after a call to it
+  failed, so the requests meanwhile do not each wait for its timeout
+
+  Check `ok()` before a call and report `failed(where, e)` when it raised,
+  `fallback` says what the service does instead and is logged with it.
+  """
+  def __init__(self, name: str, fallback: str, retry_after_sec: float = 10, clock: Callable[[], float] = monotonic):
+    self.name = name
+    self.fallback = fallback
+    self.retry_after_sec = retry_after_sec
+    self._clock = clock
+    self._down_until = 0.0
+
+  def ok(self) -> bool:
+    return self._clock() >= self._down_until
+
+  def failed(self, where: str, e: Exception):
+    self._down_until = self._clock() + self.retry_after_sec
+    # logged at the call in the service
+    Logger.log.warning(f"{self.name}::{where} {repr(e)}, {self.fallback}", stacklevel=2)
+
+class TestBreaker(unittest.TestCase):
+  def test_open_then_retry(self):
+    now = [ 100.0 ]
+    breaker = Breaker("Test", "skipping", retry_after_sec=10, clock=lambda: now[0])
+    self.assertTrue(breaker.ok())
+
+    breaker.failed("call", ConnectionError())
+    self.assertFalse(breaker.ok())
+    now[0] = 109.9
+    self.assertFalse(breaker.ok())
+    now[0] = 110.0
+    self.assertTrue(breaker.ok())
+
+    # a failure of the retry opens it again
+    breaker.failed("call", ConnectionError())
+    self.assertFalse(breaker.ok())
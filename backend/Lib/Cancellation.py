@@ -0,0 +1,52 @@
+import unittest
+from threading import Lock
+from typing import Callable, List
+
+class Cancellation:
+  """
+  Cancels work running on another thread, e.g. the upstream model stream
+  of a chat whose client disconnected
+
+  Callbacks run on the thread calling `cancel`, a callback registered
+  after `cancel` runs at once. Errors of the callbacks are ignored.
+  """
+  def __init__(self):
+    self._lock = Lock()
+    self._callbacks: List[Callable[[], None]] = []
+    self.is_cancelled = False
+
+  def on_cancel(self, fn: Callable[[], None]):
+    with self._lock:
+      if not self.is_cancelled:
+        self._callbacks.append(fn)
+        return
+    self._run(fn)
+
+  def cancel(self):
+    with self._lock:
+      if self.is_cancelled:
+        return
+      self.is_cancelled = True
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      self._run(fn)
+
+  def _run(self, fn: Callable[[], None]):
+    try:
+      fn()
+    except Exception as _:
+      pass
+
+class TestCancellation(unittest.TestCase):
+  def test_cancel(self):
+    calls = []
+    c = Cancellation()
+    c.on_cancel(lambda: calls.append("a"))
+    c.on_cancel(lambda: 1 / 0)
+    self.assertEqual(calls, [])
+
+    c.cancel()
+    c.cancel()
+    c.on_cancel(lambda: calls.append("b"))
+    self.assertTrue(c.is_cancelled)
+    self.assertEqual(calls, [ "a", "b" ])
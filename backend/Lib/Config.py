@@ -44,7 +44,11 @@ PIPE_CONFIG = str(_get_env_as_path("PIPE_CONFIG"))
 TOKENIZER_CONFIG = str(_get_env_as_path("TOKENIZER_CONFIG"))
 
 MAX_CONTENT_LENGTH = int(_get_env_or_default("MAX_CONTENT_LENGTH",10*1024*1024, lambda x: int(x)))
+# uploaded files larger than this are spooled to a temporary file instead of memory
+UPLOAD_SPOOL_BYTES = int(_get_env_or_default("UPLOAD_SPOOL_BYTES", 1024*1024, lambda x: int(x)))
 MAX_CONTEXT_SIZE = int(_get_env_or_default("MAX_CONTEXT_SIZE", 5, lambda x: int(x)))
+# estimated tokens of memories and last messages sent as chat context
+CONTEXT_TOKEN_BUDGET = int(_get_env_or_default("CONTEXT_TOKEN_BUDGET", 1024, lambda x: int(x)))
 MAIN_SERVER = str(_get_env_or_default("SERVER_MAIN", "http://localhost:5000"))
 ENCODER_SERVER = str( _get_env_or_default("SERVER_ENCODER" , "http://localhost:5001/encode") )
 MODEL_SERVER = str( _get_env_or_default("SERVER_MODEL", "http://localhost:5002/generate-reply") )
@@ -52,6 +56,7 @@ FILTER_SERVER = str( _get_env_or_default("SERVER_FILTER", "http://localhost:5003
 # TODO: Rename to ALLOWED_ORIGIN
 FRONTEND_SERVER = list( _get_env_or_default("SERVER_FRONTEND", ["http://localhost:5173"], lambda x: json.loads(x)) )
 DATABASE_URI = str(_get_required_env("CyberSync_DatabaseUri"))
+DATABASE_TLS = bool(_get_env_or_default("DATABASE_TLS", True, lambda x: x == '1' or x.lower() == "true"))
 JWT_SECRET = str(_get_required_env("JWT_SECRET"))
 RESOURCE_DIR = str(_get_env_or_default("RESOURCE_DIR", "Uploads/"))
 
@@ -68,8 +73,29 @@ if AI_MODEL == "groq" and (GROQ_API_KEY == None or len(GROQ_API_KEY) == 0):
 
 HF_TOKEN = str(_get_env_or_default("HF_TOKEN", ""))
 
-CHUNK_SIZE_BYTES = int(_get_env_or_default("CHUNK_SIZE_BYTES", 256, lambda x:  int(x)))
-CHUNK_OFFSET_BYTES = int(_get_env_or_default("CHUNK_OFFSET_BYTES", 28, lambda x:  int(x)))
+# estimated tokens per memory chunk of a file, below the 256 word pieces sentence transformers usually embed
+CHUNK_TOKENS = int(_get_env_or_default("CHUNK_TOKENS", 200, lambda x: int(x)))
+# tokens of the last sentences of a chunk repeated at the start of the next, at most half of CHUNK_TOKENS
+CHUNK_OVERLAP_TOKENS = int(_get_env_or_default("CHUNK_OVERLAP_TOKENS", 40, lambda x: int(x)))
+# processes of backend.Worker reading the pages of a pdf file memory (Main reads them serially), seconds a page may take
+PDF_WORKERS = int(_get_env_or_default("PDF_WORKERS", os.cpu_count() or 1, lambda x: int(x)))
+PDF_PAGE_TIMEOUT_SEC = float(_get_env_or_default("PDF_PAGE_TIMEOUT_SEC", 30, lambda x: float(x)))
+# chunks of a file per encoder request and its encoder requests in flight, also the process wide limit
+EMBED_BATCH_SIZE = int(_get_env_or_default("EMBED_BATCH_SIZE", 32, lambda x: int(x)))
+EMBED_CONCURRENCY = int(_get_env_or_default("EMBED_CONCURRENCY", 4, lambda x: int(x)))
+# a failed batch is sent again this many times before the file fails
+EMBED_RETRIES = int(_get_env_or_default("EMBED_RETRIES", 2, lambda x: int(x)))
+
+# file memories are ingested by `python -m backend.Worker` from a redis queue, 0 ingests them on the request
+INGEST_ASYNC = bool(_get_env_or_default("INGEST_ASYNC", True, lambda x: x == '1' or x.lower() == "true"))
+# jobs run at once by a worker process
+INGEST_WORKERS = int(_get_env_or_default("INGEST_WORKERS", 2, lambda x: int(x)))
+# a failed job is run again this many times
+INGEST_RETRIES = int(_get_env_or_default("INGEST_RETRIES", 2, lambda x: int(x)))
+# job status is kept this long, 1 day = 86400
+INGEST_JOB_EXPIRE_SEC = int(_get_env_or_default("INGEST_JOB_EXPIRE_SEC", 86400, lambda x: int(x)))
+# a job without progress for this long was dropped by its worker and is run by another, 10 min = 600
+INGEST_CLAIM_IDLE_SEC = int(_get_env_or_default("INGEST_CLAIM_IDLE_SEC", 600, lambda x: int(x)))
 DEBUG = bool(_get_env_or_default("DEBUG", False, lambda x: x != None or len(x) > 0))
 AI_NAME = str(_get_env_or_default("AI_NAME", "CEDRIK"))
 
@@ -77,3 +103,70 @@ REDIS_HOST = str(_get_env_or_default("REDIS_HOST", "redis"))
 REDIS_PORT = int(_get_env_or_default("REDIS_PORT", 5004, lambda x: int(x)))
 # 30 min = 1800
 LABS_SESSION_EXPIRE_SEC = int(_get_env_or_default("LABS_SESSION_EXPIRE_SEC", 1800, lambda x: int(x)))
+# recent messages per conversation for the chat context, cached in redis (>= 5 for the chat history)
+CHAT_CONTEXT_MESSAGES = int(_get_env_or_default("CHAT_CONTEXT_MESSAGES", 2 * MAX_CONTEXT_SIZE, lambda x: int(x)))
+# 1 day = 86400
+CHAT_CONTEXT_EXPIRE_SEC = int(_get_env_or_default("CHAT_CONTEXT_EXPIRE_SEC", 86400, lambda x: int(x)))
+# how a chat turn is stored: bulk (unordered inserts keyed by the Idempotency-Key header, no transaction)
+# or transaction (multi document transaction, needs a replica set)
+CHAT_COMMIT = str(_get_env_or_default("CHAT_COMMIT", "bulk"))
+
+# Greenlet server (backend.Serve)
+SERVE_HOST = str(_get_env_or_default("FLASK_RUN_HOST", "0.0.0.0"))
+SERVE_PORT = int(_get_env_or_default("FLASK_RUN_PORT", 5000, lambda x: int(x)))
+# max concurrent connections (open chat streams included) per process
+SERVE_MAX_CONNECTIONS = int(_get_env_or_default("SERVE_MAX_CONNECTIONS", 2000, lambda x: int(x)))
+# /ai/chat-stream sends the model deltas in content frames of up to SSE_COALESCE_CHARS
+# characters, or what arrived within SSE_COALESCE_MS of the first buffered delta
+SSE_COALESCE_CHARS = int(_get_env_or_default("SSE_COALESCE_CHARS", 64, lambda x: int(x)))
+SSE_COALESCE_MS = float(_get_env_or_default("SSE_COALESCE_MS", 30, lambda x: float(x)))
+# deltas read ahead of a slow client before the model stream is paused
+SSE_MAX_PENDING = int(_get_env_or_default("SSE_MAX_PENDING", 256, lambda x: int(x)))
+# streamed replies are buffered in a redis stream, a client that lost the connection
+# resumes with Last-Event-ID (GET /ai/chat-stream/<id>) instead of generating again
+CHAT_STREAM_BUFFER = bool(_get_env_or_default("CHAT_STREAM_BUFFER", True, lambda x: x == '1' or x.lower() == "true"))
+# 5 min = 300, a buffered reply can be resumed for this long
+CHAT_STREAM_EXPIRE_SEC = int(_get_env_or_default("CHAT_STREAM_EXPIRE_SEC", 300, lambda x: int(x)))
+# the generation is cancelled when no client read the reply for this long
+CHAT_STREAM_ORPHAN_SEC = float(_get_env_or_default("CHAT_STREAM_ORPHAN_SEC", 10, lambda x: float(x)))
+
+# Chat generation admission, per user token bucket of CHAT_RATE_PER_MIN replies (bursts of
+# CHAT_RATE_BURST) and at most CHAT_MAX_IN_FLIGHT generations over all replicas, 0 turns a limit off.
+# Requests over the limit wait in a queue served round robin per user for up to
+# CHAT_QUEUE_TIMEOUT_MS, then get 429 with Retry-After
+CHAT_RATE_PER_MIN = float(_get_env_or_default("CHAT_RATE_PER_MIN", 10, lambda x: float(x)))
+CHAT_RATE_BURST = int(_get_env_or_default("CHAT_RATE_BURST", 5, lambda x: int(x)))
+CHAT_MAX_IN_FLIGHT = int(_get_env_or_default("CHAT_MAX_IN_FLIGHT", 32, lambda x: int(x)))
+CHAT_QUEUE_TIMEOUT_MS = float(_get_env_or_default("CHAT_QUEUE_TIMEOUT_MS", 5000, lambda x: float(x)))
+CHAT_QUEUE_MAX = int(_get_env_or_default("CHAT_QUEUE_MAX", 256, lambda x: int(x)))
+# a generation slot is freed after this long if its process died, 5 min = 300
+CHAT_GENERATION_LEASE_SEC = int(_get_env_or_default("CHAT_GENERATION_LEASE_SEC", 300, lambda x: int(x)))
+
+# Memory vector search: atlas ($vectorSearch), exact (brute force over the collection),
+# memory (in process float32 index), hnsw (in process, needs `pip install hnswlib`)
+# or redis (vector set shared by the replicas, redis >= 8)
+VECTOR_SEARCH = str(_get_env_or_default("VECTOR_SEARCH", "atlas"))
+# hnsw and redis search breadth, higher is better recall and slower
+VECTOR_INDEX_EF = int(_get_env_or_default("VECTOR_INDEX_EF", 64, lambda x: int(x)))
+# process wide workers for the chat retrieval stages
+RETRIEVAL_WORKERS = int(_get_env_or_default("RETRIEVAL_WORKERS", 16, lambda x: int(x)))
+# the chat continues without the stages that miss their deadline
+RETRIEVAL_MEMORY_DEADLINE_MS = float(_get_env_or_default("RETRIEVAL_MEMORY_DEADLINE_MS", 1500, lambda x: float(x)))
+RETRIEVAL_CONTEXT_DEADLINE_MS = float(_get_env_or_default("RETRIEVAL_CONTEXT_DEADLINE_MS", 500, lambda x: float(x)))
+# memory search results cached in redis, invalidated by any memory write.
+# Off by default for the in process indexes, they answer faster than a redis round trip
+RETRIEVAL_CACHE = bool(_get_env_or_default("RETRIEVAL_CACHE", VECTOR_SEARCH not in ("memory", "hnsw"), lambda x: x == '1' or x.lower() == "true"))
+# 1 hour = 3600
+RETRIEVAL_CACHE_EXPIRE_SEC = int(_get_env_or_default("RETRIEVAL_CACHE_EXPIRE_SEC", 3600, lambda x: int(x)))
+# decimals kept of the normalized query embedding in the cache key
+RETRIEVAL_CACHE_PRECISION = int(_get_env_or_default("RETRIEVAL_CACHE_PRECISION", 2, lambda x: int(x)))
+
+# Audit documents are inserted by a background writer, 0 inserts them on the request
+AUDIT_WRITE_BEHIND = bool(_get_env_or_default("AUDIT_WRITE_BEHIND", True, lambda x: x == '1' or x.lower() == "true"))
+# queue the audits in a redis stream instead of memory, kept if the process dies
+AUDIT_STREAM = bool(_get_env_or_default("AUDIT_STREAM", False, lambda x: x == '1' or x.lower() == "true"))
+AUDIT_QUEUE_SIZE = int(_get_env_or_default("AUDIT_QUEUE_SIZE", 10000, lambda x: int(x)))
+AUDIT_BATCH_SIZE = int(_get_env_or_default("AUDIT_BATCH_SIZE", 200, lambda x: int(x)))
+AUDIT_FLUSH_MS = float(_get_env_or_default("AUDIT_FLUSH_MS", 500, lambda x: float(x)))
+# when the queue is full: drop (the new audit), drop-oldest or sync (insert on the request)
+AUDIT_OVERFLOW = str(_get_env_or_default("AUDIT_OVERFLOW", "drop"))
@@ -0,0 +1,113 @@
+import re
+import unittest
+from dataclasses import dataclass
+from typing import List, Set, Tuple
+
+_PIECE = re.compile(r"\w+|[^\w\s]")
+_SPACE = re.compile(r"\s+")
+
+# share of word trigrams above which two passages are the same passage
+NEAR_DUPLICATE = 0.8
+
+def estimate_tokens(text: str) -> int:
+  """
+  Approximate BPE token count, a token per word or symbol and one more
+  every 6 characters of long words
+  """
+  count = 0
+  for piece in _PIECE.findall(text):
+    count += 1 + (len(piece) - 1) // 6
+  return count
+
+def _normalize(text: str) -> str:
+  return _SPACE.sub(" ", text).strip().lower()
+
+def _shingles(text: str) -> Set[Tuple[str, ...]]:
+  words = text.split(" ")
+  if len(words) < 3:
+    return { tuple(words) }
+  return { tuple(words[i:i + 3]) for i in range(len(words) - 2) }
+
+def _is_near_duplicate(a: Set[Tuple[str, ...]], b: Set[Tuple[str, ...]]) -> bool:
+  common = len(a & b)
+  if common == 0:
+    return False
+  # jaccard, or one passage (mostly) inside the other
+  return common / len(a | b) >= NEAR_DUPLICATE or common / min(len(a), len(b)) >= 0.9
+
+@dataclass
+class PackStats:
+  passages: int
+  packed: int
+  duplicates: int
+  over_budget: int
+  input_tokens: int
+  packed_tokens: int
+
+  @property
+  def saved_tokens(self) -> int:
+    return self.input_tokens - self.packed_tokens
+
+def pack_context(passages: List[dict], history: List[dict], token_budget: int) -> Tuple[List[str], PackStats]:
+  """
+  Picks the context passages sent to the model
+
+  Passages are `{ text, score?, token_count? }`, best score first (no score
+  is last). Exact and near duplicates of a better passage or of a
+  `history` message (`{ role, content }`) are dropped, then passages are
+  kept while they fit in `token_budget`.
+
+  Returns:
+    `(texts, stats)`
+  """
+  seen = [ _shingles(n) for n in (_normalize(m.get("content", "")) for m in history) if n ]
+  seen_exact = { _normalize(m.get("content", "")) for m in history }
+  ranked = sorted(passages, key=lambda p: p.get("score", 0.0), reverse=True)
+
+  texts: List[str] = []
+  stats = PackStats(len(passages), 0, 0, 0, 0, 0)
+  for p in ranked:
+    text = p.get("text", "")
+    tokens = p.get("token_count") or estimate_tokens(text)
+    stats.input_tokens += tokens
+
+    norm = _normalize(text)
+    if len(norm) == 0:
+      continue
+    shingles = _shingles(norm)
+    if norm in seen_exact or any([ _is_near_duplicate(shingles, s) for s in seen ]):
+      stats.duplicates += 1
+      continue
+    if stats.packed_tokens + tokens > token_budget:
+      stats.over_budget += 1
+      continue
+
+    seen_exact.add(norm)
+    seen.append(shingles)
+    texts.append(text)
+    stats.packed += 1
+    stats.packed_tokens += tokens
+  return texts, stats
+
+class TestContextPacker(unittest.TestCase):
+  def test_estimate(self):
+    self.assertEqual(estimate_tokens(""), 0)
+    self.assertEqual(estimate_tokens("What is a firewall?"), 6)
+    self.assertEqual(estimate_tokens("cryptographically"), 3)
+
+  def test_pack(self):
+    chunk = "a firewall filters network traffic between zones using a set of rules"
+    texts, stats = pack_context([
+      { "text": "how do i configure it" },
+      { "text": chunk, "score": 0.9 },
+      { "text": chunk.upper() + "  ", "score": 0.8 },
+      { "text": chunk + " defined by the admin", "score": 0.7 },
+      { "text": "nmap scans ports " * 40, "score": 0.6 },
+      { "text": "ids detect intrusions", "score": 0.5, "token_count": 3 },
+    ], [ { "role": "user", "content": "How do I configure  it" } ], token_budget=20)
+
+    self.assertEqual(texts, [ chunk, "ids detect intrusions" ])
+    self.assertEqual(stats.duplicates, 3)
+    self.assertEqual(stats.over_budget, 1)
+    self.assertEqual(stats.packed_tokens, estimate_tokens(chunk) + 3)
+    self.assertGreater(stats.saved_tokens, 100)
@@ -0,0 +1,61 @@
+import unittest
+from concurrent.futures import Executor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from threading import Event
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple
+
+@dataclass
+class Stage:
+  name: str
+  fn: Callable[[], Any]
+  # from the start of `run_stages`
+  deadline_ms: float
+  # result when the stage is late or fails
+  default: Any = None
+
+def run_stages(executor: Executor, stages: List[Stage]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+  """
+  Runs `stages` concurrently on `executor` and waits for each one until its deadline
+
+  A late stage is cancelled if it did not start yet, otherwise it is
+  left to finish in the background and its result is dropped.
+
+  Returns:
+    `(results, degraded)`, `results` has every stage name, `degraded` is
+    `{ name: "timeout" | "error" }` for the stages that got their default
+  """
+  start = perf_counter()
+  futures = [ (s, executor.submit(s.fn)) for s in stages ]
+
+  results: Dict[str, Any] = {}
+  degraded: Dict[str, str] = {}
+  for s, future in futures:
+    remaining = s.deadline_ms / 1000 - (perf_counter() - start)
+    try:
+      results[s.name] = future.result(timeout=max(0, remaining))
+    except FutureTimeoutError:
+      future.cancel()
+      results[s.name] = s.default
+      degraded[s.name] = "timeout"
+    except Exception as _:
+      results[s.name] = s.default
+      degraded[s.name] = "error"
+  return results, degraded
+
+class TestDeadline(unittest.TestCase):
+  def test_partial_results(self):
+    release = Event()
+    def fail():
+      raise ValueError()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+      results, degraded = run_stages(executor, [
+        Stage("fast", lambda: 1, deadline_ms=1000),
+        Stage("slow", lambda: release.wait(5), deadline_ms=50, default=[]),
+        Stage("fail", fail, deadline_ms=1000, default=0),
+      ])
+      release.set()
+
+    self.assertEqual(results, { "fast": 1, "slow": [], "fail": 0 })
+    self.assertEqual(degraded, { "slow": "timeout", "fail": "error" })
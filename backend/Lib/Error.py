@@ -53,6 +53,12 @@ class TooManyFiles(HTTPException):
         super().__init__(msg)
         self.code = 400
 
+class TooManyChats(HTTPException):
+    def __init__(self, retry_after: int, msg: str = "Too many chat requests, try again later"):
+        super().__init__(msg)
+        self.code = 429
+        self.retry_after = retry_after
+
 class InvalidId(Exception): ...
 
 def ErrHTTPExceptionHandler(e: HTTPException):
@@ -60,8 +66,13 @@ def ErrHTTPExceptionHandler(e: HTTPException):
     status = e.code if e.code else 500
     message = e.description
 
+    headers = {}
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after != None:
+        headers["Retry-After"] = str(retry_after)
+
     return jsonify({
         "error": message,
         "type": e.__class__.__name__
-    }), status
+    }), status, headers
 
@@ -0,0 +1,125 @@
+import codecs
+import unittest
+import zipfile
+from io import BytesIO
+from typing import BinaryIO, Tuple
+from charset_normalizer import from_bytes
+
+PDF = "pdf"
+DOCX = "docx"
+PPTX = "pptx"
+TEXT = "text"
+
+# a text file's encoding is detected on its start
+SAMPLE_BYTES = 64 * 1024
+_PDF_MAGIC = b"%PDF-"
+_ZIP_MAGIC = b"PK\x03\x04"
+_BOMS = (
+  (codecs.BOM_UTF32_LE, "utf-32"),
+  (codecs.BOM_UTF32_BE, "utf-32"),
+  (codecs.BOM_UTF8, "utf-8-sig"),
+  (codecs.BOM_UTF16_LE, "utf-16"),
+  (codecs.BOM_UTF16_BE, "utf-16"),
+)
+_BY_EXTENSION = { ".pdf": PDF, ".docx": DOCX, ".pptx": PPTX }
+_BY_CONTENT_TYPE = {
+  "application/pdf": PDF,
+  "application/vnd.openxmlformats-officedocument.wordprocessingml.document": DOCX,
+  "application/vnd.openxmlformats-officedocument.presentationml.presentation": PPTX,
+}
+
+def _ooxml(stream: BinaryIO) -> str:
+  try:
+    names = zipfile.ZipFile(stream).namelist()
+  except zipfile.BadZipFile:
+    return ""
+  if any([ n.startswith("word/") for n in names ]):
+    return DOCX
+  if any([ n.startswith("ppt/") for n in names ]):
+    return PPTX
+  return ""
+
+def text_encoding(sample: bytes, complete: bool) -> str:
+  """
+  Encoding of the text starting with `sample`, `complete` when it is the
+  whole text. Utf-8 is validated first, other encodings are detected by
+  charset_normalizer.
+
+  Returns:
+    the encoding, "" when it is not text
+  """
+  for bom, encoding in _BOMS:
+    if sample.startswith(bom):
+      return encoding
+  try:
+    # a character cut at the end of the sample is left undecoded
+    codecs.utf_8_decode(sample, "strict", complete)
+    if b"\x00" not in sample:
+      return "utf-8"
+  except UnicodeDecodeError:
+    pass
+
+  result = from_bytes(sample).best()
+  if result == None:
+    return ""
+  encoding = result.encoding
+  # nul bytes are binary data in an 8 bit encoding
+  if b"\x00" in sample and not encoding.startswith(("utf_16", "utf_32")):
+    return ""
+  return encoding
+
+def sniff(stream: BinaryIO, filename: str = "", content_type: str = "") -> Tuple[str, str]:
+  """
+  Kind of a file (PDF, DOCX, PPTX, TEXT) from its first bytes, then its
+  extension or content type, then whether it decodes as text
+
+  Returns:
+    `(kind, encoding)`, the encoding of a TEXT file, `("", "")` when the
+    kind is not known
+  """
+  stream.seek(0)
+  head = stream.read(SAMPLE_BYTES)
+  complete = len(stream.read(1)) == 0
+  stream.seek(0)
+
+  kind = ""
+  # the header may only follow whitespace or a utf-8 bom, a text may mention it
+  if head.removeprefix(codecs.BOM_UTF8).lstrip().startswith(_PDF_MAGIC):
+    kind = PDF
+  elif head.startswith(_ZIP_MAGIC):
+    kind = _ooxml(stream)
+    stream.seek(0)
+  if kind == "":
+    extension = "." + filename.lower().rsplit(".", 1)[-1] if "." in filename else ""
+    kind = _BY_EXTENSION.get(extension, "") or _BY_CONTENT_TYPE.get(content_type, "")
+  if kind != "":
+    return kind, ""
+
+  if len(head) == 0 or head.startswith(_ZIP_MAGIC):
+    return "", ""
+  encoding = text_encoding(head, complete)
+  return (TEXT, encoding) if encoding else ("", "")
+
+class TestFileSniff(unittest.TestCase):
+  def test_magic(self):
+    self.assertEqual(sniff(BytesIO(b"%PDF-1.4\n..."), "notes.txt"), (PDF, ""))
+    docx = BytesIO()
+    with zipfile.ZipFile(docx, "w") as z:
+      z.writestr("word/document.xml", "<w/>")
+    self.assertEqual(sniff(docx, "upload.bin"), (DOCX, ""))
+    other = BytesIO()
+    with zipfile.ZipFile(other, "w") as z:
+      z.writestr("a.txt", "a")
+    self.assertEqual(sniff(other, "a.zip"), ("", ""))
+    self.assertEqual(sniff(BytesIO(b"broken"), "slides.pptx"), (PPTX, ""))
+    self.assertEqual(sniff(BytesIO(b"\r\n %PDF-1.7\n..."), "upload"), (PDF, ""))
+    self.assertEqual(sniff(BytesIO(b"A pdf starts with %PDF-1.4\n"), "notes.txt"), (TEXT, "utf-8"))
+
+  def test_text(self):
+    self.assertEqual(sniff(BytesIO("Plain ünïcödé text.".encode())), (TEXT, "utf-8"))
+    self.assertEqual(sniff(BytesIO("Plain text.".encode("utf-16"))), (TEXT, "utf-16"))
+    # the sample ends inside a character
+    text = ("é" * SAMPLE_BYTES).encode()
+    self.assertEqual(text_encoding(text[:SAMPLE_BYTES - 1], False), "utf-8")
+    self.assertEqual(sniff(BytesIO(b"")), ("", ""))
+    self.assertEqual(sniff(BytesIO(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00")), ("", ""))
@@ -0,0 +1,387 @@
+import threading
+import unittest
+import weakref
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+from flask import Flask, Response, g, request
+
+from .Timing import LatencyStats
+
+def _os_thread_local():
+  """
+  `threading.local` of the OS thread even when gevent patched `threading`.
+  Greenlets of one thread share a shard, they never switch in the
+  middle of an update since updates do no io.
+  """
+  try:
+    from gevent import monkey
+    if monkey.is_module_patched("threading"):
+      return monkey.get_original("threading", "local")
+  except ImportError:
+    pass
+  return threading.local
+
+class _Owner:
+  """
+  Held by the thread local of a shard, dropped when its thread exits
+  """
+  __slots__ = ("shard", "__weakref__")
+
+  def __init__(self, shard: dict):
+    self.shard = shard
+
+class _Shards:
+  """
+  One dict per OS thread, updates do not take a lock.
+  The lock is only taken when a thread writes for the first time and when
+  it exits, its shard is then merged into the retired one so threads that
+  come and go (a thread per request) do not add up.
+  """
+  def __init__(self, merge: Callable[[dict, Tuple, object], None]):
+    self._local = _os_thread_local()()
+    self._shards: List[dict] = []
+    self._retired: dict = {}
+    self._merge = merge
+    self._lock = Lock()
+
+  def get(self) -> dict:
+    owner = getattr(self._local, "owner", None)
+    if owner is None:
+      owner = _Owner({})
+      self._local.owner = owner
+      with self._lock:
+        self._shards.append(owner.shard)
+      weakref.finalize(owner, self._retire, owner.shard)
+    return owner.shard
+
+  def _retire(self, shard: dict):
+    with self._lock:
+      self._shards = [ i for i in self._shards if i is not shard ]
+      for k, v in shard.items():
+        self._merge(self._retired, k, v)
+
+  def all(self) -> List[dict]:
+    """
+    The live shards and a copy of the retired one
+    """
+    with self._lock:
+      retired = { k: list(v) if isinstance(v, list) else v for k, v in self._retired.items() }
+      return self._shards + [ retired ]
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+  pairs = []
+  for k, v in zip(names, values):
+    v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    pairs.append(f"{k}=\"{v}\"")
+  if extra:
+    pairs.append(extra)
+  if len(pairs) == 0:
+    return ""
+  return "{" + ",".join(pairs) + "}"
+
+def _fmt_value(v: float) -> str:
+  if v == float("inf"):
+    return "+Inf"
+  if float(v).is_integer():
+    return str(int(v))
+  return repr(float(v))
+
+class Metric:
+  type = ""
+
+  def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._shards = _Shards(self._merge)
+
+  @staticmethod
+  def _merge(into: dict, key: Tuple, value):
+    """
+    Adds `value` of a shard to `into[key]`
+    """
+    into[key] = into.get(key, 0) + value
+
+  def render(self) -> List[str]:
+    raise NotImplementedError()
+
+  def header(self) -> List[str]:
+    return [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}" ]
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, *labels, value: float = 1):
+    shard = self._shards.get()
+    shard[labels] = shard.get(labels, 0) + value
+
+  def values(self) -> Dict[Tuple, float]:
+    out: Dict[Tuple, float] = {}
+    for shard in self._shards.all():
+      for k, v in list(shard.items()):
+        out[k] = out.get(k, 0) + v
+    return out
+
+  def render(self):
+    lines = self.header()
+    for k, v in sorted(self.values().items()):
+      lines.append(f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}")
+    return lines
+
+class Gauge(Counter):
+  """
+  Up and down gauge, the value is the sum of all `inc` and `dec`
+  """
+  type = "gauge"
+
+  def dec(self, *labels, value: float = 1):
+    self.inc(*labels, value=-value)
+
+  @contextmanager
+  def track(self, *labels):
+    self.inc(*labels)
+    try:
+      yield
+    finally:
+      self.dec(*labels)
+
+# seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value: float, *labels):
+    shard = self._shards.get()
+    entry = shard.get(labels)
+    if entry is None:
+      # [ bucket counts..., +Inf count, sum ]
+      entry = [0] * (len(self.buckets) + 2)
+      shard[labels] = entry
+    i = 0
+    for i, b in enumerate(self.buckets):
+      if value <= b:
+        break
+    else:
+      i = len(self.buckets)
+    entry[i] += 1
+    entry[-1] += value
+
+  @staticmethod
+  def _merge(into: dict, key: Tuple, value):
+    entry = into.get(key)
+    if entry is None:
+      into[key] = list(value)
+      return
+    for i, v in enumerate(value):
+      entry[i] += v
+
+  @contextmanager
+  def time(self, *labels):
+    start = perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(perf_counter() - start, *labels)
+
+  def render(self):
+    merged: Dict[Tuple, List[float]] = {}
+    for shard in self._shards.all():
+      for k, entry in list(shard.items()):
+        m = merged.get(k)
+        if m is None:
+          merged[k] = list(entry)
+        else:
+          for i, v in enumerate(entry):
+            m[i] += v
+
+    lines = self.header()
+    for k, entry in sorted(merged.items()):
+      cumulative = 0
+      for b, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+        cumulative += count
+        le = "le=\"" + _fmt_value(b) + "\""
+        lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {_fmt_value(cumulative)}")
+      lines.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_value(entry[-1])}")
+      lines.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {_fmt_value(cumulative)}")
+    return lines
+
+class LatencySummary(Metric):
+  """
+  Exports the percentiles of a `LatencyStats`
+  """
+  type = "summary"
+
+  def __init__(self, name: str, help: str, stats: LatencyStats, label: str = "stage"):
+    super().__init__(name, help, (label,))
+    self.stats = stats
+
+  def render(self):
+    lines = self.header()
+    for k, v in sorted(self.stats.snapshot().items()):
+      for q, key in ((0.5, "p50"), (0.95, "p95"), (0.99, "p99")):
+        quantile = "quantile=\"" + str(q) + "\""
+        lines.append(f"{self.name}{_fmt_labels(self.labels, (k,), quantile)} {_fmt_value(v[key])}")
+      lines.append(f"{self.name}_count{_fmt_labels(self.labels, (k,))} {_fmt_value(v['count'])}")
+    return lines
+
+class Registry:
+  def __init__(self):
+    self.metrics: List[Metric] = []
+
+  def register(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return self.register(Counter(name, help, labels))
+
+  def gauge(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Gauge:
+    return self.register(Gauge(name, help, labels))
+
+  def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return self.register(Histogram(name, help, labels, buckets))
+
+  def render(self) -> str:
+    lines = []
+    for m in self.metrics:
+      lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests", ("route", "method", "status"))
+HTTP_DURATION = REGISTRY.histogram("http_request_duration_seconds", "HTTP request duration until the response is closed", ("route", "method"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "HTTP requests being served")
+DOWNSTREAM_DURATION = REGISTRY.histogram("downstream_request_duration_seconds", "Calls to other services", ("target",))
+DOWNSTREAM_ERRORS = REGISTRY.counter("downstream_errors_total", "Failed calls to other services", ("target",))
+CACHE_REQUESTS = REGISTRY.counter("cache_requests_total", "Cache lookups", ("cache", "result"))
+RETRIEVAL_CACHE_SAVED = REGISTRY.counter("retrieval_cache_saved_seconds_total", "Estimated memory search time saved by retrieval cache hits")
+RETRIEVAL_DEGRADED = REGISTRY.counter("retrieval_degraded_total", "Chat retrieval stages skipped after a timeout or error", ("stage", "reason"))
+AUDIT_PENDING = REGISTRY.gauge("audit_pending", "Audit documents queued in memory for the background writer")
+AUDIT_WRITES = REGISTRY.counter("audit_writes_total", "Audit documents by outcome", ("result",))
+CONTEXT_TOKENS_SAVED = REGISTRY.counter("context_tokens_saved_total", "Estimated prompt tokens left out of the chat context by the packer")
+CHAT_REPLIES = REGISTRY.counter("chat_replies_total", "Streamed chat replies, cancelled when the client disconnected", ("result",))
+CHAT_REPLY_TOKENS = REGISTRY.counter("chat_reply_tokens_total", "Estimated completion tokens of streamed chat replies", ("result",))
+CHAT_STREAM_READERS = REGISTRY.counter("chat_stream_readers_total", "Clients following a buffered chat reply, new, retried requests and resumes", ("kind",))
+CHAT_ADMISSION = REGISTRY.counter("chat_admission_total", "Chat generation requests by admission result", ("result",))
+CHAT_QUEUE_WAIT = REGISTRY.histogram("chat_queue_wait_seconds", "Time chat generation requests waited for a slot", buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10))
+GENERATION_TOKENS_SAVED = REGISTRY.counter("generation_tokens_saved_total", "Estimated completion tokens not generated after a client disconnect")
+
+def register_metrics(app: Flask, registry: Registry = REGISTRY):
+  """
+  Counts and times every request of `app` and serves `/metrics`
+  in the Prometheus text format
+  """
+  @app.before_request
+  def _metrics_before():
+    g._metrics_start = perf_counter()
+    g._metrics_done = False
+    HTTP_IN_FLIGHT.inc()
+
+  def _finish(route: str, method: str, status: int, start: float):
+    HTTP_IN_FLIGHT.dec()
+    HTTP_REQUESTS.inc(route, method, status)
+    HTTP_DURATION.observe(perf_counter() - start, route, method)
+
+  @app.after_request
+  def _metrics_after(response: Response):
+    start = g.get("_metrics_start", None)
+    if start == None:
+      return response
+    g._metrics_done = True
+    route = request.url_rule.rule if request.url_rule != None else "unmatched"
+    method = request.method
+    status = response.status_code
+    # streamed responses are closed after the last chunk is written
+    response.call_on_close(lambda: _finish(route, method, status, start))
+    return response
+
+  @app.teardown_request
+  def _metrics_teardown(_exc):
+    start = g.get("_metrics_start", None)
+    if start != None and not g.get("_metrics_done", False):
+      route = request.url_rule.rule if request.url_rule != None else "unmatched"
+      _finish(route, request.method, 500, start)
+
+  def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+  app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
+
+def _parse_exposition(text: str) -> Dict[str, float]:
+  """
+  Minimal collector for tests, `{ "name{labels}": value }`
+  """
+  out = {}
+  for line in text.splitlines():
+    if len(line) == 0 or line.startswith("#"):
+      continue
+    key, value = line.rsplit(" ", 1)
+    out[key] = float(value)
+  return out
+
+class TestMetrics(unittest.TestCase):
+  def test_counter_threads(self):
+    c = Counter("t_total", "test", ("k",))
+    def work():
+      for _ in range(10_000):
+        c.inc("a")
+    threads = [ threading.Thread(target=work) for _ in range(8) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    self.assertEqual(c.values()[("a",)], 80_000)
+    # the shards of the exited threads were merged
+    self.assertEqual(len(c._shards.all()), 1)
+
+  def test_histogram_threads(self):
+    h = Histogram("t_seconds", "test", buckets=(1,))
+    for _ in range(20):
+      t = threading.Thread(target=lambda: h.observe(0.5))
+      t.start()
+      t.join()
+    h.observe(2)
+    self.assertEqual(len(h._shards.all()), 2)
+    parsed = _parse_exposition("\n".join(h.render()))
+    self.assertEqual(parsed['t_seconds_bucket{le="1"}'], 20)
+    self.assertEqual(parsed['t_seconds_count'], 21)
+
+  def test_histogram_render(self):
+    h = Histogram("t_seconds", "test", ("k",), buckets=(0.1, 1))
+    h.observe(0.05, "a")
+    h.observe(0.5, "a")
+    h.observe(5, "a")
+    parsed = _parse_exposition("\n".join(h.render()))
+    self.assertEqual(parsed['t_seconds_bucket{k="a",le="0.1"}'], 1)
+    self.assertEqual(parsed['t_seconds_bucket{k="a",le="1"}'], 2)
+    self.assertEqual(parsed['t_seconds_bucket{k="a",le="+Inf"}'], 3)
+    self.assertEqual(parsed['t_seconds_count{k="a"}'], 3)
+    self.assertAlmostEqual(parsed['t_seconds_sum{k="a"}'], 5.55)
+
+  def test_scrape(self):
+    app = Flask(__name__)
+    registry = Registry()
+    registry.register(HTTP_REQUESTS)
+    registry.register(HTTP_IN_FLIGHT)
+    register_metrics(app, registry)
+
+    @app.route("/ping/<v>")
+    def ping(v):
+      return v
+
+    client = app.test_client()
+    before = HTTP_REQUESTS.values().get(("/ping/<v>", "GET", 200), 0)
+    client.get("/ping/a").close()
+    client.get("/ping/b").close()
+    res = client.get("/metrics")
+    self.assertEqual(res.status_code, 200)
+    parsed = _parse_exposition(res.get_data(as_text=True))
+    self.assertEqual(parsed['http_requests_total{route="/ping/<v>",method="GET",status="200"}'], before + 2)
+    self.assertIn("http_requests_in_flight", parsed)
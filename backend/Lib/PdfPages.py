@@ -0,0 +1,165 @@
+import multiprocessing
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import BinaryIO, Deque, Iterator, Tuple
+import PyPDF2 as pdf2
+
+# fewer pages are read in the calling process
+PARALLEL_MIN_PAGES = 8
+
+_pool: ProcessPoolExecutor | None = None
+_pool_workers = 0
+_pool_lock = Lock()
+
+def _clean(text: str) -> str:
+  # null bytes and text that is not valid utf-8 break the embeddings and mongo
+  return text.replace("\x00", "").strip().encode("utf-8", errors="ignore").decode("utf-8")
+
+# ============ Pool process ============
+# the pdf a pool process has open, (path, file, reader)
+_open: Tuple[str, BinaryIO, pdf2.PdfReader] | None = None
+
+def _on_alarm(*_):
+  raise TimeoutError("page took too long")
+
+def _page(path: str, index: int, timeout: float) -> Tuple[str, str]:
+  """
+  Returns:
+    `(text, error)` of page `index` of the pdf at `path`
+  """
+  global _open
+  if _open == None or _open[0] != path:
+    if _open != None:
+      _open[1].close()
+    f = open(path, "rb")
+    _open = (path, f, pdf2.PdfReader(f))
+
+  # a pool process runs one page at a time on its main thread
+  alarm = timeout > 0 and hasattr(signal, "setitimer")
+  if alarm:
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+  try:
+    return _clean(_open[2].pages[index].extract_text() or ""), ""
+  except Exception as e:
+    return "", repr(e)
+  finally:
+    if alarm:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+
+# ============ Caller ============
+def _in_greenlets() -> bool:
+  monkey = sys.modules.get("gevent.monkey")
+  return monkey != None and monkey.is_module_patched("threading")
+
+def start_pool(workers: int) -> ProcessPoolExecutor | None:
+  """
+  Starts the process wide pool of `workers` processes `read_pages` uses
+
+  The processes are forked, call it when the process starts, before it
+  has other threads (e.g. before `backend.Worker` imports the app). A fork
+  after may deadlock on a lock another thread held. None with less than 2
+  workers or in a gevent patched process.
+  """
+  global _pool, _pool_workers
+  if workers < 2 or _in_greenlets() or "fork" not in multiprocessing.get_all_start_methods():
+    return None
+  with _pool_lock:
+    if _pool == None:
+      _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+      _pool_workers = workers
+      # fork the processes now
+      _pool.submit(int).result()
+    return _pool
+
+def _drop_pool(pool: ProcessPoolExecutor):
+  global _pool
+  with _pool_lock:
+    if _pool is pool:
+      _pool = None
+  pool.shutdown(wait=False, cancel_futures=True)
+
+def read_pages(stream: BinaryIO, timeout: float) -> Iterator[Tuple[int, str, str]]:
+  """
+  Text of each page of a pdf in order, yielded as soon as it and the pages
+  before are read
+
+  Pages are read by the `start_pool` processes, up to 2 per process at
+  once, the pdf is copied to a temporary file they read. A page is
+  stopped after `timeout` seconds (0: never). A pdf of less than
+  `PARALLEL_MIN_PAGES` pages, or in a process that did not start the
+  pool (or whose pool broke), is read here without timeout. The pool is
+  never started here, the process may have threads by now.
+
+  Yields:
+    `(page number from 1, text, error)`, empty text and the error of a
+    page that could not be read
+
+  Throws:
+    PdfReadError when it is not a pdf, BrokenProcessPool when a pool process died
+  """
+  stream.seek(0)
+  reader = pdf2.PdfReader(stream)
+  count = len(reader.pages)
+  pool = _pool if count >= PARALLEL_MIN_PAGES else None
+  if pool == None:
+    for i, page in enumerate(reader.pages):
+      try:
+        yield i + 1, _clean(page.extract_text() or ""), ""
+      except Exception as e:
+        yield i + 1, "", repr(e)
+    return
+
+  with tempfile.NamedTemporaryFile(suffix=".pdf") as copy:
+    stream.seek(0)
+    shutil.copyfileobj(stream, copy, 1024 * 1024)
+    copy.flush()
+
+    pending: Deque[Future] = deque()
+    submitted = 0
+    try:
+      while submitted < count or len(pending) > 0:
+        while submitted < count and len(pending) < _pool_workers * 2:
+          pending.append(pool.submit(_page, copy.name, submitted, timeout))
+          submitted += 1
+        try:
+          text, error = pending.popleft().result()
+        except BrokenProcessPool:
+          _drop_pool(pool)
+          raise
+        yield submitted - len(pending), text, error
+    finally:
+      for f in pending:
+        f.cancel()
+
+class TestPdfPages(unittest.TestCase):
+  @staticmethod
+  def _pdf(pages: int) -> BinaryIO:
+    writer = pdf2.PdfWriter()
+    for _ in range(pages):
+      writer.add_blank_page(100, 100)
+    out = tempfile.TemporaryFile()
+    writer.write(out)
+    return out # type: ignore
+
+  def test_order(self):
+    # serially, then in the pool
+    for workers in (0, 2):
+      start_pool(workers)
+      with self._pdf(PARALLEL_MIN_PAGES + 3) as pdf:
+        pages = list(read_pages(pdf, 5))
+      self.assertEqual([ p for p, _, _ in pages ], list(range(1, PARALLEL_MIN_PAGES + 4)))
+      self.assertTrue(all([ text == "" and error == "" for _, text, error in pages ]))
+
+  def test_not_pdf(self):
+    with tempfile.TemporaryFile() as f:
+      f.write(b"not a pdf")
+      with self.assertRaises(pdf2.errors.PdfReadError):
+        list(read_pages(f, 5)) # type: ignore
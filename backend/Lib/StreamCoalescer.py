@@ -0,0 +1,165 @@
+import json
+import unittest
+from json.encoder import encode_basestring_ascii
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Generator, Iterable
+from flask import Flask, Response, stream_with_context
+
+_CONTENT_PREFIX = 'data: {"type": "content", "content": '
+_CONTENT_SUFFIX = '}\n\n'
+
+def content_frame(text: str) -> str:
+  """
+  Same bytes as `f"data: {json.dumps({'type': 'content', 'content': text})}\\n\\n"`
+  with only the text escaped
+  """
+  return _CONTENT_PREFIX + encode_basestring_ascii(text) + _CONTENT_SUFFIX
+
+def event_stream(frames: Iterable[str], on_close: Callable[[], None] | None = None) -> Response:
+  """
+  SSE response of `frames`, run in the request context
+
+  `on_close` runs when the response is closed, also when it was closed
+  before the first frame and `frames` never ran (its `finally` neither)
+  """
+  response = Response(
+    stream_with_context(frames),
+    mimetype='text/event-stream',
+    headers={
+      'Cache-Control': 'no-cache',
+      'X-Accel-Buffering': 'no',
+      'Connection': 'keep-alive'
+    }
+  )
+  if on_close != None:
+    response.call_on_close(on_close)
+  return response
+
+class _Done:
+  pass
+
+class _Failed:
+  def __init__(self, error: BaseException):
+    self.error = error
+
+def coalesce(
+  source: Iterable[Any],
+  max_chars: int,
+  max_delay_ms: float,
+  max_pending: int,
+  wrap: Callable[[Callable], Callable] = lambda fn: fn
+) -> Generator[Any, None, None]:
+  """
+  Joins the `str` items of `source` into fewer, larger items
+
+  `source` is read on its own thread into a queue of `max_pending` items,
+  a slow consumer fills it and blocks the reader (and the upstream
+  connection behind it). Buffered text is yielded once it reaches
+  `max_chars` or `max_delay_ms` after its first item, the first item is
+  yielded at once. Other items are yielded as is, after the buffered text.
+  Errors of `source` are raised here, closing the generator stops the reader.
+
+  Args:
+    wrap: applied to the reader, e.g. `flask.copy_current_request_context`
+  """
+  pending: Queue = Queue(maxsize=max_pending)
+  stop = Event()
+
+  def put(item) -> bool:
+    while not stop.is_set():
+      try:
+        pending.put(item, timeout=0.1)
+        return True
+      except Full:
+        continue
+    return False
+
+  def read():
+    try:
+      for item in source:
+        if not put(item):
+          break
+      else:
+        put(_Done())
+    except BaseException as e:
+      put(_Failed(e))
+    finally:
+      close = getattr(source, "close", None)
+      if close != None:
+        close()
+
+  Thread(target=wrap(read), name="stream-coalesce", daemon=True).start()
+
+  buffer, size = [], 0
+  deadline = None
+  first = True
+  try:
+    while True:
+      try:
+        item = pending.get(timeout=None if deadline == None else max(0.0, deadline - monotonic()))
+      except Empty:
+        item = None
+
+      if isinstance(item, str):
+        buffer.append(item)
+        size += len(item)
+        if deadline == None:
+          deadline = monotonic() + max_delay_ms / 1000
+        if not first and size < max_chars and monotonic() < deadline:
+          continue
+        first = False
+      if len(buffer) > 0:
+        yield "".join(buffer)
+        buffer, size = [], 0
+        deadline = None
+
+      if item == None or isinstance(item, str):
+        continue
+      if isinstance(item, _Done):
+        return
+      if isinstance(item, _Failed):
+        raise item.error
+      yield item
+  finally:
+    stop.set()
+
+class TestStreamCoalescer(unittest.TestCase):
+  def test_content_frame(self):
+    for text in [ "hello", " wörld\n", 'say "hi" \\ 🛡️', "" ]:
+      self.assertEqual(content_frame(text), f"data: {json.dumps({'type': 'content', 'content': text})}\n\n")
+
+  def test_coalesce(self):
+    def source():
+      yield "a"
+      for i in range(10):
+        yield "b"
+      sleep(0.1)
+      yield "c"
+      yield { "done": True }
+
+    items = list(coalesce(source(), max_chars=4, max_delay_ms=50, max_pending=64))
+    self.assertEqual(items, [ "a", "bbbb", "bbbb", "bb", "c", { "done": True } ])
+
+  def test_error(self):
+    def source():
+      yield "a"
+      raise ValueError("upstream")
+
+    with self.assertRaises(ValueError):
+      list(coalesce(source(), max_chars=4, max_delay_ms=10, max_pending=4))
+
+  def test_event_stream_closed(self):
+    calls = []
+    def frames():
+      try:
+        yield "data: {}\n\n"
+      finally:
+        calls.append("finally")
+
+    with Flask(__name__).test_request_context():
+      response = event_stream(frames(), on_close=lambda: calls.append("closed"))
+    # e.g. the client is gone before the first frame is written
+    response.close()
+    self.assertEqual(calls, [ "closed" ])
@@ -0,0 +1,225 @@
+import re
+import unittest
+from typing import Iterable, Iterator, List, Tuple
+
+from .ContextPacker import estimate_tokens
+
+_PARAGRAPH = re.compile(r"\n[ \t]*\n\s*")
+# end of a sentence: punctuation, closing quotes or brackets, then space before the next sentence
+_SENTENCE = re.compile(r"(?<=[.!?])[\"')\]]*\s+(?=[\"'(\[]?[A-Z0-9])|\n+(?=\s*(?:[-*•]|\d+[.)])\s)")
+_WORD = re.compile(r"\S+\s*")
+# text without a paragraph break is cut at its last line break after this many characters
+_MAX_PENDING = 64 * 1024
+
+# (offset in a text, page) where each page starts in it
+PageMarks = List[Tuple[int, int]]
+
+def _page_at(marks: PageMarks, offset: int) -> int:
+  page = marks[0][1] if len(marks) > 0 else 0
+  for start, p in marks:
+    if start > offset:
+      break
+    page = p
+  return page
+
+def _paragraphs(pieces: Iterable[Tuple[str, int]]) -> Iterator[Tuple[str, PageMarks]]:
+  """
+  Paragraphs of the text `pieces` split anywhere, e.g. read in blocks, each
+  piece with its page
+
+  Yields:
+    `(paragraph, where its pages start in it)`
+  """
+  pending = ""
+  marks: PageMarks = []
+
+  def part(start: int, end: int) -> Tuple[str, PageMarks]:
+    return pending[start:end], [ (0, _page_at(marks, start)) ] + [ (o - start, p) for o, p in marks if start < o < end ]
+
+  def drop(n: int):
+    nonlocal pending, marks
+    marks = [ (0, _page_at(marks, n)) ] + [ (o - n, p) for o, p in marks if o > n ]
+    pending = pending[n:]
+
+  for piece, page in pieces:
+    if len(marks) == 0 or marks[-1][1] != page:
+      marks.append((len(pending), page))
+    pending += piece
+    start = 0
+    for m in _PARAGRAPH.finditer(pending):
+      yield part(start, m.start())
+      start = m.end()
+    drop(start)
+    if len(pending) > _MAX_PENDING:
+      cut = pending.rfind("\n", 0, len(pending) - 1)
+      if cut > 0:
+        yield part(0, cut)
+        drop(cut + 1)
+  yield part(0, len(pending))
+
+def _split_long(text: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+  """
+  Lines, then words of a sentence longer than `max_tokens`
+  """
+  parts: List[str] = []
+  for line in text.split("\n"):
+    if estimate_tokens(line) <= max_tokens:
+      parts.append(line)
+    else:
+      parts.extend([ w.strip() for w in _WORD.findall(line) ])
+
+  current: List[str] = []
+  size = 0
+  for part in parts:
+    tokens = estimate_tokens(part)
+    if len(current) > 0 and size + tokens > max_tokens:
+      yield " ".join(current), size
+      current, size = [], 0
+    current.append(part)
+    size += tokens
+  if len(current) > 0:
+    yield " ".join(current), size
+
+def _sentences(paragraph: str, marks: PageMarks, max_tokens: int) -> List[Tuple[str, int, int, int]]:
+  """
+  Returns:
+    `(sentence, tokens, first page, last page)`
+  """
+  out = []
+  start = 0
+  ends = [ (m.start(), m.end()) for m in _SENTENCE.finditer(paragraph) ] + [ (len(paragraph), len(paragraph)) ]
+  for end, next_start in ends:
+    s = paragraph[start:end].strip()
+    first, last = _page_at(marks, start), _page_at(marks, max(start, end - 1))
+    start = next_start
+    if len(s) == 0:
+      continue
+    tokens = estimate_tokens(s)
+    if tokens > max_tokens:
+      out.extend([ (part, t, first, last) for part, t in _split_long(s, max_tokens) ])
+    else:
+      out.append((s, tokens, first, last))
+  return out
+
+def chunk_text(pieces: Iterable[str] | str, max_tokens: int, overlap_tokens: int) -> Iterator[str]:
+  """
+  Chunks of about `max_tokens` estimated tokens (`estimate_tokens`) of a
+  text given whole or as `pieces`, yielded as soon as they are complete
+
+  Chunks end at sentence ends, at a paragraph end when the chunk is at
+  least half full. Each chunk starts with the last sentences of the one
+  before, up to `overlap_tokens`. Only a sentence longer than `max_tokens`
+  is cut, at line breaks or between words.
+  """
+  if isinstance(pieces, str):
+    pieces = [ pieces ]
+  for chunk, _, _ in _chunks(( (p, 0) for p in pieces ), max_tokens, overlap_tokens):
+    yield chunk
+
+def chunk_pages(pages: Iterable[Tuple[int, str]], max_tokens: int, overlap_tokens: int) -> Iterator[Tuple[str, int, int]]:
+  """
+  `chunk_text` of the `(page, text)` of a document, pages are joined by a
+  line break, a paragraph may go on on the next page
+
+  Yields:
+    `(chunk, first page, last page)` of the sentences in the chunk
+  """
+  pieces = ( (text if i == 0 else "\n" + text, page) for i, (page, text) in enumerate(pages) )
+  return _chunks(pieces, max_tokens, overlap_tokens)
+
+def _chunks(pieces: Iterable[Tuple[str, int]], max_tokens: int, overlap_tokens: int) -> Iterator[Tuple[str, int, int]]:
+  max_tokens = max(1, max_tokens)
+  overlap_tokens = min(max(0, overlap_tokens), max_tokens // 2)
+
+  # (sentence, tokens, starts a paragraph, first page, last page)
+  window: List[Tuple[str, int, bool, int, int]] = []
+  size = 0
+  new = 0
+
+  def emit() -> Tuple[str, int, int]:
+    parts = []
+    for s, _, starts, _, _ in window:
+      if len(parts) > 0:
+        parts.append("\n\n" if starts else " ")
+      parts.append(s)
+    return "".join(parts), min([ i[3] for i in window ]), max([ i[4] for i in window ])
+
+  def keep_overlap(next_tokens: int):
+    nonlocal window, size
+    kept: List[Tuple[str, int, bool, int, int]] = []
+    kept_size = 0
+    for s in reversed(window):
+      if kept_size + s[1] > overlap_tokens or kept_size + s[1] + next_tokens > max_tokens:
+        break
+      kept.insert(0, s)
+      kept_size += s[1]
+    window, size = kept, kept_size
+
+  for paragraph, marks in _paragraphs(pieces):
+    sentences = _sentences(paragraph, marks, max_tokens)
+    if len(sentences) == 0:
+      continue
+    paragraph_tokens = sum([ t for _, t, _, _ in sentences ])
+    if new > 0 and size + paragraph_tokens > max_tokens and size * 2 >= max_tokens:
+      yield emit()
+      keep_overlap(sentences[0][1])
+      new = 0
+
+    for i, (s, tokens, first, last) in enumerate(sentences):
+      if new > 0 and size + tokens > max_tokens:
+        yield emit()
+        keep_overlap(tokens)
+        new = 0
+      window.append((s, tokens, i == 0, first, last))
+      size += tokens
+      new += tokens
+
+  if new > 0:
+    yield emit()
+
+class TestTextChunker(unittest.TestCase):
+  TEXT = "\n\n".join([
+    " ".join([ f"Sentence {p}-{s} has some words in it, ünïcödé too." for s in range(8) ])
+    for p in range(6)
+  ])
+
+  def test_small(self):
+    self.assertEqual(list(chunk_text("One short note.", 200, 40)), [ "One short note." ])
+    self.assertEqual(list(chunk_text("  \n\n ", 200, 40)), [])
+
+  def test_boundaries(self):
+    chunks = list(chunk_text(self.TEXT, 60, 15))
+    self.assertGreater(len(chunks), 1)
+    for c in chunks:
+      self.assertLessEqual(estimate_tokens(c), 60)
+      self.assertTrue(c.startswith("Sentence") and c.endswith("too."), c)
+    # each chunk repeats the last sentence of the one before
+    for a, b in zip(chunks, chunks[1:]):
+      self.assertTrue(b.startswith(a.split(". ")[-1].split("\n\n")[-1]), (a, b))
+    sentences = { s for c in chunks for s in re.split(r"(?<=\.)\s+", c) }
+    self.assertEqual(len(sentences), 48)
+
+  def test_pieces(self):
+    pieces = [ self.TEXT[i:i + 7] for i in range(0, len(self.TEXT), 7) ]
+    self.assertEqual(list(chunk_text(pieces, 60, 15)), list(chunk_text(self.TEXT, 60, 15)))
+
+  def test_pages(self):
+    paragraphs = self.TEXT.split("\n\n")
+    # a paragraph goes on on the next page
+    pages = [ (1, "\n\n".join(paragraphs[:3]) + " Continued"), (2, "on page two.\n\n" + "\n\n".join(paragraphs[3:])) ]
+    chunks = list(chunk_pages(pages, 60, 15))
+    self.assertEqual([ c for c, _, _ in chunks ], list(chunk_text("\n".join([ t for _, t in pages ]), 60, 15)))
+    self.assertEqual((chunks[0][1], chunks[-1][2]), (1, 2))
+    spanning = [ c for c in chunks if "Continued\non page two." in c[0] ]
+    self.assertTrue(len(spanning) > 0 and all([ c[1:] == (1, 2) for c in spanning ]))
+    # pages of the sentences, not of their paragraph
+    lines = [ (p, f"Line {p}.") for p in range(1, 7) ]
+    two = estimate_tokens("Line 1. Line 2.")
+    self.assertEqual([ c[1:] for c in chunk_pages(lines, two, 0) ], [ (1, 2), (3, 4), (5, 6) ])
+    self.assertTrue(all([ first <= last for _, first, last in chunks ]))
+
+  def test_long_sentence(self):
+    text = " ".join([ "word" ] * 500)
+    chunks = list(chunk_text(text, 100, 20))
+    self.assertEqual(len(chunks), 5)
+    self.assertEqual(" ".join(chunks), text)
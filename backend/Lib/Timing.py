@@ -0,0 +1,121 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+_END = object()
+
+class StageTimer:
+  """
+  Per request stage timings in milliseconds
+
+  Stages with the same name are summed. Safe to use from the
+  retrieval worker threads of the same request.
+  """
+  def __init__(self):
+    self.start = perf_counter()
+    self.stages: Dict[str, float] = {}
+    self._lock = Lock()
+
+  def add(self, name: str, ms: float):
+    with self._lock:
+      self.stages[name] = self.stages.get(name, 0.0) + ms
+
+  @contextmanager
+  def stage(self, name: str):
+    start = perf_counter()
+    try:
+      yield self
+    finally:
+      self.add(name, (perf_counter() - start) * 1000)
+
+  def timed(self, name: str, f: Callable):
+    """
+    wraps `f` so each call is recorded as stage `name`
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      with self.stage(name):
+        return f(*args, **kwargs)
+    return wrapper
+
+  def timed_iter(self, name: str, it: Iterable[T]) -> Iterator[T]:
+    """
+    yields from `it`, the time spent producing each item is recorded as stage `name`
+    """
+    it = iter(it)
+    while True:
+      with self.stage(name):
+        item = next(it, _END)
+      if item is _END:
+        return
+      yield item # type: ignore
+
+  def total(self) -> float:
+    return (perf_counter() - self.start) * 1000
+
+  def as_dict(self) -> Dict[str, float]:
+    with self._lock:
+      out = { k: round(v, 1) for k, v in self.stages.items() }
+    out["total"] = round(self.total(), 1)
+    return out
+
+  def header(self) -> str:
+    """
+    `Server-Timing` header value
+    """
+    return ", ".join([ f"{k};dur={v}" for k, v in self.as_dict().items() ])
+
+  def __str__(self):
+    return " ".join([ f"{k}={v}ms" for k, v in self.as_dict().items() ])
+
+class LatencyStats:
+  """
+  Rolling window of stage timings for percentiles
+  """
+  def __init__(self, window: int = 2048):
+    self.window = window
+    self._samples: Dict[str, deque] = {}
+    self._counts: Dict[str, int] = {}
+    self._lock = Lock()
+
+  def observe(self, timings: Dict[str, float]):
+    with self._lock:
+      for k, v in timings.items():
+        samples = self._samples.get(k)
+        if samples == None:
+          samples = deque(maxlen=self.window)
+          self._samples[k] = samples
+        samples.append(v)
+        self._counts[k] = self._counts.get(k, 0) + 1
+
+  def snapshot(self) -> Dict[str, Dict[str, float]]:
+    """
+    Returns:
+      `{ stage: { p50, p95, p99, count } }` in ms, count is since startup
+    """
+    with self._lock:
+      copies = { k: sorted(v) for k, v in self._samples.items() }
+      counts = dict(self._counts)
+
+    out = {}
+    for k, s in copies.items():
+      out[k] = {
+        "p50": percentile(s, 50),
+        "p95": percentile(s, 95),
+        "p99": percentile(s, 99),
+        "count": counts.get(k, 0)
+      }
+    return out
+
+def percentile(sorted_values, p: float) -> float:
+  if len(sorted_values) == 0:
+    return 0.0
+  k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * (len(sorted_values) - 1)))))
+  return sorted_values[k]
+
+# Chat path (`/api/ai/chat` and `/api/ai/chat-stream`)
+CHAT_LATENCY = LatencyStats()
@@ -0,0 +1,135 @@
+import unittest
+from typing import Dict, List, Tuple
+import numpy as np
+
+try:
+  import hnswlib # type: ignore
+except ImportError:
+  hnswlib = None
+
+def normalize(m: np.ndarray) -> np.ndarray:
+  norms = np.linalg.norm(m, axis=-1, keepdims=True)
+  norms[norms == 0] = 1
+  return m / norms
+
+class FlatIndex:
+  """
+  Exact inner product over a float32 matrix, one row per key
+  """
+  def __init__(self, dim: int, capacity: int = 1024):
+    self.dim = dim
+    self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+    self.keys: List = []
+    self.rows: Dict = {}
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, keys: List, vectors: np.ndarray):
+    for key, v in zip(keys, vectors):
+      row = self.rows.get(key)
+      if row == None:
+        row = len(self.keys)
+        if row == len(self.matrix):
+          grown = np.zeros((max(1024, 2 * len(self.matrix)), self.dim), dtype=np.float32)
+          grown[:row] = self.matrix
+          self.matrix = grown
+        self.keys.append(key)
+        self.rows[key] = row
+      self.matrix[row] = v
+
+  def remove(self, key):
+    row = self.rows.pop(key, None)
+    if row == None:
+      return
+    # move the last row into the hole
+    last = len(self.keys) - 1
+    if row != last:
+      self.matrix[row] = self.matrix[last]
+      self.keys[row] = self.keys[last]
+      self.rows[self.keys[row]] = row
+    self.keys.pop()
+
+  def search(self, query: np.ndarray, k: int) -> List[Tuple]:
+    n = len(self.keys)
+    k = min(k, n)
+    if k == 0:
+      return []
+    scores = self.matrix[:n] @ query
+    top = np.argpartition(scores, n - k)[n - k:]
+    top = top[np.argsort(-scores[top])]
+    return [ (self.keys[i], float(scores[i])) for i in top ]
+
+class HnswIndex:
+  """
+  Approximate inner product with hnswlib, same interface as `FlatIndex`
+  """
+  def __init__(self, dim: int, capacity: int = 1024, ef: int = 64, M: int = 16, ef_construction: int = 200):
+    assert(hnswlib != None)
+    self.dim = dim
+    self.ef = ef
+    self.index = hnswlib.Index(space="ip", dim=dim)
+    self.index.init_index(max_elements=capacity, M=M, ef_construction=ef_construction, allow_replace_deleted=True)
+    self.labels: Dict = {}
+    self.keys: Dict[int, object] = {}
+    self.next_label = 0
+
+  def __len__(self):
+    return len(self.labels)
+
+  def add(self, keys: List, vectors: np.ndarray):
+    labels = []
+    for key in keys:
+      label = self.labels.get(key)
+      if label == None:
+        label = self.next_label
+        self.next_label += 1
+        self.labels[key] = label
+        self.keys[label] = key
+      labels.append(label)
+
+    needed = self.index.get_current_count() + len(labels)
+    if needed > self.index.get_max_elements():
+      self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+    self.index.add_items(vectors, np.asarray(labels), replace_deleted=True)
+
+  def remove(self, key):
+    label = self.labels.pop(key, None)
+    if label == None:
+      return
+    del self.keys[label]
+    self.index.mark_deleted(label)
+
+  def search(self, query: np.ndarray, k: int) -> List[Tuple]:
+    k = min(k, len(self.labels))
+    if k == 0:
+      return []
+    self.index.set_ef(max(self.ef, k))
+    labels, distances = self.index.knn_query(query, k=k)
+    # ip distance is 1 - dot
+    return [ (self.keys[int(l)], 1 - float(d)) for l, d in zip(labels[0], distances[0]) ]
+
+class TestVectorIndex(unittest.TestCase):
+  def _data(self, n: int, dim: int):
+    rng = np.random.default_rng(1)
+    return normalize(rng.standard_normal((n, dim)).astype(np.float32))
+
+  def _check(self, index):
+    vectors = self._data(200, 16)
+    index.add(list(range(200)), vectors)
+    index.add([ 5 ], vectors[7:8])
+    index.remove(3)
+    index.remove(199)
+    self.assertEqual(len(index), 198)
+
+    hits = index.search(vectors[7], 2)
+    self.assertEqual(sorted([ k for k, _ in hits ]), [5, 7])
+    self.assertAlmostEqual(hits[0][1], 1.0, places=4)
+    self.assertNotIn(3, [ k for k, _ in index.search(vectors[3], 10) ])
+
+  def test_flat(self):
+    self._check(FlatIndex(16, capacity=4))
+
+  @unittest.skipIf(hnswlib == None, "hnswlib not installed")
+  def test_hnsw(self):
+    self._check(HnswIndex(16, capacity=4))
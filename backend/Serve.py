@@ -0,0 +1,53 @@
+"""
+Greenlet server for `backend.Apps.Main`
+
+Each request runs in a greenlet instead of a worker thread. Blocking socket io
+(pymongo, redis, requests, groq) is made cooperative by `monkey.patch_all()`
+so an open `/api/ai/chat-stream` only costs a greenlet while it waits for the
+next token, and thousands of streams share one OS thread.
+All the other blueprints are served unchanged.
+
+Usage
+  python -m backend.Serve
+
+Env
+  FLASK_RUN_HOST          - bind address (default: 0.0.0.0)
+  FLASK_RUN_PORT          - bind port (default: 5000)
+  SERVE_MAX_CONNECTIONS   - max concurrent connections (default: 2000)
+
+SIGTERM stops the server like Ctrl-C, open requests get 5 seconds and the
+exit hooks (the audit writer flush) run.
+"""
+# NOTE patch before anything imports socket, ssl, threading or time
+from gevent import monkey
+monkey.patch_all()
+
+import signal
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from backend.Lib.Config import SERVE_HOST, SERVE_PORT, SERVE_MAX_CONNECTIONS
+from backend.Lib.Logger import Logger
+from backend.Apps.Main import app
+
+def serve():
+  server = WSGIServer(
+    (SERVE_HOST, SERVE_PORT),
+    app,
+    spawn=Pool(SERVE_MAX_CONNECTIONS),
+    backlog=SERVE_MAX_CONNECTIONS,
+    log=None,
+    error_log=Logger.log
+  )
+  gevent.signal_handler(signal.SIGTERM, server.stop)
+  Logger.log.info(f"Serving backend.Apps.Main on {SERVE_HOST}:{SERVE_PORT} (greenlet, max_connections={SERVE_MAX_CONNECTIONS})")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.stop(timeout=5)
+
+if __name__ == "__main__":
+  serve()
@@ -1,5 +1,15 @@
 import unittest
 from Lib.Sanitizer import TestContainsHtml
+from Lib.Metrics import TestMetrics
+from Lib.Deadline import TestDeadline
+from Lib.VectorIndex import TestVectorIndex
+from Lib.ContextPacker import TestContextPacker
+from Lib.StreamCoalescer import TestStreamCoalescer
+from Lib.Cancellation import TestCancellation
+from Lib.TextChunker import TestTextChunker
+from Lib.PdfPages import TestPdfPages
+from Lib.FileSniff import TestFileSniff
+from Lib.Breaker import TestBreaker
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+"""
+Worker for the file memory ingestion jobs queued by `/api/memory/create`
+and `/api/memory/update`
+
+Runs `INGEST_WORKERS` jobs at once, scaled apart from the API: any number
+of workers share the queue (`Apps.Main.Ingestion`). A job reads its spooled
+file from GridFS, extracts, chunks, embeds and inserts the memories
+(`Service.Memory.ingest_file`, only the changed chunks of a file that
+replaces another) and reports its stage and progress in the job status. A
+job failed by an error other than the file's (e.g. the encoder is down) is
+queued again up to `INGEST_RETRIES` times, then it fails with its error and
+the spooled file is deleted.
+
+Usage
+  python -m backend.Worker
+
+Env
+  INGEST_WORKERS          - jobs run at once (default: 2)
+  INGEST_RETRIES          - runs of a failed job after the first (default: 2)
+  INGEST_CLAIM_IDLE_SEC   - a job without progress this long is run by another worker (default: 600)
+  PDF_WORKERS             - processes reading pdf pages, shared by the jobs (default: cpu count)
+
+SIGTERM stops taking jobs, the running ones finish.
+"""
+import os
+import signal
+import socket
+from threading import Event, Thread
+from bson import ObjectId
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from backend.Lib.Config import INGEST_RETRIES, INGEST_WORKERS, PDF_WORKERS
+from backend.Lib.Logger import Logger
+from backend.Lib.PdfPages import start_pool
+
+# forked before the services start their threads (retrieval cache, embeddings)
+if __name__ == "__main__":
+  start_pool(PDF_WORKERS)
+
+from backend.Apps.Main.Database import db_connection_init
+from backend.Apps.Main.Ingestion import IngestionExtension, IngestionService, get_ingestion
+from backend.Apps.Main.Retrieval import RetrievalExtension, get_retrieval
+from backend.Apps.Main.Service.Memory import discard_file, ingest_file, replaced_memories
+
+_RETRY_SEC = 5
+_stop = Event()
+
+def _object_id(value: str) -> ObjectId | None:
+  return ObjectId(value) if ObjectId.is_valid(value) else None
+
+def run_job(ingestion: IngestionService, consumer: str, entry_id: str, job_id: str):
+  job = ingestion.get(job_id)
+  if job == None or job["status"] in ("done", "failed"):
+    # expired or finished by a worker that died before removing it
+    ingestion.finish(entry_id)
+    return
+
+  attempts = job["attempts"] + 1
+  ingestion.update(job_id, status="running", attempts=attempts)
+
+  def progress(stage: str, chunks: int):
+    ingestion.update(job_id, stage=stage, chunks=chunks)
+    ingestion.heartbeat(consumer, entry_id)
+
+  file_id = ObjectId(job["file_id"])
+  replaces = _object_id(job.get("replaces", ""))
+  try:
+    user_id = _object_id(job.get("user", ""))
+    ids = ingest_file(file_id, job["title"], job["tags"], progress, user_id, job.get("ip", ""), replaces)
+  except Exception as e:
+    error = getattr(e, "description", None) or repr(e)
+    Logger.log.error(f"ingestion job {job_id} attempt {attempts} failed: {error}")
+    # an HTTPException is about the file (not supported, no text), the rest may pass next time
+    if attempts <= INGEST_RETRIES and not isinstance(e, HTTPException):
+      ingestion.update(job_id, status="queued", stage="queued", chunks=0, error=error)
+      ingestion.finish(entry_id, retry_job=job_id)
+    else:
+      discard_file(file_id)
+      ingestion.update(job_id, status="failed", error=error)
+      ingestion.finish(entry_id)
+    return
+
+  synced = ids
+  if replaces != None:
+    synced = ids + replaced_memories(replaces, _object_id(job.get("replaces_file", "")))
+  # published to the indexes kept in process by the Main replicas
+  get_retrieval().sync_memories(synced)
+  ingestion.update(job_id, status="done", stage="done", chunks=len(ids), memories=len(ids), error="")
+  ingestion.finish(entry_id)
+  Logger.log.info(f"ingestion job {job_id} done, {len(ids)} memories")
+
+def work(app: Flask, n: int):
+  consumer = f"{socket.gethostname()}-{os.getpid()}-{n}"
+  with app.app_context():
+    ingestion = get_ingestion()
+    while not _stop.is_set():
+      try:
+        taken = ingestion.take(consumer)
+        if taken != None:
+          run_job(ingestion, consumer, *taken)
+      except Exception as e:
+        Logger.log.error(f"Worker::work {repr(e)}")
+        _stop.wait(_RETRY_SEC)
+
+def create_app() -> Flask:
+  """
+  The services of the jobs only, not the API app (`backend.Apps.Main.app`).
+  The retrieval does not load an index, it publishes the written memories
+  to the indexes of the Main replicas
+  """
+  app = Flask(__name__)
+  db_connection_init()
+  IngestionExtension(app)
+  RetrievalExtension(app, search=False)
+  return app
+
+def main():
+  app = create_app()
+  signal.signal(signal.SIGTERM, lambda *_: _stop.set())
+  threads = [ Thread(target=work, args=(app, i), name=f"ingest-{i}") for i in range(max(1, INGEST_WORKERS)) ]
+  for t in threads:
+    t.start()
+  Logger.log.info(f"Ingestion worker running {len(threads)} jobs at once")
+  try:
+    while not _stop.wait(1):
+      pass
+  except KeyboardInterrupt:
+    _stop.set()
+  for t in threads:
+    t.join()
+
+if __name__ == "__main__":
+  main()
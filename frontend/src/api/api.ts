@@ -77,6 +77,45 @@ export type MemoryCreateRequest = {
   file?: File | null;
 };
 
+export type MemoryJob = {
+  id: string;
+  status: "queued" | "running" | "done" | "failed";
+  stage: "queued" | "extract" | "embed" | "insert" | "done";
+  chunks: number;
+  attempts: number;
+  error: string;
+  memories: number;
+  filename: string;
+  created_at: string;
+  updated_at: string;
+};
+
+const MEMORY_JOB_POLL_MS = 1000;
+
+const getMemoryJob = async (jobId: string): Promise<MemoryJob> => {
+  const res = await api.get(`/memory/jobs/${jobId}`);
+  return res.data;
+};
+
+// files are ingested in the background (202 { job }), wait until the job ends
+const waitForMemoryJob = async <T extends { status: number; data: any }>(res: T): Promise<T> => {
+  if (res.status !== 202) {
+    return res;
+  }
+
+  const jobId: string = res.data.job;
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, MEMORY_JOB_POLL_MS));
+    const job = await getMemoryJob(jobId);
+    if (job.status === "done") {
+      return res;
+    }
+    if (job.status === "failed") {
+      throw new Error(job.error || "File ingestion failed");
+    }
+  }
+};
+
 export type MemoryGetRequest = {
   title?: string;
   mem_type?: string;
@@ -119,8 +158,13 @@ export type ChatRequest = {
   content: string;
   file: File | null;
   agent?: "professor" | "hacker";
+  // one per turn, a retry of the turn sends the same one and is not stored twice
+  idempotencyKey?: string;
 };
 
+// a request that got no response is sent again this many times with the same Idempotency-Key
+const CHAT_RETRIES = 2;
+
 export type ChatResponse = {
   conversation: string;
   reply: string;
@@ -226,13 +270,16 @@ export const memoryApi = {
       formData.append("file", data.file);
     }
 
-    return api.post("/memory/create", formData, {
+    const res = await api.post("/memory/create", formData, {
       headers: {
         "Content-Type": "multipart/form-data",
       },
     });
+    return waitForMemoryJob(res);
   },
 
+  job: getMemoryJob,
+
   get: async (filters?: MemoryGetRequest, params?: MemoryGetParams) => {
     const queryParams: Record<string, string> = {};
 
@@ -290,11 +337,13 @@ export const memoryApi = {
       formData.append("file", data.file);
     }
 
-    return api.put(`/memory/update/${memoryId}`, formData, {
+    const res = await api.put(`/memory/update/${memoryId}`, formData, {
       headers: {
         "Content-Type": "multipart/form-data",
       },
     });
+    // a new file is ingested like a created one
+    return waitForMemoryJob(res);
   },
 
   delete: async (memoryId: string) => {
@@ -365,12 +414,23 @@ export const aiApi = {
     const overrides = {};
     formData.append("overrides", JSON.stringify(overrides));
 
-    return api.post<ChatResponse>("/ai/chat", formData, {
-      headers: {
-        "Content-Type": "multipart/form-data",
-      },
-      signal,
-    });
+    const idempotencyKey = data.idempotencyKey ?? crypto.randomUUID();
+    for (let attempt = 0; ; attempt++) {
+      try {
+        return await api.post<ChatResponse>("/ai/chat", formData, {
+          headers: {
+            "Content-Type": "multipart/form-data",
+            "Idempotency-Key": idempotencyKey,
+          },
+          signal,
+        });
+      } catch (error) {
+        // retried only when the request may not have reached the server
+        if (attempt >= CHAT_RETRIES || signal?.aborted || !axios.isAxiosError(error) || error.response) {
+          throw error;
+        }
+      }
+    }
   },
   truncateMessage: async (messageId: string, content: string) => {
     return api.post("/ai/truncate-message", {
@@ -412,59 +472,134 @@ export const aiApi = {
     }
   }
 
-  const response = await fetch(`${API_BASE_URL}/ai/chat-stream`, {
-    method: "POST",
-    body: formData,
-    credentials: "include",
-    headers: {
-      "X-CSRF-TOKEN": csrfToken,
-    },
-    signal,
-  });
+  // a retry with the same key follows the reply of the first request instead of generating another one
+  const idempotencyKey = data.idempotencyKey ?? crypto.randomUUID();
+  let response: Response;
+  for (let attempt = 0; ; attempt++) {
+    try {
+      response = await fetch(`${API_BASE_URL}/ai/chat-stream`, {
+        method: "POST",
+        body: formData,
+        credentials: "include",
+        headers: {
+          "X-CSRF-TOKEN": csrfToken,
+          "Idempotency-Key": idempotencyKey,
+        },
+        signal,
+      });
+      break;
+    } catch (error) {
+      // fetch rejects without a response (network error) or when aborted
+      if (attempt >= CHAT_RETRIES || signal?.aborted) {
+        throw error;
+      }
+    }
+  }
 
   if (!response.ok) {
     throw new Error(`HTTP error! status: ${response.status}`);
   }
 
-  const reader = response.body?.getReader();
-  const decoder = new TextDecoder();
   let conversationId = "";
   let aiMessageId: string | undefined;  // ✅ Add this
+  // the reply is buffered on the server, a dropped connection resumes after the last event id
+  let streamId: string | undefined;
+  let lastEventId = "0";
+  let finished = false;
+
+  // the stop button aborts the fetch, stop the generation too
+  signal?.addEventListener("abort", () => {
+    if (streamId && !finished) {
+      fetch(`${API_BASE_URL}/ai/chat-stream/${streamId}/stop`, {
+        method: "POST",
+        credentials: "include",
+        headers: { "X-CSRF-TOKEN": csrfToken },
+      }).catch(() => {});
+    }
+  }, { once: true });
 
-  if (!reader) {
-    throw new Error("No response body");
-  }
+  const readEvents = async (res: Response) => {
+    const reader = res.body?.getReader();
+    const decoder = new TextDecoder();
 
-  try {
-    while (true) {
-      const { done, value } = await reader.read();
-      
-      if (done) {
-        console.log("✅ Stream reader completed");
-        break;
-      }
+    if (!reader) {
+      throw new Error("No response body");
+    }
 
-      const chunk = decoder.decode(value);
-      const lines = chunk.split("\n");
-
-      for (const line of lines) {
-        if (line.startsWith("data: ")) {
-          const data = JSON.parse(line.slice(6));
-
-          if (data.type === "content") {
-            onChunk(data.content);
-          } else if (data.type === "done") {
-            conversationId = data.conversation || "";
-            aiMessageId = data.ai_message_id;  // ✅ Capture this
-            console.log("✅ Received 'done' event with conversation:", conversationId, "ai_message_id:", aiMessageId);
-          } else if (data.type === "error") {
-            throw new Error(data.content);
+    // a read can end inside a line (or a character), it is completed by the next one
+    let partial = "";
+    // the id of an event counts once its data line arrived
+    let eventId: string | undefined;
+
+    try {
+      while (true) {
+        const { done, value } = await reader.read();
+        
+        if (done) {
+          console.log("✅ Stream reader completed");
+          break;
+        }
+
+        const lines = (partial + decoder.decode(value, { stream: true })).split("\n");
+        partial = lines.pop() ?? "";
+
+        for (const line of lines) {
+          if (line.startsWith("id: ")) {
+            eventId = line.slice(4);
+          } else if (line.startsWith("data: ")) {
+            const data = JSON.parse(line.slice(6));
+            if (eventId !== undefined) {
+              lastEventId = eventId;
+              eventId = undefined;
+            }
+
+            if (data.type === "stream") {
+              streamId = data.id;
+            } else if (data.type === "content") {
+              onChunk(data.content);
+            } else if (data.type === "done") {
+              finished = true;
+              conversationId = data.conversation || "";
+              aiMessageId = data.ai_message_id;  // ✅ Capture this
+              console.log("✅ Received 'done' event with conversation:", conversationId, "ai_message_id:", aiMessageId);
+            } else if (data.type === "error") {
+              finished = true;
+              throw new Error(data.content);
+            }
           }
         }
       }
+    } finally {
+      reader.releaseLock();
+    }
+  };
+
+  let res = response;
+  for (let attempt = 0; ; attempt++) {
+    try {
+      await readEvents(res);
+      if (finished || !streamId) {
+        break;
+      }
+    } catch (err) {
+      if (finished || !streamId || signal?.aborted || attempt >= 3) {
+        throw err;
+      }
+    }
+    // also a connection closed cleanly before done, e.g. by a proxy idle timeout
+    if (attempt >= 3) {
+      throw new Error("The reply stream closed before the reply finished");
+    }
+    console.log("🔁 Resuming reply", streamId, "after", lastEventId);
+    await new Promise((resolve) => setTimeout(resolve, 500 * (attempt + 1)));
+    res = await fetch(`${API_BASE_URL}/ai/chat-stream/${streamId}`, {
+      credentials: "include",
+      headers: { "Last-Event-ID": lastEventId },
+      signal,
+    });
+    if (!res.ok) {
+      throw new Error(`HTTP error! status: ${res.status}`);
     }
-  } finally {
-    reader.releaseLock();
   }
 
   console.log("✅ Returning from chatStream");